@@ -0,0 +1,140 @@
+"""
+Address-level research shared across agents.
+
+Sections marked ``shared`` in the prompt registry are pure research about
+the property's surroundings and market. Once generated for an address they
+are stored under its canonical key and reused by every agent who analyzes
+the same address while they are fresh, so only the agent-specific sections
+need a new upstream call. The generated text names the address as the
+first agent spelled it; ``research_html`` swaps in the reader's spelling.
+"""
+import logging
+import re
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .analysis_prompts import PROMPT_VERSION, SHARED_SECTION_KEYS
+from .models import AddressResearch
+
+logger = logging.getLogger(__name__)
+
+# Spellings folded together by canonical_address, after lowercasing and
+# dropping punctuation
+_ADDRESS_TOKENS = {
+    'street': 'st', 'avenue': 'ave', 'av': 'ave', 'road': 'rd', 'drive': 'dr', 'boulevard': 'blvd',
+    'lane': 'ln', 'court': 'ct', 'place': 'pl', 'terrace': 'ter', 'circle': 'cir', 'parkway': 'pkwy',
+    'highway': 'hwy', 'square': 'sq', 'trail': 'trl',
+    'north': 'n', 'south': 's', 'east': 'e', 'west': 'w',
+    'northeast': 'ne', 'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw',
+    'apartment': 'apt', 'suite': 'ste', '#': 'unit',
+    'usa': '',
+}
+_ADDRESS_PUNCTUATION_RE = re.compile(r'[^\w#]+')
+
+
+def canonical_address(address: str) -> str:
+    """
+    Normalized form of an address used as the research key
+
+    "123 Main Street, Springfield, IL" and "123 main st springfield il"
+    share a key. Only spelling is normalized; no geocoding is done.
+    """
+    tokens = _ADDRESS_PUNCTUATION_RE.sub(' ', address.lower().replace('#', ' # ')).split()
+    tokens = [_ADDRESS_TOKENS.get(token, token) for token in tokens]
+    return ' '.join(token for token in tokens if token)[:255]
+
+
+def _fresh_after():
+    return timezone.now() - timedelta(seconds=settings.ADDRESS_RESEARCH_MAX_AGE)
+
+
+def load_research(address: str, model: str, keys: Optional[Iterable[str]] = None) -> Dict[str, AddressResearch]:
+    """
+    Fresh shared sections stored for an address
+
+    Args:
+        address: Property address, in any spelling
+        model: Perplexity model the sections must have been generated with
+        keys: Section keys wanted (all shared sections when None)
+
+    Returns:
+        AddressResearch rows by section key; missing or stale sections are left out
+    """
+    if not settings.ADDRESS_RESEARCH_ENABLED:
+        return {}
+    keys = SHARED_SECTION_KEYS if keys is None else SHARED_SECTION_KEYS.intersection(keys)
+    try:
+        rows = AddressResearch.objects.filter(
+            address_key=canonical_address(address),
+            section_key__in=list(keys),
+            model=model,
+            prompt_version=PROMPT_VERSION,
+            generated_at__gte=_fresh_after(),
+        )
+        research = {row.section_key: row for row in rows}
+        if research:
+            AddressResearch.objects.filter(pk__in=[row.pk for row in research.values()]).update(
+                reuse_count=F('reuse_count') + 1
+            )
+    except Exception as e:
+        logger.warning(f"Address research read failed: {str(e)}")
+        return {}
+    return research
+
+
+def store_research(address: str, model: str, sections: Dict[str, str], citations: Optional[List] = None) -> int:
+    """
+    Save freshly generated sections, keeping only the shareable ones
+
+    Args:
+        address: Property address, in any spelling
+        model: Perplexity model the sections were generated with
+        sections: Section HTML by section key
+        citations: Sources the sections were researched from
+
+    Returns:
+        Number of sections stored
+    """
+    if not settings.ADDRESS_RESEARCH_ENABLED:
+        return 0
+    address_key = canonical_address(address)
+    spelling = address.strip()[:255]
+    now = timezone.now()
+    stored = 0
+    for key, html in sections.items():
+        if key not in SHARED_SECTION_KEYS or not html:
+            continue
+        try:
+            AddressResearch.objects.update_or_create(
+                address_key=address_key,
+                section_key=key,
+                model=model,
+                prompt_version=PROMPT_VERSION,
+                defaults={'address': spelling, 'html': html, 'citations': citations or [],
+                          'generated_at': now, 'reuse_count': 0},
+            )
+        except Exception as e:
+            logger.warning(f"Address research write failed for {address_key} {key}: {str(e)}")
+            continue
+        stored += 1
+    if stored:
+        logger.info(f"Stored {stored} shared analysis sections for {address_key}")
+    return stored
+
+
+def research_html(row: AddressResearch, address: str) -> str:
+    """Stored section HTML with the address spelled as in ``address``"""
+    address = address.strip()
+    if not row.address or row.address == address:
+        return row.html
+    return row.html.replace(row.address, address)
+
+
+def purge_research() -> int:
+    """Delete research older than the freshness window"""
+    deleted, _ = AddressResearch.objects.filter(generated_at__lt=_fresh_after()).delete()
+    return deleted
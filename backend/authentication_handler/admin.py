@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from .models import AgentProfile, PropertyAnalysis, PropertyAnalysisShare, SharedAnalysisView
+from .models import AddressResearch, AgentProfile, AnalysisBatch, AnalysisJob, CachedPerplexityResponse, GenerationResult, PropertyAnalysis, PropertyAnalysisShare, SharedAnalysisView, StreamedGeneration, UpstreamUsage
 
 class AgentProfileInline(admin.StackedInline):
     """Inline admin for AgentProfile to show with User"""
@@ -118,9 +118,9 @@ admin.site.register(User, CustomUserAdmin)
 
 @admin.register(PropertyAnalysis)
 class PropertyAnalysisAdmin(admin.ModelAdmin):
-    list_display = ('id', 'user', 'address', 'created_at', 'updated_at')  # apne fields ke hisaab se change kar lena
+    list_display = ('id', 'user', 'address', 'analysis_model', 'model_route_reason', 'created_at', 'updated_at')  # apne fields ke hisaab se change kar lena
     search_fields = ('id',)
-    list_filter = ('created_at',)
+    list_filter = ('created_at', 'analysis_model', 'model_route_reason')
 
 @admin.register(PropertyAnalysisShare)
 class PropertyAnalysisShareAdmin(admin.ModelAdmin):
@@ -132,4 +132,53 @@ class PropertyAnalysisShareAdmin(admin.ModelAdmin):
 class SharedAnalysisViewAdmin(admin.ModelAdmin):
     list_display = ('id', 'share', 'viewed_at', 'ip_address')  # fields apne model ke according
     search_fields = ('id',)
-    list_filter = ('viewed_at',)
\ No newline at end of file
+    list_filter = ('viewed_at',)
+
+@admin.register(CachedPerplexityResponse)
+class CachedPerplexityResponseAdmin(admin.ModelAdmin):
+    list_display = ('id', 'cache_key', 'model', 'size_bytes', 'hit_count', 'created_at', 'last_hit_at')
+    search_fields = ('cache_key',)
+    list_filter = ('model', 'created_at')
+    readonly_fields = ('created_at', 'last_hit_at')
+
+@admin.register(AnalysisBatch)
+class AnalysisBatchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'name', 'package_name', 'total', 'concurrency', 'created_at')
+    search_fields = ('id', 'name', 'user__username', 'user__email')
+    list_filter = ('created_at',)
+    readonly_fields = ('created_at',)
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'address', 'package_name', 'status', 'attempts', 'created_at', 'finished_at')
+    search_fields = ('id', 'address', 'payment_intent_id')
+    list_filter = ('status', 'created_at')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'updated_at')
+
+@admin.register(AddressResearch)
+class AddressResearchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'address_key', 'section_key', 'model', 'prompt_version', 'reuse_count', 'generated_at')
+    search_fields = ('address_key',)
+    list_filter = ('section_key', 'model', 'prompt_version', 'generated_at')
+    readonly_fields = ('generated_at',)
+
+@admin.register(StreamedGeneration)
+class StreamedGenerationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'generation_id', 'user', 'model', 'status', 'content_bytes', 'created_at', 'finished_at')
+    search_fields = ('generation_id', 'user__username', 'user__email')
+    list_filter = ('status', 'model', 'created_at')
+    readonly_fields = ('generation_id', 'created_at', 'updated_at', 'finished_at')
+
+@admin.register(UpstreamUsage)
+class UpstreamUsageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'client_key', 'model', 'purpose', 'total_tokens', 'cost', 'created_at')
+    search_fields = ('client_key', 'user__username', 'user__email')
+    list_filter = ('purpose', 'model', 'created_at')
+    readonly_fields = ('created_at',)
+
+@admin.register(GenerationResult)
+class GenerationResultAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'address', 'package_name', 'analysis_model', 'property_analysis', 'created_at', 'expires_at')
+    search_fields = ('token', 'address', 'user__username', 'user__email')
+    list_filter = ('analysis_model', 'created_at')
+    readonly_fields = ('token', 'created_at')
@@ -1,22 +1,37 @@
-import os
+import hashlib
+import json
+import threading
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .api_key_pool import parse_keys
+from .models import AgentProfile, UpstreamUsage
+from .upstream_client import PERPLEXITY, PERPLEXITY_CHAT_URL, get_client
+from .upstream_limiter import reset_client_key, set_client_key
+from .usage import BudgetExceeded, arecord_usage, check_budget, record_usage
+
 logger = logging.getLogger(__name__)
 
+# Part of the profile hash: bump when the prompt changes, then run
+# `manage.py regenerate_agent_descriptions` to regenerate stored descriptions
+DESCRIPTION_PROMPT_VERSION = '1'
+
 class AgentDescriptionGenerator:
     """Generates personalized agent descriptions using AI"""
     
     def __init__(self):
-        self.api_key = os.getenv('PERPLEXITY_API_KEY')
-        print("=======>>>>> PERPLEXITY_API_KEY ========<<<<<<<<", self.api_key)
-        if not self.api_key:
+        if not parse_keys(settings.PERPLEXITY_API_KEYS):
             raise ValueError("PERPLEXITY_API_KEY environment variable is required")
         
-        self.api_url = 'https://api.perplexity.ai/chat/completions'
+        self.api_url = PERPLEXITY_CHAT_URL
+        # The Perplexity client authorizes each call with a key from its pool
         self.headers = {
-            'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json',
             'accept': 'application/json',
         }
@@ -32,26 +47,10 @@ class AgentDescriptionGenerator:
             Generated agent description or None if generation fails
         """
         try:
-            # Prepare the prompt with agent data
-            prompt = self._build_agent_description_prompt(agent_profile_data)
-            
-            # Call Perplexity API
-            payload = {
-                'model': 'sonar',
-                'messages': [
-                    {
-                        'role': 'system',
-                        'content': 'You are a professional real estate marketing expert. Generate compelling, personalized agent descriptions that highlight the agent\'s unique value proposition and experience.'
-                    },
-                    {
-                        'role': 'user',
-                        'content': prompt
-                    }
-                ]
-            }
-            
-            response = requests.post(
-                self.api_url, 
+            check_budget()
+            payload = self.build_payload(agent_profile_data)
+            response = get_client(PERPLEXITY).post(
+                self.api_url,
                 headers=self.headers, 
                 json=payload,
                 timeout=30
@@ -62,21 +61,12 @@ class AgentDescriptionGenerator:
                 return None
             
             data = response.json()
-            choices = data.get('choices', [])
-            
-            if not choices:
-                logger.error("No choices returned from Perplexity API")
-                return None
-            
-            # Extract the generated description
-            description = choices[0].get('message', {}).get('content', '')
-            
-            if not description:
-                logger.error("Empty description returned from Perplexity API")
-                return None
-            
-            return description.strip()
+            record_usage(payload['model'], data.get('usage'), purpose=UpstreamUsage.PURPOSE_AGENT_DESCRIPTION)
+            return self.parse_response(data)
             
+        except BudgetExceeded as e:
+            logger.warning(f"Skipping agent description generation: {str(e)}")
+            return None
         except requests.exceptions.RequestException as e:
             logger.error(f"Request error during agent description generation: {str(e)}")
             return None
@@ -84,6 +74,58 @@ class AgentDescriptionGenerator:
             logger.error(f"Unexpected error during agent description generation: {str(e)}")
             return None
     
+    def build_payload(self, agent_profile_data: Dict) -> Dict:
+        """
+        Build the Perplexity request body for an agent description
+        
+        Args:
+            agent_profile_data: Dictionary containing agent profile information
+            
+        Returns:
+            Chat completion payload
+        """
+        # Prepare the prompt with agent data
+        prompt = self._build_agent_description_prompt(agent_profile_data)
+        
+        return {
+            'model': 'sonar',
+            'messages': [
+                {
+                    'role': 'system',
+                    'content': 'You are a professional real estate marketing expert. Generate compelling, personalized agent descriptions that highlight the agent\'s unique value proposition and experience.'
+                },
+                {
+                    'role': 'user',
+                    'content': prompt
+                }
+            ]
+        }
+    
+    def parse_response(self, data: Dict) -> Optional[str]:
+        """
+        Extract the generated description from a Perplexity response
+        
+        Args:
+            data: Decoded Perplexity API response
+            
+        Returns:
+            Generated agent description or None if the response is empty
+        """
+        choices = data.get('choices', [])
+        
+        if not choices:
+            logger.error("No choices returned from Perplexity API")
+            return None
+        
+        # Extract the generated description
+        description = choices[0].get('message', {}).get('content', '')
+        
+        if not description:
+            logger.error("Empty description returned from Perplexity API")
+            return None
+        
+        return description.strip()
+    
     def _build_agent_description_prompt(self, agent_data: Dict) -> str:
         """
         Build the prompt for generating agent description
@@ -163,6 +205,24 @@ Generate a compelling, welcoming description that makes potential clients feel c
         
         return prompt.strip()
 
+_generator = None
+_generator_lock = threading.Lock()
+
+
+def get_generator() -> AgentDescriptionGenerator:
+    """
+    Process-wide generator, created on first use
+
+    Raises:
+        ValueError: If PERPLEXITY_API_KEY is not set
+    """
+    global _generator
+    if _generator is None:
+        with _generator_lock:
+            if _generator is None:
+                _generator = AgentDescriptionGenerator()
+    return _generator
+
 # Convenience function for easy integration
 def generate_agent_description(agent_profile_data: Dict) -> Optional[str]:
     """
@@ -175,8 +235,223 @@ def generate_agent_description(agent_profile_data: Dict) -> Optional[str]:
         Generated agent description or None if generation fails
     """
     try:
-        generator = AgentDescriptionGenerator()
-        return generator.generate_agent_description(agent_profile_data)
+        generator = get_generator()
     except Exception as e:
         logger.error(f"Failed to create agent description generator: {str(e)}")
-        return None 
\ No newline at end of file
+        return None
+    return generator.generate_agent_description(agent_profile_data)
+
+async def agenerate_agent_description(agent_profile_data: Dict) -> Optional[str]:
+    """
+    Async version of ``generate_agent_description`` for the ASGI views
+    
+    Args:
+        agent_profile_data: Dictionary containing agent profile information
+        
+    Returns:
+        Generated agent description or None if generation fails
+    """
+    import httpx
+    from asgiref.sync import sync_to_async
+    
+    try:
+        generator = get_generator()
+        await sync_to_async(check_budget)()
+        payload = generator.build_payload(agent_profile_data)
+        response = await get_client(PERPLEXITY).apost(
+            generator.api_url,
+            headers=generator.headers,
+            json=payload,
+            timeout=30
+        )
+        
+        if response.status_code != 200:
+            logger.error(f"Perplexity API error: {response.status_code} - {response.text}")
+            return None
+        
+        data = response.json()
+        await arecord_usage(payload['model'], data.get('usage'), purpose=UpstreamUsage.PURPOSE_AGENT_DESCRIPTION)
+        return generator.parse_response(data)
+        
+    except BudgetExceeded as e:
+        logger.warning(f"Skipping agent description generation: {str(e)}")
+        return None
+    except httpx.HTTPError as e:
+        logger.error(f"Request error during agent description generation: {str(e)}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error during agent description generation: {str(e)}")
+        return None
+
+
+def profile_hash(agent_profile_data: Dict) -> str:
+    """
+    Hash of the profile fields an agent description is generated from
+
+    Args:
+        agent_profile_data: Output of ``AgentProfile.get_agent_description_data``
+
+    Returns:
+        Hex digest that changes whenever the prompt input or prompt version does
+    """
+    raw = json.dumps(
+        {'version': DESCRIPTION_PROMPT_VERSION, 'profile': agent_profile_data},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _stored_description(agent_profile: AgentProfile, content_hash: str) -> Optional[str]:
+    if agent_profile.agent_description and agent_profile.agent_description_hash == content_hash:
+        return agent_profile.agent_description
+    return None
+
+
+def _store_kwargs(agent_profile: AgentProfile, description: str, content_hash: str) -> Dict:
+    fields = {
+        'agent_description': description,
+        'agent_description_hash': content_hash,
+        'agent_description_generated_at': timezone.now(),
+    }
+    for name, value in fields.items():
+        setattr(agent_profile, name, value)
+    return fields
+
+
+def get_cached_agent_description(agent_profile: AgentProfile, regenerate: bool = False) -> Optional[str]:
+    """
+    Agent description for a profile, generated only when the profile changed
+
+    The stored description is returned as long as the hash of the profile
+    fields matches the one it was generated from. Otherwise a new one is
+    generated and stored.
+
+    Args:
+        agent_profile: Profile (with ``user`` loaded)
+        regenerate: Generate a new description even if the stored one is current
+
+    Returns:
+        The description, or None if generation failed
+    """
+    data = agent_profile.get_agent_description_data()
+    content_hash = profile_hash(data)
+    if not regenerate:
+        description = _stored_description(agent_profile, content_hash)
+        if description is not None:
+            return description
+
+    description = generate_agent_description(data)
+    if description:
+        # A profile edited meanwhile keeps a mismatching hash and is regenerated on next use
+        AgentProfile.objects.filter(pk=agent_profile.pk).update(
+            **_store_kwargs(agent_profile, description, content_hash)
+        )
+    return description
+
+
+async def aget_cached_agent_description(agent_profile: AgentProfile, regenerate: bool = False) -> Optional[str]:
+    """Async version of ``get_cached_agent_description``"""
+    data = agent_profile.get_agent_description_data()
+    content_hash = profile_hash(data)
+    if not regenerate:
+        description = _stored_description(agent_profile, content_hash)
+        if description is not None:
+            return description
+
+    description = await agenerate_agent_description(data)
+    if description:
+        await AgentProfile.objects.filter(pk=agent_profile.pk).aupdate(
+            **_store_kwargs(agent_profile, description, content_hash)
+        )
+    return description
+
+
+# Outcomes of refresh_agent_description
+GENERATED = 'generated'
+UNCHANGED = 'unchanged'
+FAILED = 'failed'
+
+
+def refresh_agent_description(agent_profile: AgentProfile, force: bool = False) -> str:
+    """
+    Regenerate a profile's stored description if it is out of date
+
+    Upstream calls are attributed to the profile's user, so per-user limits apply.
+
+    Args:
+        agent_profile: Profile (with ``user`` loaded)
+        force: Regenerate even if the stored description is current
+
+    Returns:
+        GENERATED, UNCHANGED or FAILED
+    """
+    if not force:
+        content_hash = profile_hash(agent_profile.get_agent_description_data())
+        if _stored_description(agent_profile, content_hash) is not None:
+            return UNCHANGED
+
+    token = set_client_key(f'user:{agent_profile.user_id}')
+    try:
+        description = get_cached_agent_description(agent_profile, regenerate=force)
+    except Exception as e:
+        logger.error(f"Agent description refresh failed for profile {agent_profile.pk}: {str(e)}")
+        return FAILED
+    finally:
+        reset_client_key(token)
+    return GENERATED if description else FAILED
+
+
+_refresh_executor = None
+_refresh_pending = set()
+_refresh_lock = threading.Lock()
+
+
+def schedule_description_refresh(agent_profile: AgentProfile) -> bool:
+    """
+    Regenerate a profile's description in the background if it is out of date
+
+    Runs after the current transaction commits, on a small thread pool, so
+    the next analysis finds the description ready.
+
+    Returns:
+        True if a refresh was queued
+    """
+    if not settings.AGENT_DESCRIPTION_PRECOMPUTE:
+        return False
+    content_hash = profile_hash(agent_profile.get_agent_description_data())
+    if _stored_description(agent_profile, content_hash) is not None:
+        return False
+
+    with _refresh_lock:
+        # Already queued refreshes read the profile when they start
+        if agent_profile.pk in _refresh_pending:
+            return False
+        _refresh_pending.add(agent_profile.pk)
+
+    transaction.on_commit(lambda: _get_refresh_executor().submit(_refresh_description, agent_profile.pk))
+    return True
+
+
+def _get_refresh_executor() -> ThreadPoolExecutor:
+    global _refresh_executor
+    with _refresh_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.AGENT_DESCRIPTION_REFRESH_WORKERS),
+                thread_name_prefix='agent-description',
+            )
+    return _refresh_executor
+
+
+def _refresh_description(profile_id: int):
+    with _refresh_lock:
+        _refresh_pending.discard(profile_id)
+    try:
+        agent_profile = AgentProfile.objects.select_related('user').get(pk=profile_id)
+        if refresh_agent_description(agent_profile) == GENERATED:
+            logger.info(f"Regenerated agent description for profile {profile_id}")
+    except AgentProfile.DoesNotExist:
+        pass
+    finally:
+        connection.close()
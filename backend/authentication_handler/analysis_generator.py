@@ -0,0 +1,330 @@
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Dict, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.db import connection
+
+from .address_research import load_research, research_html, store_research
+from .analysis_prompts import (
+    PROMPT_VERSION, SECTION_KEYS, SHARED_SECTION_KEYS, build_messages, build_section_messages,
+    extract_section, insert_welcome_section, split_sections,
+)
+from .models import AgentProfile
+from .perplexity_service import PerplexityError, complete, get_content
+from .response_cache import HIT, MISS
+
+logger = logging.getLogger(__name__)
+
+MODE_SINGLE = 'single'
+MODE_SECTIONS = 'sections'
+GENERATION_MODES = (MODE_SINGLE, MODE_SECTIONS)
+
+# Upstream statuses worth retrying a section for
+_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AnalysisResult(NamedTuple):
+    data: Dict
+    cache_status: str
+    agent_description: str
+    prompt_version: str
+
+
+class SectionResult(NamedTuple):
+    key: str
+    html: str
+    data: Dict
+    cache_status: str
+    attempts: int  # 0 when reused from address research
+    latency_ms: float
+
+
+def parse_generation_options(options) -> Dict:
+    """
+    Validate the ``options`` object of a generation request
+
+    Multipart uploads send it as a JSON string, which is parsed first.
+
+    Returns:
+        The options ({} when none were sent)
+
+    Raises:
+        ValueError: If ``options`` is not an object or names an unknown mode
+    """
+    if isinstance(options, str):
+        try:
+            options = json.loads(options) if options.strip() else {}
+        except ValueError:
+            raise ValueError('Field "options" must be a JSON object.')
+    options = options or {}
+    if not isinstance(options, dict):
+        raise ValueError('Field "options" must be a JSON object.')
+    if options.get('mode') is not None and options['mode'] not in GENERATION_MODES:
+        raise ValueError(f'Option "mode" must be one of: {", ".join(GENERATION_MODES)}.')
+    return options
+
+
+def get_agent_description(user) -> str:
+    """
+    Welcome section text for a user's analyses, reusing the stored
+    description while their profile is unchanged
+
+    Returns:
+        The description, or '' if the user has no profile or generation failed
+    """
+    from .agent_description_generator import get_cached_agent_description
+
+    try:
+        agent_profile = AgentProfile.objects.select_related('user').get(user=user)
+    except AgentProfile.DoesNotExist:
+        return ''
+    return get_cached_agent_description(agent_profile) or ''
+
+
+def generate_analysis(user, address: str, model: str = 'sonar', include_agent_description: bool = True,
+                      agent_description: Optional[str] = None, use_cache: bool = True,
+                      mode: Optional[str] = None) -> AnalysisResult:
+    """
+    Generate a property analysis from the server-side prompt template
+
+    The analysis prompt only depends on the address; the agent Welcome
+    section is generated alongside it and spliced into the report
+    afterwards, so a report takes as long as the slower of the two calls.
+    Shared research sections already generated for the address (by any
+    agent) are reused while fresh, and only the remaining sections are
+    generated.
+
+    Args:
+        user: User the analysis is for (their profile feeds the Welcome section)
+        address: Property address
+        model: Perplexity model name
+        include_agent_description: Add the agent Welcome section
+        agent_description: Use this Welcome text instead of the user's stored or generated one
+        use_cache: Read and write the response cache and shared address research
+        mode: ``single`` for one call producing every section, ``sections`` to
+            fan out one call per section (defaults to ANALYSIS_GENERATION_MODE).
+            When some sections are already researched, only the missing
+            ones are generated, one call each, whatever the mode
+
+    Returns:
+        AnalysisResult with the completion and how it was produced
+
+    Raises:
+        PerplexityError: If the analysis call failed
+    """
+    mode = mode or settings.ANALYSIS_GENERATION_MODE
+    if not include_agent_description:
+        agent_description = ''
+
+    # Sections already researched for the address are reused in either mode;
+    # only the missing ones are generated
+    research = load_research(address, model) if use_cache else {}
+
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='agent-description') as executor:
+        description_future = None
+        if agent_description is None:
+            # Proceed without the Welcome section if the description cannot be generated
+            description_future = executor.submit(copy_context().run, _load_agent_description, user)
+
+        if mode == MODE_SECTIONS or research:
+            data, cache_status = generate_sections(
+                address, model, reserve_welcome=include_agent_description, use_cache=use_cache,
+                research=research,
+            )
+        else:
+            messages = build_messages(address, reserve_welcome=include_agent_description)
+            data, cache_status = complete(model, messages, use_cache=use_cache)
+            if use_cache and cache_status == MISS:
+                store_research(address, model, split_sections(get_content(data)), data.get('citations'))
+
+        if description_future is not None:
+            agent_description = description_future.result()
+
+    if include_agent_description and get_content(data):
+        data = _with_content(data, insert_welcome_section(get_content(data), agent_description))
+    return AnalysisResult(data, cache_status, agent_description, PROMPT_VERSION)
+
+
+def _load_agent_description(user) -> str:
+    try:
+        return get_agent_description(user)
+    finally:
+        connection.close()
+
+
+def _with_content(data: Dict, content: str) -> Dict:
+    """Copy of a completion with its message content replaced (cached completions are shared)"""
+    choices = list(data.get('choices') or [{'index': 0}])
+    first = dict(choices[0])
+    first['message'] = dict(first.get('message') or {'role': 'assistant'}, content=content)
+    choices[0] = first
+    return dict(data, choices=choices)
+
+
+def generate_sections(address: str, model: str, reserve_welcome: bool = False, use_cache: bool = True,
+                      research: Optional[Dict] = None):
+    """
+    Generate every section as its own concurrent upstream call
+
+    Sections run on a pool of ANALYSIS_SECTION_CONCURRENCY threads, so a full
+    report takes about as long as its slowest section. Each section is
+    retried on its own; sections that already succeeded are in the response
+    cache, so re-running a failed report only pays for what failed.
+
+    Args:
+        address: Property address
+        model: Perplexity model name
+        reserve_welcome: Number sections from 2, leaving 1 for the Welcome section
+        use_cache: Read and write the response cache; newly generated shared
+            sections are also stored as address research
+        research: Stored AddressResearch by section key, used instead of generating those sections
+
+    Returns:
+        (completion, cache_status) with the assembled report in the regular
+        chat completion shape
+
+    Raises:
+        PerplexityError: If a section still failed after its retries
+    """
+    research = research or {}
+    first_number = 2 if reserve_welcome else 1
+    numbered = [(key, first_number + index) for index, key in enumerate(SECTION_KEYS)]
+    to_generate = [(key, number) for key, number in numbered if key not in research]
+    workers = max(1, min(settings.ANALYSIS_SECTION_CONCURRENCY, len(to_generate) or 1))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-section') as executor:
+        # Each task runs in a copy of this context so per-user upstream limits still apply
+        futures = {
+            key: executor.submit(copy_context().run, _generate_section, address, key, number, model, use_cache)
+            for key, number in to_generate
+        }
+        # Collect every result before raising so no call is left running unobserved
+        outcomes = []
+        for key, number in numbered:
+            if key in research:
+                outcomes.append(_reused_section(research[key], address, key, number))
+                continue
+            try:
+                outcomes.append(futures[key].result())
+            except PerplexityError as e:
+                outcomes.append(e)
+
+    failed = [(key, outcome) for (key, _number), outcome in zip(numbered, outcomes)
+              if isinstance(outcome, PerplexityError)]
+    if failed:
+        error = failed[0][1]
+        raise PerplexityError(
+            dict(error.payload, failed_sections=[failed_key for failed_key, _error in failed]),
+            status_code=error.status_code,
+        )
+
+    if use_cache:
+        for section in outcomes:
+            if section.key in SHARED_SECTION_KEYS and section.key not in research and section.cache_status == MISS:
+                store_research(address, model, {section.key: section.html}, section.data.get('citations'))
+
+    elapsed_ms = (time.monotonic() - started) * 1000
+    logger.info(f"Generated {len(to_generate)} analysis sections for {address} in {elapsed_ms:.0f}ms "
+                f"({len(research)} reused from address research)")
+    return _assemble(outcomes, model, elapsed_ms)
+
+
+def _reused_section(row, address: str, key: str, number: int) -> SectionResult:
+    """A stored research section, renumbered for its position in this report"""
+    return SectionResult(
+        key=key,
+        html=extract_section(research_html(row, address), key, number, address),
+        data={'model': row.model, 'citations': row.citations},
+        cache_status=HIT,
+        attempts=0,
+        latency_ms=0.0,
+    )
+
+
+def _generate_section(address: str, key: str, number: int, model: str, use_cache: bool) -> SectionResult:
+    """Generate one section, retrying transient upstream failures"""
+    messages = build_section_messages(address, key, number)
+    max_attempts = max(1, settings.ANALYSIS_SECTION_MAX_ATTEMPTS)
+    started = time.monotonic()
+    try:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                data, cache_status = complete(model, messages, use_cache=use_cache)
+                content = get_content(data)
+                if not content:
+                    raise PerplexityError({'error': f'Perplexity API returned an empty "{key}" section'})
+                return SectionResult(
+                    key=key,
+                    html=extract_section(content, key, number, address),
+                    data=data,
+                    cache_status=cache_status,
+                    attempts=attempt,
+                    latency_ms=round((time.monotonic() - started) * 1000, 1),
+                )
+            except PerplexityError as e:
+                retryable = e.status_code in _RETRYABLE_STATUSES
+                if not retryable or attempt == max_attempts:
+                    logger.error(f"Analysis section {key} failed after {attempt} attempt(s): {str(e)}")
+                    raise
+                backoff = settings.ANALYSIS_SECTION_RETRY_BACKOFF * (2 ** (attempt - 1))
+                logger.warning(f"Analysis section {key} attempt {attempt} failed, retrying in {backoff}s: {str(e)}")
+                time.sleep(backoff)
+    finally:
+        # Pool threads open their own database connection for the cache tier
+        connection.close()
+
+
+def _assemble(sections: List[SectionResult], model: str, elapsed_ms: float):
+    """Join section results in order into a single chat completion"""
+    parts = ['<div class="property-analysis">']
+    parts.extend(section.html for section in sections)
+    parts.append('</div>')
+
+    usage = {}
+    citations = []
+    for section in sections:
+        for name, value in (section.data.get('usage') or {}).items():
+            if isinstance(value, (int, float)):
+                usage[name] = usage.get(name, 0) + value
+        for citation in section.data.get('citations') or []:
+            if citation not in citations:
+                citations.append(citation)
+
+    completion = {
+        'id': f'sections-{uuid.uuid4().hex}',
+        'model': next((section.data.get('model') for section in sections if section.data.get('model')), model),
+        'created': int(time.time()),
+        'object': 'chat.completion',
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'stop',
+            'message': {'role': 'assistant', 'content': ''.join(parts)},
+        }],
+        'usage': usage,
+        'generation': {
+            'mode': MODE_SECTIONS,
+            'elapsed_ms': round(elapsed_ms, 1),
+            'reused_sections': [section.key for section in sections if section.attempts == 0],
+            'sections': {
+                section.key: {
+                    'cache_status': section.cache_status,
+                    'attempts': section.attempts,
+                    'latency_ms': section.latency_ms,
+                }
+                for section in sections
+            },
+        },
+    }
+    if citations:
+        completion['citations'] = citations
+
+    # A report is only a HIT (or BYPASS) if every section was
+    statuses = {section.cache_status for section in sections}
+    cache_status = statuses.pop() if len(statuses) == 1 else MISS
+    return completion, cache_status
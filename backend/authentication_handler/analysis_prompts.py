@@ -0,0 +1,365 @@
+"""
+Server-side templates for the property analysis prompt.
+
+The analysis layout is a registry of sections, each rendered into an
+``<section class="analysis-section">`` block. Templates are compacted and
+compiled once at import, so rendering a prompt is a handful of string
+substitutions. Bump ``PROMPT_VERSION`` whenever the wording or layout
+changes; it is stored on every PropertyAnalysis and is part of the
+response cache key through the rendered prompt.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+PROMPT_VERSION = '3'
+
+WELCOME_SECTION_KEY = 'welcome'
+
+
+class PromptSection(NamedTuple):
+    key: str
+    title: str
+    body: str
+    # Identical for every agent and reused across their analyses (see
+    # address_research): section prompts only depend on the address, and the
+    # agent's own content lives in the separately generated Welcome section.
+    # A section whose prompt takes agent input, or that speaks for the listing
+    # agent (their pricing advice, marketing plan and promises), must leave this off.
+    shared: bool = False
+    # Built on current listings and market figures, so it goes out of date
+    # within weeks; refreshed in saved analyses by analysis_refresh
+    time_sensitive: bool = False
+
+
+def _listing_table(caption: str, empty_message: str) -> str:
+    return f'''
+    <div class="subsection">
+      <h3>{caption} Within 1-3 Mile Radius</h3>
+      <table class="listings-table">
+        <thead><tr><th>Address</th><th>Beds</th><th>Baths</th><th>Sqft</th><th>Price</th></tr></thead>
+        <tbody><tr><td>123 Example Street</td><td>3</td><td>2</td><td>1,850</td><td>$750,000</td></tr></tbody>
+      </table>
+      <p class="no-listings" style="display: none;">No {empty_message} found within 1-3 mile radius.</p>
+    </div>
+    '''
+
+
+SECTIONS: Tuple[PromptSection, ...] = (
+    PromptSection('buyers_love', 'What Buyers Love About {address}', '''
+      <p>Brief introduction paragraph about the area's appeal and key selling points.</p>
+      <ul>
+        <li>Specific neighborhood feature or amenity</li>
+        <li>Local lifestyle benefits and community features</li>
+        <li>Transportation and accessibility advantages</li>
+        <li>Safety ratings and community atmosphere</li>
+        <li>Recent developments or improvements</li>
+        <li>Balance of urban convenience with suburban comfort</li>
+      </ul>
+    ''', shared=True),
+    PromptSection('neighborhood', 'Neighborhood & Proximity Highlights', '''
+      <p>Here's what stands out about [specific street/area] and the surrounding area:</p>
+      <ul>
+        <li><strong>Lifestyle:</strong> Description of living environment and privacy</li>
+        <li><strong>Local Amenities:</strong><ul><li>Specific nearby recreational facilities</li><li>Parks, wineries, or entertainment venues</li></ul></li>
+        <li><strong>Schools:</strong> Highly rated public schools including <strong>School Name</strong>, <strong>School Name</strong>, and <strong>School Name</strong></li>
+        <li><strong>Shopping & Dining:</strong><ul><li>Specific shopping centers and grocery stores</li><li>Popular restaurants and dining areas</li></ul></li>
+        <li><strong>Commute Access:</strong> Transportation options and commute times to major areas</li>
+      </ul>
+    ''', shared=True),
+    PromptSection('buyer_persona', 'Ideal Buyer Persona', '''
+      <div class="subsection">
+        <h3>Demographic Profile</h3>
+        <ul>
+          <li><strong>Age:</strong> Specific age range</li>
+          <li><strong>Income:</strong> Household income range</li>
+          <li><strong>Occupation:</strong> Common professional backgrounds</li>
+          <li><strong>Family Status:</strong> Family composition and lifestyle stage</li>
+        </ul>
+      </div>
+      <div class="subsection">
+        <h3>Psychographic Profile</h3>
+        <ul>
+          <li><strong>Values:</strong> What buyers prioritize in this area</li>
+          <li><strong>Lifestyle:</strong> Preferred activities and living style</li>
+          <li><strong>Interests:</strong> Common hobbies and interests</li>
+          <li><strong>Pain Points:</strong><ul><li>Common concerns or deal-breakers</li><li>Market challenges they face</li></ul></li>
+          <li><strong>Motivations:</strong><ul><li>Primary reasons for moving to this area</li><li>Investment or lifestyle goals</li></ul></li>
+        </ul>
+      </div>
+    ''', shared=True),
+    PromptSection('market_snapshot', 'Market Snapshot', (
+        _listing_table('Active Listings', 'active listings')
+        + _listing_table('Pending Sales', 'pending listings')
+        + _listing_table('Recently Sold', 'sold listings')
+        + '''
+      <p><strong>Average Days on Market:</strong> specific number</p>
+      <p><strong>Buyer Activity:</strong> Description of market temperature and buyer behavior</p>
+    '''), shared=True, time_sensitive=True),
+    PromptSection('pricing_strategy', 'Suggested Pricing Strategy', '''
+      <p><strong>Recommended List Price Range:</strong> $X,XXX,XXX - $X,XXX,XXX</p>
+      <p>This price reflects:</p>
+      <ul>
+        <li>Active and pending competition analysis</li>
+        <li>Recent sales performance in the area</li>
+        <li>Strategic positioning considerations</li>
+      </ul>
+      <p>Additional pricing considerations and market timing advice.</p>
+    ''', time_sensitive=True),
+    PromptSection('marketing_plan', '3-Week Marketing Plan', '''
+      <div class="marketing-timeline">
+        <div class="week">
+          <h4>Week 1 - Go-To-Market Foundation</h4>
+          <ul><li>Professional photography and staging</li><li>Digital listing preparation</li><li>MLS and portal listing launch</li><li>Agent outreach and pre-marketing</li></ul>
+        </div>
+        <div class="week">
+          <h4>Week 2 - Exposure & Engagement</h4>
+          <ul><li>Social media campaign launch</li><li>Video marketing and virtual tours</li><li>Email marketing to buyer database</li><li>Partner agent collaboration</li></ul>
+        </div>
+        <div class="week">
+          <h4>Week 3 - Conversion & Follow-Up</h4>
+          <ul><li>Open houses and private showings</li><li>Retargeting campaigns</li><li>Feedback analysis and strategy adjustment</li><li>Offer management and negotiation</li></ul>
+        </div>
+      </div>
+      <p><em>Disclaimer: Market activity and timing may vary. All campaigns are adjusted based on feedback, showings, and buyer behavior.</em></p>
+    '''),
+    PromptSection('market_report', 'Local Market Report', '''
+      <ul>
+        <li><strong>Inventory Level:</strong> X.X months (Market condition description)</li>
+        <li><strong>Buyer Pool:</strong> Description of buyer activity and motivations</li>
+        <li><strong>List-to-Sale Ratio:</strong> Percentage and market implications</li>
+        <li><strong>Demand:</strong> Current demand patterns and buyer preferences</li>
+      </ul>
+      <p>Market summary and outlook for the area.</p>
+    ''', shared=True, time_sensitive=True),
+    PromptSection('selling_timeline', 'Selling Timeline Overview', '''
+      <p>From preparation to closing:</p>
+      <ol>
+        <li><strong>Pre-Market Setup:</strong> Photography, staging recommendations, property prep</li>
+        <li><strong>Live on Market:</strong> Syndication + agent promotion</li>
+        <li><strong>Showings:</strong> Weekend and weekday showings with feedback</li>
+        <li><strong>Offers:</strong> Reviewed and negotiated</li>
+        <li><strong>Under Contract:</strong> Inspections, appraisal, and title</li>
+        <li><strong>Closing:</strong> Final walkthrough and celebration</li>
+      </ol>
+      <p>You'll receive clear expectations, weekly progress updates, and full transparency every step of the way.</p>
+    '''),
+)
+
+SECTION_KEYS = tuple(section.key for section in SECTIONS)
+SHARED_SECTION_KEYS = frozenset(section.key for section in SECTIONS if section.shared)
+TIME_SENSITIVE_SECTION_KEYS = frozenset(section.key for section in SECTIONS if section.time_sensitive)
+
+_INTRO = (
+    'Create a comprehensive, data-driven real estate listing presentation for the property at {address}. '
+    'Use real-time web search to gather current, accurate market information. '
+    'Respond with clean HTML only, using exactly the structure below. '
+    'No markdown, stars (*), hashes (#) or other special characters.'
+)
+
+_INSTRUCTIONS = (
+    'Rules:\n'
+    '1. Replace ALL template content with real, current, researched data about {address}: '
+    'real addresses, school names, local amenities, price ranges and market figures. No generic advice.\n'
+    '2. Keep every HTML tag, class and data attribute exactly as shown. Use <strong> for emphasis.\n'
+    '3. Listing tables (Address|Beds|Baths|Sqft|Price) may only contain real properties within a 1-3 mile radius, '
+    'one row per property. If none are found, set the table to style="display: none;" '
+    'and the matching .no-listings paragraph to style="display: block;".\n'
+    '4. Only include positive, factual information that was actually found through research.'
+)
+
+_SECTION_INTRO = (
+    'Write one section of a data-driven real estate listing presentation for the property at {address}. '
+    'Use real-time web search to gather current, accurate market information. '
+    'Respond with this single HTML block only, filled in. '
+    'No markdown, stars (*), hashes (#) or other special characters.'
+)
+
+_WHITESPACE_BETWEEN_TAGS_RE = re.compile(r'>\s+<')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def compact_html(html: str) -> str:
+    """Drop indentation and inter-tag whitespace to cut prompt tokens"""
+    html = _WHITESPACE_BETWEEN_TAGS_RE.sub('><', html.strip())
+    return _WHITESPACE_RE.sub(' ', html)
+
+
+def _compile_section(key: str, title: str, body: str) -> str:
+    """Compact a section into a format string with {number} and {address} fields"""
+    # Literal braces in the HTML would be read as format fields
+    body = compact_html(body).replace('{', '{{').replace('}', '}}')
+    return (
+        f'<section class="analysis-section" data-section="{{number}}" data-section-key="{key}">'
+        f'<div class="section-header"><h2>{title}</h2></div>'
+        f'<div class="section-content">{body}</div>'
+        '</section>'
+    )
+
+
+_COMPILED_SECTIONS: Dict[str, str] = {
+    section.key: _compile_section(section.key, section.title, section.body)
+    for section in SECTIONS
+}
+_WELCOME_PREFIX = (
+    f'<section class="analysis-section" data-section="1" data-section-key="{WELCOME_SECTION_KEY}">'
+    '<div class="section-header"><h2>👋 Welcome</h2></div>'
+    '<div class="section-content">'
+)
+_WELCOME_SUFFIX = '</div></section>'
+
+
+def render_sections(address: str, keys: Optional[List[str]] = None, first_number: int = 1) -> str:
+    """
+    Render the HTML skeleton for some or all sections
+
+    Args:
+        address: Property address
+        keys: Section keys to include, in registry order (all when None)
+        first_number: ``data-section`` number of the first rendered section
+
+    Returns:
+        Compacted HTML for the selected sections
+    """
+    selected = [key for key in SECTION_KEYS if keys is None or key in keys]
+    return ''.join(
+        _COMPILED_SECTIONS[key].format(number=first_number + index, address=address)
+        for index, key in enumerate(selected)
+    )
+
+
+@lru_cache(maxsize=256)
+def _render_body(address: str, first_number: int) -> str:
+    return (
+        _INTRO.format(address=address)
+        + '\n<div class="property-analysis">'
+        + '{welcome}'
+        + render_sections(address, first_number=first_number)
+        + '</div>\n'
+        + _INSTRUCTIONS.format(address=address)
+    )
+
+
+def render_analysis_prompt(address: str, agent_description: str = '', reserve_welcome: bool = False) -> str:
+    """
+    Render the full analysis prompt for an address
+
+    Args:
+        address: Property address
+        agent_description: Agent welcome HTML; adds a Welcome section when set
+        reserve_welcome: Leave the Welcome section out but number the other
+            sections from 2, so it can be spliced in afterwards with
+            ``insert_welcome_section``. The prompt then only depends on the
+            address and is shared by every agent.
+
+    Returns:
+        The prompt to send as the user message
+    """
+    address = address.strip()
+    if reserve_welcome:
+        return _render_body(address, 2).replace('{welcome}', '', 1)
+    if not agent_description:
+        return _render_body(address, 1).replace('{welcome}', '', 1)
+    return _render_body(address, 2).replace('{welcome}', render_welcome_section(agent_description), 1)
+
+
+def render_welcome_section(agent_description: str) -> str:
+    """The agent Welcome section, always ``data-section="1"``"""
+    return _WELCOME_PREFIX + agent_description.strip() + _WELCOME_SUFFIX
+
+
+_ANALYSIS_OPENING_RE = re.compile(r'<div[^>]*class="property-analysis"[^>]*>')
+_SECTION_NUMBER_RE = re.compile(r'(<section[^>]*?data-section=")(\d+)(")')
+
+
+def insert_welcome_section(content: str, agent_description: str) -> str:
+    """
+    Splice the Welcome section into a report generated with ``reserve_welcome``
+
+    Without a description the sections are renumbered from 1 instead, so the
+    report looks like one generated without a Welcome section.
+    """
+    if not agent_description:
+        return _SECTION_NUMBER_RE.sub(
+            lambda match: f'{match.group(1)}{max(1, int(match.group(2)) - 1)}{match.group(3)}',
+            content,
+        )
+
+    welcome = render_welcome_section(agent_description)
+    match = _ANALYSIS_OPENING_RE.search(content)
+    if match:
+        position = match.end()
+    else:
+        position = max(content.find('<section'), 0)
+    return content[:position] + welcome + content[position:]
+
+
+def build_messages(address: str, agent_description: str = '', reserve_welcome: bool = False) -> List[Dict]:
+    """Chat messages for an analysis of ``address``"""
+    return [{'role': 'user', 'content': render_analysis_prompt(address, agent_description, reserve_welcome)}]
+
+
+@lru_cache(maxsize=1024)
+def render_section_prompt(address: str, key: str, number: int) -> str:
+    """
+    Render the prompt for a single section, used by the fan-out generator
+
+    Args:
+        address: Property address
+        key: Section key from ``SECTION_KEYS``
+        number: ``data-section`` number the section gets in the full report
+
+    Returns:
+        A prompt asking for just that ``<section>`` block
+    """
+    address = address.strip()
+    return (
+        _SECTION_INTRO.format(address=address)
+        + '\n'
+        + _COMPILED_SECTIONS[key].format(number=number, address=address)
+        + '\n'
+        + _INSTRUCTIONS.format(address=address)
+    )
+
+
+def build_section_messages(address: str, key: str, number: int) -> List[Dict]:
+    """Chat messages for one section of an analysis of ``address``"""
+    return [{'role': 'user', 'content': render_section_prompt(address, key, number)}]
+
+
+_SECTION_BLOCK_RE = re.compile(
+    r'<section[^>]*data-section-key="(?P<key>[a-z_]+)"[^>]*>.*?</section>(?=\s*(?:<section|</div>|$))',
+    re.DOTALL,
+)
+
+
+def split_sections(content: str) -> Dict[str, str]:
+    """Section blocks of a generated report by ``data-section-key``, for the keys found"""
+    return {match.group('key'): match.group(0) for match in _SECTION_BLOCK_RE.finditer(content)}
+
+
+def extract_section(content: str, key: str, number: int, address: str) -> str:
+    """
+    Pull the ``<section>`` block for ``key`` out of a per-section completion
+
+    Models sometimes add prose around the block or drop the attributes, so the
+    block is located leniently and its numbering is fixed up to match the
+    position in the assembled report.
+    """
+    content = content.strip()
+    start = content.find('<section')
+    end = content.rfind('</section>')
+    if start == -1 or end == -1:
+        # No section wrapper at all: wrap the returned HTML in the expected one
+        section = next(section for section in SECTIONS if section.key == key)
+        opening = (
+            f'<section class="analysis-section" data-section="{number}" data-section-key="{key}">'
+            f'<div class="section-header"><h2>{section.title.format(address=address.strip())}</h2></div>'
+            '<div class="section-content">'
+        )
+        return opening + content + '</div></section>'
+
+    block = content[start:end + len('</section>')]
+    opening_end = block.find('>') + 1
+    opening = f'<section class="analysis-section" data-section="{number}" data-section-key="{key}">'
+    return opening + block[opening_end:]
@@ -0,0 +1,131 @@
+"""
+Incremental refresh of saved analyses.
+
+Listings, pricing and market figures in a report go out of date within
+weeks while the neighborhood, buyer persona and Welcome sections do not.
+Refreshing regenerates only the time-sensitive sections (one upstream call
+each, run concurrently) and splices them into ``analysis_content`` in
+place, keeping the rest of the report, including any edits, as it was.
+"""
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Iterable, List, NamedTuple, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .address_research import load_research, store_research
+from .analysis_generator import _generate_section, _reused_section, _with_content
+from .analysis_prompts import SECTION_KEYS, SHARED_SECTION_KEYS, TIME_SENSITIVE_SECTION_KEYS, split_sections
+from .html_normalizer import normalize_analysis_html
+from .models import PropertyAnalysis
+from .perplexity_service import PerplexityError
+from .response_cache import MISS, STALE
+
+logger = logging.getLogger(__name__)
+
+_SECTION_NUMBER_RE = re.compile(r'data-section="(\d+)"')
+
+
+class RefreshResult(NamedTuple):
+    analysis: PropertyAnalysis
+    refreshed: List[str]  # Regenerated or taken from newer address research
+    reused: List[str]  # The subset of ``refreshed`` taken from address research
+    failed: List[str]
+    elapsed_ms: float
+
+
+def refresh_analysis(analysis: PropertyAnalysis, keys: Optional[Iterable[str]] = None,
+                     use_cache: bool = True) -> RefreshResult:
+    """
+    Regenerate some sections of a saved analysis and save it
+
+    Sections the report does not contain (analyses from the old client-side
+    prompt have no section keys) are skipped. Shared sections are taken from
+    address research generated after the analysis was last refreshed, when
+    there is some. ``refreshed_at`` is only set when every section succeeded,
+    so failed sections are retried by the next scheduled run.
+
+    Args:
+        analysis: Analysis to refresh
+        keys: Section keys to regenerate (the time-sensitive ones when None)
+        use_cache: Read and write the response cache and shared address research
+
+    Returns:
+        RefreshResult; sections that succeeded are saved even if others failed
+    """
+    keys = TIME_SENSITIVE_SECTION_KEYS if keys is None else set(keys)
+    content = analysis.analysis_content or ''
+    blocks = split_sections(content)
+    targets = [(key, _section_number(blocks[key])) for key in SECTION_KEYS if key in keys and key in blocks]
+    if not targets:
+        return RefreshResult(analysis, [], [], [], 0.0)
+
+    address = analysis.address
+    model = analysis.analysis_model or 'sonar'
+    started = time.monotonic()
+
+    research = {}
+    if use_cache:
+        since = analysis.refreshed_at or analysis.created_at
+        stored = load_research(address, model, [key for key, _number in targets])
+        for key, number in targets:
+            if key not in stored or stored[key].generated_at <= since:
+                continue
+            # Research harvested from this very report is no refresh
+            section = _reused_section(stored[key], address, key, number)
+            if section.html != blocks[key]:
+                research[key] = section
+    to_generate = [(key, number) for key, number in targets if key not in research]
+
+    workers = max(1, min(settings.ANALYSIS_SECTION_CONCURRENCY, len(to_generate) or 1))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-refresh') as executor:
+        futures = {
+            key: executor.submit(copy_context().run, _generate_section, address, key, number, model, use_cache)
+            for key, number in to_generate
+        }
+        refreshed, reused, failed = [], [], []
+        for key, number in targets:
+            if key in research:
+                section = research[key]
+                reused.append(key)
+            else:
+                try:
+                    section = futures[key].result()
+                except PerplexityError as e:
+                    logger.warning(f"Refreshing section {key} of analysis {analysis.id} failed: {str(e)}")
+                    failed.append(key)
+                    continue
+                if section.cache_status == STALE:
+                    # The upstream failed and the cache served what we are replacing
+                    failed.append(key)
+                    continue
+                if use_cache and key in SHARED_SECTION_KEYS and section.cache_status == MISS:
+                    store_research(address, model, {key: section.html}, section.data.get('citations'))
+            content = content.replace(blocks[key], normalize_analysis_html(section.html), 1)
+            refreshed.append(key)
+
+    update_fields = ['updated_at']
+    if refreshed:
+        analysis.analysis_content = content
+        if isinstance(analysis.api_response, dict) and analysis.api_response.get('choices'):
+            analysis.api_response = _with_content(analysis.api_response, content)
+        update_fields += ['analysis_content', 'api_response']
+    if not failed:
+        analysis.refreshed_at = timezone.now()
+        update_fields.append('refreshed_at')
+    if len(update_fields) > 1:
+        analysis.save(update_fields=update_fields)
+
+    elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+    logger.info(f"Refreshed {len(refreshed)} sections of analysis {analysis.id} in {elapsed_ms:.0f}ms "
+                f"({len(reused)} from address research, {len(failed)} failed)")
+    return RefreshResult(analysis, refreshed, reused, failed, elapsed_ms)
+
+
+def _section_number(block: str) -> int:
+    match = _SECTION_NUMBER_RE.search(block)
+    return int(match.group(1)) if match else 1
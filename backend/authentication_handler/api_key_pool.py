@@ -0,0 +1,122 @@
+"""
+Pool of API keys for one upstream.
+
+Each call checks out the least-loaded key, preferring the one throttled
+longest ago. A key answered with 429 is taken out of rotation for the
+``Retry-After`` delay (or an exponential backoff when there is none) while
+the other keys keep serving, so throughput grows with the number of keys.
+Like the limiter, the pool state is per process.
+"""
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def parse_keys(value: str) -> List[str]:
+    """Comma-separated keys, without blanks or duplicates, in order"""
+    keys = []
+    for key in value.split(','):
+        key = key.strip()
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+
+def mask_key(key: str) -> str:
+    """Loggable form of a key"""
+    return f'...{key[-4:]}' if len(key) > 8 else '...'
+
+
+class ApiKey:
+    """One key and its request counters"""
+
+    def __init__(self, value: str):
+        self.value = value
+        self.label = mask_key(value)
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.consecutive_throttles = 0
+        self.cooldown_until = 0.0
+        self.last_throttled_at = 0.0
+
+
+class ApiKeyPool:
+    """Spread upstream calls over several API keys"""
+
+    def __init__(self, name: str, keys: List[str], base_backoff: float, max_backoff: float):
+        if not keys:
+            raise ValueError(f"{name} key pool needs at least one key")
+        self.name = name
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._keys = [ApiKey(key) for key in keys]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def checkout(self) -> ApiKey:
+        """
+        Key for the next call: the least loaded one not cooling down
+
+        When every key is cooling down the one that comes back first is
+        used; the limiter holds calls back until then (see ``available_in``).
+        """
+        with self._lock:
+            now = time.monotonic()
+            ready = [key for key in self._keys if key.cooldown_until <= now]
+            if ready:
+                key = min(ready, key=lambda k: (k.in_flight, k.last_throttled_at))
+            else:
+                key = min(self._keys, key=lambda k: k.cooldown_until)
+            key.in_flight += 1
+            key.requests += 1
+            return key
+
+    def release(self, key: ApiKey, throttled: bool = False, retry_after: Optional[float] = None):
+        """
+        Return a key after its call
+
+        Args:
+            key: Key from ``checkout``
+            throttled: The upstream answered 429
+            retry_after: Parsed Retry-After of that 429, if any
+        """
+        with self._lock:
+            key.in_flight -= 1
+            if not throttled:
+                key.consecutive_throttles = 0
+                return
+            now = time.monotonic()
+            key.throttled += 1
+            key.consecutive_throttles += 1
+            key.last_throttled_at = now
+            if retry_after is None:
+                retry_after = self.base_backoff * (2 ** (key.consecutive_throttles - 1))
+            delay = min(retry_after, self.max_backoff)
+            key.cooldown_until = max(key.cooldown_until, now + delay)
+        logger.warning(f"{self.name} key {key.label} throttled, out of rotation for {delay:.1f}s")
+
+    def available_in(self) -> float:
+        """Seconds until some key is out of its cooldown, 0 if one already is"""
+        with self._lock:
+            now = time.monotonic()
+            return max(0.0, min(key.cooldown_until for key in self._keys) - now)
+
+    def get_stats(self) -> List[Dict]:
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    'key': key.label,
+                    'in_flight': key.in_flight,
+                    'requests': key.requests,
+                    'throttled': key.throttled,
+                    'cooldown_remaining_s': round(max(0.0, key.cooldown_until - now), 2),
+                }
+                for key in self._keys
+            ]
@@ -0,0 +1,478 @@
+"""
+Async versions of the I/O-bound views for the ASGI deployment mode.
+
+These are routed in place of their sync counterparts when
+``settings.ASYNC_UPSTREAM_VIEWS`` is on (``SERVER_MODE=asgi``). Upstream calls
+use the non-blocking httpx pool from ``upstream_client``, so a single uvicorn
+process can hold many slow LLM calls in flight. DRF function views are sync
+only, so authentication and request parsing are done by hand here and the
+JSON error shapes mirror the DRF versions in ``views.py``.
+"""
+import json
+import logging
+import math
+import os
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .deadline import DeadlineExceeded, expired
+from .generation_results import store_result
+from .model_router import choose_model, record_model_call
+from .models import AgentProfile, StreamedGeneration
+from .notion_utils import build_headers, build_page_payload
+from .perplexity_service import PerplexityError, budget_error, busy_error, deadline_error, get_api_headers
+from .perplexity_stream import astream_completion, format_sse
+from .priority import set_package
+from .response_cache import BYPASS, HIT, MISS, STALE, make_cache_key, perplexity_cache
+from .resumable_stream import atail_generation, start_generation
+from .single_flight import COALESCED, perplexity_flights
+from .upstream_client import NOTION, NOTION_PAGES_URL, PERPLEXITY, PERPLEXITY_CHAT_URL, get_client
+from .upstream_limiter import UpstreamBusy, current_client_key
+from .usage import BudgetExceeded, aapply_budget, arecord_usage
+
+logger = logging.getLogger(__name__)
+
+
+def _authenticate(request):
+    """
+    Authenticate a JWT bearer token the same way DRF does
+
+    Like DRF, the result is also set as ``request.user`` (replacing the lazy
+    session user, which cannot be evaluated from async code).
+
+    Returns:
+        (user, error_response) - user is None when no valid token was sent
+    """
+    request.user = AnonymousUser()
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed as e:
+        detail = e.detail.get('detail', '') if isinstance(e.detail, dict) else e.detail
+        return None, JsonResponse({'detail': str(detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if result is None:
+        return None, None
+    request.user = result[0]
+    return result[0], None
+
+
+def _read_json(request):
+    """Decode a JSON request body, returning None when it is missing or invalid"""
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+
+
+def _perplexity_response(data, cache_status, status_code=status.HTTP_200_OK):
+    response = JsonResponse(data, status=status_code)
+    response['X-Cache'] = cache_status
+    return response
+
+
+def _event_stream_response(events, cache_status=None):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    if cache_status is not None:
+        response['X-Cache'] = cache_status
+    return response
+
+
+def _with_route(response, route):
+    response['X-Model-Route'] = f'{route.model}; {route.reason}'
+    return response
+
+
+async def _single_event(event):
+    yield event
+
+
+@csrf_exempt
+async def perplexity_proxy(request):
+    """Async Perplexity proxy with the same cache and streaming behaviour as the sync view"""
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+
+    try:
+        headers = get_api_headers()
+    except PerplexityError as e:
+        return JsonResponse(e.payload, status=e.status_code)
+
+    data = _read_json(request)
+    if not data:
+        return JsonResponse({'error': 'No data provided in the request.'}, status=status.HTTP_400_BAD_REQUEST)
+    messages = data.get('messages')
+    if not messages:
+        return JsonResponse({'error': 'Field "messages" is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    route = choose_model(data.get('package_name'), data.get('model'))
+    try:
+        route = await aapply_budget(route)
+    except BudgetExceeded as e:
+        error = budget_error(e)
+        response = JsonResponse(error.payload, status=error.status_code)
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+        return response
+    set_package(data.get('package_name'))
+    model = route.model
+
+    payload = {
+        'model': model,
+        'messages': messages
+    }
+
+    use_cache = settings.PERPLEXITY_CACHE_ENABLED and data.get('cache', True) is not False
+    cache_key = make_cache_key(model, messages)
+    stream = data.get('stream') is True
+    package_name = data.get('package_name') or ''
+
+    if use_cache:
+        cached = await sync_to_async(perplexity_cache.get)(cache_key)
+        if cached is not None:
+            # Kept server-side so the client can save it by token, as for a miss
+            token = await sync_to_async(store_result)(user, cached, model, route.reason, package_name=package_name)
+            if stream:
+                if token:
+                    cached = dict(cached, result_token=token)
+                return _with_route(_event_stream_response(_single_event(format_sse(cached, event='done')), HIT), route)
+            response = _with_route(_perplexity_response(cached, HIT), route)
+            if token:
+                response['X-Result-Token'] = token
+            return response
+
+    if stream:
+        def on_complete(completion):
+            # The cached copy stays token-free; the token only goes to this client
+            if use_cache:
+                perplexity_cache.set(cache_key, model, completion)
+            token = store_result(user, completion, model, route.reason, package_name=package_name)
+            return {'result_token': token} if token else None
+
+        if settings.STREAM_RESUME_ENABLED and user is not None:
+            generation = await sync_to_async(start_generation)(headers, payload, user=user, on_complete=on_complete)
+            return _with_route(_event_stream_response(
+                atail_generation(generation.generation_id),
+                MISS if use_cache else BYPASS,
+            ), route)
+        return _with_route(_event_stream_response(
+            astream_completion(headers, payload, on_complete=on_complete, client_key=current_client_key()),
+            MISS if use_cache else BYPASS,
+        ), route)
+
+    try:
+        # Coalesces identical requests on this event loop; the cross-process
+        # lock used by the sync path would block the loop, so it is not taken here
+        if settings.PERPLEXITY_SINGLE_FLIGHT_ENABLED:
+            (result, cache_status), shared = await perplexity_flights.ado(
+                f'{cache_key}:{int(use_cache)}',
+                lambda: _fetch_completion(headers, payload, cache_key, use_cache),
+            )
+            if shared and cache_status in (MISS, BYPASS):
+                cache_status = COALESCED
+        else:
+            result, cache_status = await _fetch_completion(headers, payload, cache_key, use_cache)
+    except PerplexityError as e:
+        response = JsonResponse(e.payload, status=e.status_code)
+        if e.retry_after is not None:
+            response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+    response = _with_route(_perplexity_response(result, cache_status), route)
+    token = await sync_to_async(store_result)(user, result, model, route.reason, package_name=package_name)
+    if token:
+        response['X-Result-Token'] = token
+    return response
+
+
+@csrf_exempt
+async def resume_generation(request, generation_id):
+    """Async version of resume_generation"""
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+
+    try:
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Parameter "offset" must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    if offset < 0:
+        return JsonResponse({'error': 'Parameter "offset" must not be negative.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    generation = await StreamedGeneration.objects.filter(generation_id=generation_id).afirst()
+    if generation is None or user is None or generation.user_id != user.id:
+        return JsonResponse({'error': 'Generation not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    return _event_stream_response(atail_generation(generation.generation_id, offset))
+
+
+@csrf_exempt
+async def wait_analysis_job(request, job_id):
+    """Async version of wait_analysis_job: long-polls until the job finishes or the timeout passes"""
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    from .jobs import await_job, serialize_job
+
+    try:
+        timeout = float(request.GET.get('timeout', settings.ANALYSIS_JOB_LONG_POLL_MAX))
+    except ValueError:
+        return JsonResponse({'error': 'Timeout must be a number of seconds.'}, status=status.HTTP_400_BAD_REQUEST)
+    timeout = max(0.0, min(timeout, settings.ANALYSIS_JOB_LONG_POLL_MAX))
+
+    job = await await_job(job_id, user, timeout)
+    if job is None:
+        return JsonResponse({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return JsonResponse(await sync_to_async(serialize_job)(job), status=status.HTTP_200_OK)
+
+
+async def _fetch_completion(headers, payload, cache_key, use_cache):
+    """
+    Call Perplexity without blocking the event loop
+
+    Returns:
+        (completion, cache_status)
+
+    Raises:
+        PerplexityError: With the same payloads as the sync proxy
+    """
+    started = time.monotonic()
+    try:
+        resp = await get_client(PERPLEXITY).apost(PERPLEXITY_CHAT_URL, headers=headers, json=payload, hedge=True)
+    except UpstreamBusy as e:
+        if use_cache:
+            stale = await sync_to_async(perplexity_cache.get_stale)(cache_key)
+            if stale is not None:
+                return stale, STALE
+        raise busy_error(e)
+    except DeadlineExceeded:
+        if use_cache:
+            stale = await sync_to_async(perplexity_cache.get_stale)(cache_key)
+            if stale is not None:
+                return stale, STALE
+        raise deadline_error()
+    except httpx.HTTPError as e:
+        record_model_call(payload['model'], started, failed=True)
+        if use_cache:
+            stale = await sync_to_async(perplexity_cache.get_stale)(cache_key)
+            if stale is not None:
+                return stale, STALE
+        if expired():
+            raise deadline_error()
+        raise PerplexityError({'error': f'Error occurred during the API call: {str(e)}'})
+
+    record_model_call(payload['model'], started, failed=resp.status_code == 429 or resp.status_code >= 500)
+    if resp.status_code != 200:
+        if use_cache and (resp.status_code == 429 or resp.status_code >= 500):
+            stale = await sync_to_async(perplexity_cache.get_stale)(cache_key)
+            if stale is not None:
+                return stale, STALE
+        try:
+            error_data = resp.json()
+        except ValueError:
+            error_data = {'details': resp.text}
+        raise PerplexityError({'error': 'Failed to get a valid response from Perplexity API', **error_data},
+                              status_code=resp.status_code)
+    try:
+        result = resp.json()
+    except ValueError:
+        raise PerplexityError({'error': 'Perplexity API did not return JSON data', 'content': resp.text},
+                              status_code=resp.status_code)
+    await arecord_usage(payload['model'], result.get('usage'))
+    if use_cache and result.get('choices'):
+        await sync_to_async(perplexity_cache.set)(cache_key, payload['model'], result)
+    return result, MISS if use_cache else BYPASS
+
+
+@csrf_exempt
+async def generate_property_analysis(request):
+    """
+    Async version of generate_property_analysis
+
+    The generator fans sections out to its own thread pool and reads the
+    research and cache tables as it goes, so it runs in a worker thread of
+    its own instead of the single thread-sensitive executor that every other
+    sync call of this process queues on.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    from .analysis_generator import generate_analysis, parse_generation_options
+
+    data = _read_json(request) or {}
+    address = (data.get('address') or '').strip()
+    if not address:
+        return JsonResponse({'error': 'Address is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    package_name = data.get('package_name', 'Professional')
+    try:
+        options = parse_generation_options(data.get('options'))
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    route = choose_model(package_name, options.get('model'))
+    set_package(package_name)
+
+    def generate(model):
+        try:
+            return generate_analysis(
+                user,
+                address,
+                model=model,
+                include_agent_description=options.get('include_agent_description', True) is not False,
+                use_cache=settings.PERPLEXITY_CACHE_ENABLED and options.get('cache', True) is not False,
+                mode=options.get('mode'),
+            )
+        finally:
+            connection.close()
+
+    try:
+        route = await aapply_budget(route)
+        result = await sync_to_async(generate, thread_sensitive=False)(route.model)
+    except BudgetExceeded as e:
+        error = budget_error(e)
+        response = JsonResponse(error.payload, status=error.status_code)
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+        return response
+    except PerplexityError as e:
+        response = JsonResponse(e.payload, status=e.status_code)
+        if e.retry_after is not None:
+            response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+
+    # Same shape as the proxy response, plus what the client needs to save it
+    data = dict(
+        result.data,
+        agent_description=result.agent_description,
+        prompt_version=result.prompt_version,
+        package_name=package_name,
+        model_route=route.as_dict(),
+    )
+    data['result_token'] = await sync_to_async(store_result)(
+        user, data, route.model, route.reason,
+        address=address,
+        package_name=package_name,
+        prompt_version=result.prompt_version,
+        agent_description=result.agent_description,
+    )
+    return _with_route(_perplexity_response(data, result.cache_status), route)
+
+
+@csrf_exempt
+async def notion_format(request):
+    """Async version of notion_format"""
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    _user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+
+    api_key = os.getenv('NOTION_API_KEY')
+    if not api_key:
+        return JsonResponse({'error': 'Notion API key not configured.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    data = _read_json(request) or {}
+    perplexity_data = data.get('perplexity_data')
+    if not perplexity_data:
+        return JsonResponse({'error': 'No Perplexity data provided.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    database_id = os.getenv('NOTION_DATABASE_ID')
+    if not database_id:
+        return JsonResponse({'error': 'Notion database ID not configured.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    try:
+        resp = await get_client(NOTION).apost(
+            NOTION_PAGES_URL,
+            headers=build_headers(api_key),
+            json=build_page_payload(perplexity_data, database_id),
+        )
+        if resp.status_code != 200:
+            try:
+                error_data = resp.json()
+            except ValueError:
+                error_data = {'details': resp.text}
+            return JsonResponse({'error': 'Failed to create Notion page', **error_data}, status=resp.status_code)
+        try:
+            result = resp.json()
+        except ValueError:
+            return JsonResponse({'error': 'Notion API did not return JSON data', 'content': resp.text}, status=resp.status_code)
+        return JsonResponse(result, status=resp.status_code)
+    except UpstreamBusy as e:
+        response = JsonResponse({'error': str(e), 'retry_after': round(e.retry_after, 1)},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+    except DeadlineExceeded:
+        return JsonResponse({'error': 'Notion did not answer in time. Please try again.'}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+    except httpx.HTTPError as e:
+        if expired():
+            return JsonResponse({'error': 'Notion did not answer in time. Please try again.'}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        return JsonResponse({'error': f'Error occurred during the API call: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@csrf_exempt
+async def generate_agent_description(request):
+    """Async version of generate_agent_description"""
+    if request.method != 'POST':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    user, auth_error = await sync_to_async(_authenticate)(request)
+    if auth_error is not None:
+        return auth_error
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+    from .agent_description_generator import aget_cached_agent_description
+
+    try:
+        try:
+            agent_profile = await AgentProfile.objects.select_related('user').aget(user=user)
+        except AgentProfile.DoesNotExist:
+            return JsonResponse({'error': 'Agent profile not found. Please complete your profile first.'},
+                                status=status.HTTP_404_NOT_FOUND)
+
+        # Served from the stored description unless the profile changed
+        regenerate = (_read_json(request) or {}).get('regenerate') is True
+        description = await aget_cached_agent_description(agent_profile, regenerate=regenerate)
+
+        if not description:
+            return JsonResponse({'error': 'Failed to generate agent description. Please try again.'},
+                                status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        return JsonResponse({
+            'agent_description': description,
+            'message': 'Agent description generated successfully'
+        }, status=status.HTTP_200_OK)
+
+    except Exception as e:
+        logger.error(f"Error generating agent description: {str(e)}")
+        return JsonResponse({'error': f'Error generating agent description: {str(e)}'},
+                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
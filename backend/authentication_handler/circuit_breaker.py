@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+from .upstream_limiter import UpstreamBusy
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(UpstreamBusy):
+    """The upstream is considered down and calls are failing fast"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(
+            name,
+            retry_after,
+            message=f'{name} is temporarily unavailable, please retry in {int(retry_after) or 1} seconds.',
+        )
+
+
+class CircuitBreaker:
+    """
+    Fail fast while an upstream is erroring or too slow
+
+    Outcomes of the last ``window`` seconds are kept. Once at least
+    ``min_calls`` were made and the share of failed or slow calls reaches
+    ``failure_rate``, the circuit opens and calls are rejected for
+    ``open_seconds``. It then lets ``half_open_calls`` probe calls through:
+    a successful probe closes the circuit, a failed one opens it again.
+    """
+
+    def __init__(self, name: str, failure_rate: float, slow_call_seconds: float, min_calls: int,
+                 window: float, open_seconds: float, half_open_calls: int = 1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._half_opened_at = 0.0
+        self._probes = 0
+        self._outcomes = deque()  # (monotonic time, failed)
+        self._stats = {'rejected': 0, 'opened': 0}
+
+    def allow_request(self):
+        """
+        Check whether a call may go out now
+
+        Raises:
+            CircuitOpen: While the circuit is open
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == OPEN:
+                remaining = self._opened_at + self.open_seconds - now
+                if remaining > 0:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpen(self.name, remaining)
+                self._state = HALF_OPEN
+                self._half_opened_at = now
+                self._probes = 0
+                logger.info(f"{self.name} circuit half-open, probing upstream")
+
+            if self._state == HALF_OPEN:
+                # A probe that never reported back (e.g. cancelled) must not
+                # keep the circuit half-open forever
+                if self._probes >= self.half_open_calls and now - self._half_opened_at < self.open_seconds:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpen(self.name, 1.0)
+                if self._probes >= self.half_open_calls:
+                    self._probes = 0
+                    self._half_opened_at = now
+                self._probes += 1
+
+    def record(self, failed: bool, latency: float = 0.0):
+        """
+        Feed the outcome of a call into the breaker
+
+        Args:
+            failed: The call raised or the upstream answered 5xx
+            latency: Seconds the call took; calls over ``slow_call_seconds`` count as failed
+        """
+        failed = failed or latency > self.slow_call_seconds
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if failed:
+                    self._open(now)
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"{self.name} circuit closed")
+                return
+
+            self._outcomes.append((now, failed))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+
+            if self._state == CLOSED and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for _at, was_failed in self._outcomes if was_failed)
+                if failures / len(self._outcomes) >= self.failure_rate:
+                    self._open(now)
+
+    def _open(self, now: float):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._stats['opened'] += 1
+        logger.warning(f"{self.name} circuit opened for {self.open_seconds}s")
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            failures = sum(1 for _at, failed in self._outcomes if failed)
+            stats.update({
+                'state': self._state,
+                'window_calls': len(self._outcomes),
+                'window_failures': failures,
+                'open_remaining_s': round(max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 2)
+                if self._state == OPEN else 0.0,
+            })
+        return stats
@@ -0,0 +1,106 @@
+"""
+Per-request deadline budget.
+
+``RequestDeadlineMiddleware`` gives every request ``REQUEST_DEADLINE_SECONDS``
+when it arrives. Outbound calls (Perplexity, Notion, Stripe, SMTP) use the
+time left as their timeout, so a slow upstream ends the request with a 504
+before the worker timeout (gunicorn's ``--timeout 120``) kills the worker.
+The deadline lives in a context variable: threads started with
+``copy_context()`` inherit it, and background work that outlives the
+request clears it with ``clear_deadline``.
+"""
+import time
+from contextvars import ContextVar, Token
+from typing import Optional, Tuple, Union
+
+import stripe
+
+Timeout = Union[float, Tuple[float, float]]
+
+# Absolute time.monotonic() value, or None when there is no deadline
+_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before an outbound call could be made"""
+
+    def __init__(self, message: str = 'Request deadline exceeded'):
+        super().__init__(message)
+
+
+def set_deadline(seconds: Optional[float]) -> Token:
+    """Give the current context ``seconds`` from now; None or 0 removes the deadline"""
+    return _deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def set_deadline_at(deadline: Optional[float]) -> Token:
+    """Restore a deadline captured with ``get_deadline``"""
+    return _deadline.set(deadline)
+
+
+def reset_deadline(token: Token):
+    _deadline.reset(token)
+
+
+def clear_deadline():
+    """Remove the deadline for work that is meant to outlive the request"""
+    _deadline.set(None)
+
+
+def get_deadline() -> Optional[float]:
+    return _deadline.get()
+
+
+def remaining(deadline: Optional[float] = None) -> Optional[float]:
+    """Seconds left before the current (or given) deadline, None when there is none"""
+    if deadline is None:
+        deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def expired(deadline: Optional[float] = None) -> bool:
+    left = remaining(deadline)
+    return left is not None and left <= 0
+
+
+def within_deadline(seconds: float) -> float:
+    """
+    ``seconds`` capped to the time left
+
+    Raises:
+        DeadlineExceeded: If the deadline has already passed
+    """
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(seconds, left)
+
+
+def remaining_timeout(timeout: Timeout) -> Timeout:
+    """
+    Cap a timeout, either seconds or a (connect, read) tuple, to the time left
+
+    Raises:
+        DeadlineExceeded: If the deadline has already passed
+    """
+    if isinstance(timeout, tuple):
+        return tuple(within_deadline(part) for part in timeout)
+    return within_deadline(timeout)
+
+
+class DeadlineRequestsClient(stripe.RequestsClient):
+    """Stripe HTTP client whose timeout is capped to the calling request's deadline"""
+
+    @property
+    def _timeout(self) -> Timeout:
+        # Read on the calling thread for every request; DeadlineExceeded is
+        # turned into a stripe APIConnectionError by the client
+        return remaining_timeout(self._default_timeout)
+
+    @_timeout.setter
+    def _timeout(self, value: Timeout):
+        self._default_timeout = value
@@ -1,11 +1,17 @@
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.conf import settings
 import logging
 
+from .deadline import within_deadline
+
 logger = logging.getLogger(__name__)
 
+def _smtp_connection():
+    """SMTP connection that times out with the request's deadline"""
+    return get_connection(timeout=within_deadline(settings.EMAIL_TIMEOUT))
+
 def send_property_analysis_email(share_data):
     """
     Send property analysis email to recipient
@@ -134,7 +140,8 @@ def send_property_analysis_email(share_data):
             subject=subject,
             body=text_content,
             from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[recipient_email]
+            to=[recipient_email],
+            connection=_smtp_connection(),
         )
         
         email.attach_alternative(html_content, "text/html")
@@ -247,7 +254,8 @@ def send_welcome_email(user_email, user_name):
             subject=subject,
             body=text_content,
             from_email=settings.DEFAULT_FROM_EMAIL,
-            to=[user_email]
+            to=[user_email],
+            connection=_smtp_connection(),
         )
         
         email.attach_alternative(html_content, "text/html")
@@ -0,0 +1,82 @@
+"""
+Server-held generation results.
+
+Completions returned by the generate endpoint and the Perplexity proxy are
+kept for ``GENERATION_RESULT_TTL`` seconds under a random result token.
+``save_property_analysis`` then only needs the token (and any edits) rather
+than the whole completion and its HTML uploaded back.
+"""
+import logging
+import secrets
+from datetime import timedelta
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import GenerationResult
+from .perplexity_service import get_content
+
+logger = logging.getLogger(__name__)
+
+
+def store_result(user, data: Dict, model: str, route_reason: str = '', address: str = '',
+                 package_name: str = '', prompt_version: str = '',
+                 agent_description: str = '') -> Optional[str]:
+    """
+    Keep a completion for the user to save later (best effort)
+
+    Args:
+        user: Signed-in user the result belongs to; nothing is kept for
+            anonymous requests, which cannot save analyses
+        data: Completion returned to the client
+        model: Model that generated it
+        route_reason: Model router decision
+        address: Property address, when the endpoint knows it
+        package_name: Package it was generated for
+        prompt_version: Version of the server-side prompt template
+        agent_description: Welcome section generated alongside it
+
+    Returns:
+        The result token, or None if nothing was kept
+    """
+    if not settings.GENERATION_RESULTS_ENABLED or user is None or not user.is_authenticated:
+        return None
+    if not get_content(data):
+        return None
+    try:
+        result = GenerationResult.objects.create(
+            token=secrets.token_urlsafe(32),
+            user=user,
+            address=(address or '')[:500],
+            package_name=(package_name or '')[:100],
+            analysis_model=(data.get('model') or model or '')[:50],
+            model_route_reason=(route_reason or '')[:50],
+            prompt_version=(prompt_version or '')[:20],
+            agent_description=agent_description or '',
+            api_response=data,
+            expires_at=timezone.now() + timedelta(seconds=settings.GENERATION_RESULT_TTL),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to keep generation result: {str(e)}")
+        return None
+    return result.token
+
+
+def get_result(token: str, user, lock: bool = False) -> Optional[GenerationResult]:
+    """
+    The user's unexpired result for a token, or None
+
+    Args:
+        lock: Lock the row until the surrounding transaction ends
+    """
+    results = GenerationResult.objects.filter(token=token, user=user, expires_at__gt=timezone.now())
+    if lock:
+        results = results.select_for_update()
+    return results.first()
+
+
+def purge_results() -> int:
+    """Delete expired generation results"""
+    deleted, _ = GenerationResult.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
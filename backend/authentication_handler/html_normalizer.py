@@ -0,0 +1,245 @@
+"""
+One-time normalization of generated analysis HTML.
+
+The model is asked for clean HTML but still slips in markdown (``**bold**``,
+``### headings``, code fences), citation markers like ``[1][2]`` and the odd
+unsafe or unknown tag. ``normalize_analysis_html`` runs once when content is
+stored in ``PropertyAnalysis.analysis_content``:
+
+1. A reply with no HTML at all is converted from markdown as a whole; stray
+   inline markdown inside HTML text is converted to ``<strong>``/``<em>``.
+2. Citation markers are stripped.
+3. Tags and attributes are filtered against an allowlist (scripts, styles
+   and embeds are dropped with their content, unknown tags are unwrapped,
+   unclosed tags are closed, style attributes keep layout and text
+   formatting properties with plain values).
+4. Comments and insignificant whitespace are removed.
+
+Everything is done in one streaming pass of ``html.parser`` plus regexes
+without backtracking over text nodes, so time grows linearly with the
+document (see the ``benchmark_html_normalizer`` command). The output is
+stable: normalizing it again returns it unchanged.
+"""
+import html
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+import markdown
+from django.conf import settings
+
+# Allowed tags and the attributes each may keep
+_COMMON_ATTRS = frozenset({'class', 'style'})
+_ALLOWED_TAGS: Dict[str, frozenset] = {
+    **{tag: _COMMON_ATTRS for tag in (
+        'div', 'p', 'span', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'strong', 'em', 'b', 'i',
+        'u', 'br', 'hr', 'blockquote', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'caption', 'sup', 'sub',
+    )},
+    'section': _COMMON_ATTRS | {'data-section', 'data-section-key'},
+    'th': _COMMON_ATTRS | {'colspan', 'rowspan'},
+    'td': _COMMON_ATTRS | {'colspan', 'rowspan'},
+    'a': _COMMON_ATTRS | {'href', 'title'},
+}
+# Dropped together with everything inside them
+_DROPPED_TAGS = frozenset({
+    'script', 'style', 'iframe', 'object', 'embed', 'noscript', 'template', 'head', 'title', 'svg', 'math',
+    'form', 'textarea', 'select', 'button',
+})
+_VOID_TAGS = frozenset({'br', 'hr'})
+# Whitespace next to these never renders, so it is removed
+_BLOCK_TAGS = frozenset({
+    'section', 'div', 'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'li', 'br', 'hr', 'blockquote',
+    'table', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td', 'caption',
+})
+# Removed when nothing is left inside them (e.g. a <sup> that held a citation)
+_DROPPED_WHEN_EMPTY = frozenset({'span', 'strong', 'em', 'b', 'i', 'u', 'sup', 'sub', 'a'})
+
+# Layout properties the templates use and the text formatting users set in the
+# editor (colors, fonts, indentation) survive in style attributes
+_ALLOWED_STYLES = frozenset({
+    'display', 'text-align', 'font-weight', 'font-style', 'color', 'background-color', 'text-decoration',
+    'font-size', 'font-family', 'line-height', 'text-indent', 'margin-left', 'padding-left',
+    'vertical-align', 'list-style-type',
+})
+# Keywords, lengths, hex colors and quoted font names; the only functions let
+# through are color ones, so url(), expression() and escapes are rejected
+_STYLE_VALUE_RE = re.compile(r'^[#a-z0-9 \-.,%()\'"]+$')
+_STYLE_FUNCTION_RE = re.compile(r'([a-z\-]*)\(')
+_STYLE_FUNCTIONS = frozenset({'rgb', 'rgba', 'hsl', 'hsla'})
+_ATTR_VALUE_RES = {
+    'data-section': re.compile(r'^\d+$'),
+    'data-section-key': re.compile(r'^[a-z_]+$'),
+    'colspan': re.compile(r'^\d{1,3}$'),
+    'rowspan': re.compile(r'^\d{1,3}$'),
+}
+_SAFE_HREF_RE = re.compile(r'^(?:https?:|mailto:|tel:|#|/)', re.IGNORECASE)
+
+_HTML_TAG_RE = re.compile(r'<[a-zA-Z][^>]*>')
+_CODE_FENCE_START_RE = re.compile(r'^\s*```[\w-]*[ \t]*\n?')
+_CODE_FENCE_END_RE = re.compile(r'\n?[ \t]*```\s*$')
+
+_CITATION_RE = re.compile(r'[ \t]*\[\d{1,3}(?:[\s,\-–]+\d{1,3})*\]')
+_MD_HEADING_RE = re.compile(r'(^|\n)[ \t]*#{1,6}[ \t]+')
+_MD_BOLD_RE = re.compile(r'\*\*([^*<>\n]+)\*\*|__([^_<>\n]+)__')
+_MD_ITALIC_RE = re.compile(r'(?<![\w*])\*(?![\s*])([^*<>\n]+?)(?<!\s)\*(?![\w*])')
+_MD_CODE_RE = re.compile(r'`([^`<>\n]+)`')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def _clean_text(text: str) -> str:
+    """Escape a text node, then strip citations and convert inline markdown"""
+    text = _CITATION_RE.sub('', html.escape(text, quote=False))
+    text = _MD_HEADING_RE.sub(r'\1', text)
+    text = _MD_BOLD_RE.sub(lambda match: f'<strong>{match.group(1) or match.group(2)}</strong>', text)
+    text = _MD_ITALIC_RE.sub(r'<em>\1</em>', text)
+    return _MD_CODE_RE.sub(r'\1', text)
+
+
+def _clean_style(value: str) -> str:
+    declarations = []
+    for declaration in value.split(';'):
+        name, _, style_value = declaration.partition(':')
+        name, style_value = name.strip().lower(), _WHITESPACE_RE.sub(' ', style_value.strip().lower())
+        if name not in _ALLOWED_STYLES or not _STYLE_VALUE_RE.match(style_value):
+            continue
+        if any(function not in _STYLE_FUNCTIONS for function in _STYLE_FUNCTION_RE.findall(style_value)):
+            continue
+        declarations.append(f'{name}: {style_value};')
+    return ' '.join(declarations)
+
+
+def _clean_attrs(tag: str, attrs: List[Tuple[str, Optional[str]]]) -> str:
+    allowed = _ALLOWED_TAGS[tag]
+    cleaned = []
+    for name, value in attrs:
+        if name not in allowed or value is None:
+            continue
+        value = value.strip()
+        if name == 'style':
+            value = _clean_style(value)
+        elif name == 'class':
+            value = _WHITESPACE_RE.sub(' ', value)
+        elif name == 'href' and not _SAFE_HREF_RE.match(value):
+            continue
+        elif name in _ATTR_VALUE_RES and not _ATTR_VALUE_RES[name].match(value):
+            continue
+        if value:
+            cleaned.append(f' {name}="{html.escape(value, quote=True)}"')
+    return ''.join(cleaned)
+
+
+class _Normalizer(HTMLParser):
+    """Streaming allowlist filter and minifier, fed once per document"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out: List[str] = []
+        # Open allowed tags, with the index of their start tag in ``out``
+        self.open: List[Tuple[str, int]] = []
+        self.open_counts: Dict[str, int] = {}
+        self.dropped_depth = 0
+        # Whitespace seen but not yet written, and whether a block boundary came last
+        self.pending_space = False
+        self.after_block = True
+
+    def _boundary(self, tag: str):
+        """Write or discard pending whitespace before a tag"""
+        if tag in _BLOCK_TAGS:
+            self.pending_space = False
+            self.after_block = True
+            return
+        if self.pending_space and not self.after_block:
+            self.out.append(' ')
+        self.pending_space = False
+        self.after_block = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.dropped_depth or tag in _DROPPED_TAGS:
+            if tag in _DROPPED_TAGS:
+                self.dropped_depth += 1
+            return
+        if tag not in _ALLOWED_TAGS:
+            return
+        if tag == 'li' and self.open and self.open[-1][0] == 'li':
+            # An unclosed <li> ends where the next one starts
+            self.handle_endtag('li')
+        self._boundary(tag)
+        self.out.append(f'<{tag}{_clean_attrs(tag, attrs)}>')
+        if tag not in _VOID_TAGS:
+            self.open.append((tag, len(self.out) - 1))
+            self.open_counts[tag] = self.open_counts.get(tag, 0) + 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in _VOID_TAGS and tag not in _DROPPED_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if self.dropped_depth:
+            if tag in _DROPPED_TAGS:
+                self.dropped_depth -= 1
+            return
+        if not self.open_counts.get(tag):
+            # Stray end tag, or one of a tag that was not allowed
+            return
+        while self.open:
+            name, index = self.open.pop()
+            self._close(name, index)
+            if name == tag:
+                break
+
+    def _close(self, tag: str, index: int):
+        self.open_counts[tag] -= 1
+        if tag in _DROPPED_WHEN_EMPTY and index == len(self.out) - 1:
+            del self.out[index]
+            return
+        self._boundary(tag)
+        self.out.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.dropped_depth:
+            return
+        text = _WHITESPACE_RE.sub(' ', _clean_text(data))
+        if not text.strip():
+            self.pending_space = self.pending_space or bool(text)
+            return
+        if text[0] == ' ':
+            self.pending_space = True
+        if self.pending_space and not self.after_block:
+            self.out.append(' ')
+        self.out.append(text.strip())
+        self.pending_space = text[-1] == ' '
+        self.after_block = False
+
+    def handle_comment(self, data):
+        pass
+
+    def result(self) -> str:
+        self.close()
+        while self.open:
+            self._close(*self.open.pop())
+        return ''.join(self.out)
+
+
+def normalize_analysis_html(content: Optional[str]) -> str:
+    """
+    Clean, sanitize and minify analysis HTML before it is stored
+
+    Args:
+        content: HTML (or markdown) returned by the model or edited by the user
+
+    Returns:
+        Compact HTML made of allowlisted tags only; ``content`` unchanged when
+        ANALYSIS_HTML_NORMALIZE is off
+    """
+    if not content:
+        return ''
+    if not settings.ANALYSIS_HTML_NORMALIZE:
+        return content
+    content = _CODE_FENCE_END_RE.sub('', _CODE_FENCE_START_RE.sub('', content, count=1), count=1)
+    if not _HTML_TAG_RE.search(content):
+        # A reply written entirely in markdown
+        content = markdown.markdown(content, extensions=['tables'])
+    parser = _Normalizer()
+    parser.feed(content)
+    return parser.result()
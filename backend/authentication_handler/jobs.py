@@ -0,0 +1,625 @@
+import asyncio
+import csv
+import io
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+
+from .address_research import canonical_address
+from .analysis_generator import generate_analysis
+from .html_normalizer import normalize_analysis_html
+from .model_router import choose_model
+from .models import AnalysisBatch, AnalysisJob, PropertyAnalysis
+from .perplexity_service import PerplexityError, complete, get_content
+from .priority import package_weight, reset_package, set_package
+from .upstream_limiter import reset_client_key, set_client_key
+from .usage import BudgetExceeded, apply_budget
+
+logger = logging.getLogger(__name__)
+
+# Worker id of jobs the client took over to generate inline (see take_over_job)
+INLINE_WORKER_ID = 'inline'
+
+
+def default_worker_id() -> str:
+    """Identify a worker thread across hosts and processes"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def submit_analysis_job(user, address: str, package_name: str, model: Optional[str],
+                        messages: Optional[List[Dict]] = None, payment_intent_id: Optional[str] = None,
+                        agent_description: str = '', include_agent_description: bool = True,
+                        mode: Optional[str] = None) -> AnalysisJob:
+    """
+    Queue an analysis for the worker pool
+
+    The job is scheduled among the other queued jobs by its package's
+    priority weight (see ``priority``).
+
+    Args:
+        user: User the resulting PropertyAnalysis belongs to
+        address: Property address
+        package_name: Purchased package
+        model: Perplexity model name (routed by package when the job runs if None)
+        messages: Chat messages to send; the server-side prompt template is
+            rendered by the worker when omitted
+        payment_intent_id: Stripe payment intent the analysis was paid with
+        agent_description: Agent description stored alongside the analysis
+        include_agent_description: Add the Welcome section to a templated prompt
+        mode: Generation mode for a templated prompt (see analysis_generator)
+
+    Returns:
+        The queued job
+    """
+    return AnalysisJob.objects.create(
+        user=user,
+        address=address,
+        package_name=package_name,
+        payment_intent_id=payment_intent_id,
+        agent_description=agent_description or '',
+        request_payload=_request_payload(model, messages, include_agent_description, mode),
+        max_attempts=settings.ANALYSIS_JOB_MAX_ATTEMPTS,
+        virtual_finish=_virtual_finish_tags(package_name, 1)[0],
+    )
+
+
+def _virtual_finish_tags(package_name: str, count: int) -> List[float]:
+    """
+    Weighted fair queuing tags for ``count`` new jobs of a package
+
+    The virtual time is the highest tag claimed so far. A package's new
+    jobs follow its queued ones, each ``1 / weight`` apart, so a heavier
+    package advances more slowly and is claimed more often, while a lighter
+    package's jobs still come up once the virtual time reaches them.
+    """
+    weight = package_weight(package_name)
+    virtual_time = (
+        AnalysisJob.objects.exclude(status=AnalysisJob.STATUS_QUEUED)
+        .order_by('-virtual_finish').values_list('virtual_finish', flat=True).first()
+    ) or 0.0
+    last_queued = AnalysisJob.objects.filter(
+        status=AnalysisJob.STATUS_QUEUED, package_name=package_name,
+    ).aggregate(tag=Max('virtual_finish'))['tag'] or 0.0
+    start = max(virtual_time, last_queued)
+    return [start + (index + 1) / weight for index in range(count)]
+
+
+def _request_payload(model: Optional[str], messages: Optional[List[Dict]], include_agent_description: bool,
+                     mode: Optional[str]) -> Dict:
+    request_payload = {'model': model}
+    if messages:
+        request_payload['messages'] = messages
+    else:
+        request_payload['include_agent_description'] = include_agent_description
+        request_payload['mode'] = mode
+    return request_payload
+
+
+def parse_batch_addresses(text: str) -> List[str]:
+    """
+    Addresses from an uploaded CSV file
+
+    Uses the column headed "address" when there is one, otherwise the
+    first column of every row.
+    """
+    rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    if 'address' in header:
+        column = header.index('address')
+        rows = rows[1:]
+    else:
+        column = 0
+    return [row[column].strip() for row in rows if len(row) > column and row[column].strip()]
+
+
+def submit_analysis_batch(user, addresses: List[str], package_name: str, model: Optional[str] = None,
+                          concurrency: Optional[int] = None, name: str = '',
+                          include_agent_description: bool = True, mode: Optional[str] = None) -> AnalysisBatch:
+    """
+    Queue one templated analysis job per address as a batch
+
+    Duplicate addresses (in any spelling) are queued once. Workers run at
+    most ``concurrency`` of the batch's jobs at a time, and each job stores
+    its PropertyAnalysis as soon as it finishes.
+
+    Args:
+        user: User the analyses belong to
+        addresses: Property addresses
+        package_name: Package the analyses are generated for
+        model: Perplexity model name (routed by package when None)
+        concurrency: Jobs run at once (capped at ANALYSIS_BATCH_MAX_CONCURRENCY)
+        name: Label shown with the batch
+        include_agent_description: Add the Welcome section to each analysis
+        mode: Generation mode (see analysis_generator)
+
+    Returns:
+        The batch, with its jobs queued
+    """
+    unique_addresses = {}
+    for address in addresses:
+        unique_addresses.setdefault(canonical_address(address), address)
+
+    if concurrency is None:
+        concurrency = settings.ANALYSIS_BATCH_CONCURRENCY
+    concurrency = max(1, min(concurrency, settings.ANALYSIS_BATCH_MAX_CONCURRENCY))
+
+    request_payload = _request_payload(model, None, include_agent_description, mode)
+    with transaction.atomic():
+        tags = _virtual_finish_tags(package_name, len(unique_addresses))
+        batch = AnalysisBatch.objects.create(
+            user=user,
+            name=name[:200],
+            package_name=package_name,
+            concurrency=concurrency,
+            total=len(unique_addresses),
+        )
+        AnalysisJob.objects.bulk_create([
+            AnalysisJob(
+                user=user,
+                batch=batch,
+                address=address,
+                package_name=package_name,
+                request_payload=request_payload,
+                max_attempts=settings.ANALYSIS_JOB_MAX_ATTEMPTS,
+                virtual_finish=tag,
+            )
+            for address, tag in zip(unique_addresses.values(), tags)
+        ])
+    logger.info(f"Queued analysis batch {batch.id} with {batch.total} addresses (concurrency {concurrency})")
+    return batch
+
+
+def submit_paid_analysis_job(user, payment_intent_id: str, address: str, package_name: str,
+                             model: Optional[str] = None, **kwargs) -> Tuple[AnalysisJob, bool]:
+    """
+    Queue the analysis a payment intent paid for, unless it is already queued
+
+    Both the Stripe webhook and the returning client call this; whichever
+    comes first creates the job and the other picks it up.
+
+    Args:
+        user: User the analysis belongs to
+        payment_intent_id: Stripe payment intent the analysis was paid with
+        address: Property address
+        package_name: Purchased package
+        model: Perplexity model name (routed by package when None)
+        **kwargs: Passed through to ``submit_analysis_job``
+
+    Returns:
+        (job, created)
+    """
+    job = AnalysisJob.objects.filter(payment_intent_id=payment_intent_id).first()
+    if job is not None:
+        return job, False
+    try:
+        with transaction.atomic():
+            job = submit_analysis_job(
+                user, address, package_name, model, payment_intent_id=payment_intent_id, **kwargs,
+            )
+    except IntegrityError:
+        # Lost the race against a concurrent submit for the same payment
+        return AnalysisJob.objects.get(payment_intent_id=payment_intent_id), False
+    logger.info(f"Queued analysis job {job.id} for payment {payment_intent_id}")
+    return job, True
+
+
+def take_over_job(user, job_id: int) -> Tuple[Optional[AnalysisJob], bool]:
+    """
+    Claim a queued job for the client to generate inline
+
+    The checkout page falls back to inline generation when no worker picked
+    the paid job up in time. The same compare-and-set as ``claim_next_job``
+    decides between the client and a worker, so the analysis is generated
+    (and billed) once. If the client never saves, the job goes stale and
+    ``requeue_stale_jobs`` hands it back to the workers.
+
+    Returns:
+        (job in its latest state, taken) - job is None if it does not belong to ``user``
+    """
+    taken = AnalysisJob.objects.filter(pk=job_id, user=user, status=AnalysisJob.STATUS_QUEUED).update(
+        status=AnalysisJob.STATUS_RUNNING,
+        worker_id=INLINE_WORKER_ID,
+        started_at=timezone.now(),
+    )
+    job = AnalysisJob.objects.filter(pk=job_id, user=user).first()
+    if taken:
+        logger.info(f"Analysis job {job_id} taken over for inline generation")
+    return job, bool(taken)
+
+
+def settle_paid_job(user, payment_intent_id: Optional[str], analysis: PropertyAnalysis) -> bool:
+    """
+    Close a payment's job with an analysis the client generated inline
+
+    The job is completed with that analysis so a worker does not generate
+    (and bill) it again. Jobs a worker already started are left to finish.
+
+    Returns:
+        True if a queued or taken-over job was closed
+    """
+    if not payment_intent_id:
+        return False
+    settled = AnalysisJob.objects.filter(
+        Q(status=AnalysisJob.STATUS_QUEUED) | Q(status=AnalysisJob.STATUS_RUNNING, worker_id=INLINE_WORKER_ID),
+        user=user,
+        payment_intent_id=payment_intent_id,
+    ).update(
+        status=AnalysisJob.STATUS_SUCCEEDED,
+        property_analysis=analysis,
+        error='',
+        finished_at=timezone.now(),
+    )
+    if settled:
+        logger.info(f"Analysis job for payment {payment_intent_id} settled with inline analysis {analysis.id}")
+    return bool(settled)
+
+
+def queue_analysis_for_payment(payment_intent) -> Optional[AnalysisJob]:
+    """
+    Start generating the analysis for a succeeded Stripe payment intent
+
+    Runs from the payment_intent.succeeded webhook, so the analysis is
+    usually under way or done by the time the browser returns from checkout.
+
+    Args:
+        payment_intent: Stripe PaymentIntent object from the webhook event
+
+    Returns:
+        The analysis job, or None if the intent does not describe an analysis
+    """
+    payment_intent_id = payment_intent.get('id')
+    metadata = payment_intent.get('metadata') or {}
+    address = (metadata.get('address') or '').strip()
+    user = User.objects.filter(pk=metadata.get('user_id') or None).first()
+    if not payment_intent_id or not address or user is None:
+        return None
+
+    # Analyses saved by clients from before jobs were used carry the payment too
+    if PropertyAnalysis.objects.filter(payment_intent_id=payment_intent_id).exists():
+        return None
+
+    job, _created = submit_paid_analysis_job(
+        user,
+        payment_intent_id,
+        address,
+        metadata.get('package_name') or 'Professional',
+    )
+    return job
+
+
+def requeue_stale_jobs() -> int:
+    """
+    Put back jobs whose worker died while running them
+
+    The lost run counts as an attempt, so a job that keeps crashing or hanging
+    its worker is failed once it reaches ``max_attempts`` instead of being
+    retried forever.
+
+    Returns:
+        The number of jobs requeued
+    """
+    now = timezone.now()
+    stale = AnalysisJob.objects.filter(
+        status=AnalysisJob.STATUS_RUNNING,
+        started_at__lt=now - timedelta(seconds=settings.ANALYSIS_JOB_STALE_SECONDS),
+    )
+    failed = stale.filter(attempts__gte=F('max_attempts') - 1).update(
+        status=AnalysisJob.STATUS_FAILED,
+        attempts=F('attempts') + 1,
+        worker_id='',
+        error='The worker stopped while running this job',
+        finished_at=now,
+    )
+    if failed:
+        logger.error(f"Failed {failed} stale analysis jobs that used up their attempts")
+    return stale.update(status=AnalysisJob.STATUS_QUEUED, attempts=F('attempts') + 1, worker_id='')
+
+
+def claim_next_job(worker_id: str) -> Optional[AnalysisJob]:
+    """
+    Atomically take the runnable job with the lowest fair queuing tag
+
+    Jobs are ordered by package priority (see ``_virtual_finish_tags``),
+    then by age. A compare-and-set update on ``status`` decides ownership, so this works
+    on SQLite and PostgreSQL alike without row locks.
+
+    Returns:
+        The claimed job, or None if the queue is empty
+    """
+    now = timezone.now()
+    candidates = AnalysisJob.objects.filter(
+        Q(run_after__isnull=True) | Q(run_after__lte=now),
+        status=AnalysisJob.STATUS_QUEUED,
+    ).exclude(
+        # Batches already running their share of jobs wait, without holding up other work
+        batch_id__in=_saturated_batches(),
+    ).order_by('virtual_finish', 'created_at').values_list('pk', 'batch_id')[:10]
+
+    for pk, batch_id in candidates:
+        claimed = AnalysisJob.objects.filter(pk=pk, status=AnalysisJob.STATUS_QUEUED).update(
+            status=AnalysisJob.STATUS_RUNNING,
+            worker_id=worker_id,
+            started_at=now,
+        )
+        if not claimed:
+            continue
+        if batch_id is not None and _over_batch_concurrency(batch_id):
+            # Another worker filled the batch's last slot at the same moment
+            AnalysisJob.objects.filter(pk=pk, worker_id=worker_id).update(
+                status=AnalysisJob.STATUS_QUEUED, worker_id='', started_at=None,
+            )
+            continue
+        return AnalysisJob.objects.get(pk=pk)
+    return None
+
+
+def _saturated_batches() -> List[int]:
+    """Ids of batches with as many running jobs as their concurrency allows"""
+    return list(
+        AnalysisJob.objects.filter(status=AnalysisJob.STATUS_RUNNING, batch__isnull=False)
+        .values('batch_id')
+        .annotate(running=Count('id'))
+        .filter(running__gte=F('batch__concurrency'))
+        .values_list('batch_id', flat=True)
+    )
+
+
+def _over_batch_concurrency(batch_id: int) -> bool:
+    running = AnalysisJob.objects.filter(batch_id=batch_id, status=AnalysisJob.STATUS_RUNNING).count()
+    return running > AnalysisBatch.objects.values_list('concurrency', flat=True).get(pk=batch_id)
+
+
+def run_job(job: AnalysisJob) -> AnalysisJob:
+    """
+    Generate the analysis for a claimed job and store it as a PropertyAnalysis
+
+    Failed attempts are retried with exponential backoff until
+    ``max_attempts`` is reached.
+    """
+    job.attempts += 1
+    payload = job.request_payload or {}
+    # Count the job's upstream calls against its owner's per-user limit
+    token = set_client_key(f'user:{job.user_id}')
+    package_token = set_package(job.package_name)
+    try:
+        return _run_job(job, payload)
+    finally:
+        reset_package(package_token)
+        reset_client_key(token)
+
+
+def _run_job(job: AnalysisJob, payload: Dict) -> AnalysisJob:
+    # Routed on every attempt, so a retry can move to the fallback model
+    route = choose_model(job.package_name, payload.get('model'))
+    try:
+        route = apply_budget(route)
+    except BudgetExceeded as e:
+        return _defer_job(job, e)
+    model = route.model
+
+    prompt_version = ''
+    try:
+        if payload.get('messages'):
+            data, _cache_status = complete(model, payload['messages'])
+        else:
+            result = generate_analysis(
+                job.user,
+                job.address,
+                model=model,
+                include_agent_description=payload.get('include_agent_description', True),
+                agent_description=job.agent_description or None,
+                mode=payload.get('mode'),
+            )
+            data, prompt_version = result.data, result.prompt_version
+            job.agent_description = result.agent_description
+        content = get_content(data)
+        if not content:
+            raise PerplexityError({'error': 'Perplexity API returned an empty analysis'})
+    except PerplexityError as e:
+        return _fail_attempt(job, str(e.payload.get('error', e)))
+    except Exception as e:
+        logger.exception(f"Unexpected error running analysis job {job.id}")
+        return _fail_attempt(job, str(e))
+
+    analysis = PropertyAnalysis.objects.create(
+        user_id=job.user_id,
+        address=job.address,
+        package_name=job.package_name,
+        analysis_content=normalize_analysis_html(content),
+        analysis_model=data.get('model') or model,
+        model_route_reason=route.reason,
+        prompt_version=prompt_version,
+        api_response=data,
+        agent_description=job.agent_description,
+        payment_intent_id=job.payment_intent_id,
+    )
+
+    job.property_analysis = analysis
+    job.status = AnalysisJob.STATUS_SUCCEEDED
+    job.error = ''
+    job.finished_at = timezone.now()
+    job.save()
+    logger.info(f"Analysis job {job.id} succeeded (analysis {analysis.id})")
+    return job
+
+
+def _defer_job(job: AnalysisJob, error: BudgetExceeded) -> AnalysisJob:
+    """Put a job back until its owner's (or the service's) usage budget frees up, without using an attempt"""
+    job.attempts -= 1
+    job.error = str(error)
+    job.status = AnalysisJob.STATUS_QUEUED
+    job.run_after = timezone.now() + timedelta(seconds=error.retry_after)
+    job.worker_id = ''
+    job.save()
+    logger.warning(f"Analysis job {job.id} deferred for {error.retry_after:.0f}s: {error}")
+    return job
+
+
+def _fail_attempt(job: AnalysisJob, error: str) -> AnalysisJob:
+    job.error = error
+    if job.attempts < job.max_attempts:
+        backoff = settings.ANALYSIS_JOB_RETRY_BACKOFF * (2 ** (job.attempts - 1))
+        job.status = AnalysisJob.STATUS_QUEUED
+        job.run_after = timezone.now() + timedelta(seconds=backoff)
+        job.worker_id = ''
+        logger.warning(f"Analysis job {job.id} attempt {job.attempts} failed, retrying in {backoff}s: {error}")
+    else:
+        job.status = AnalysisJob.STATUS_FAILED
+        job.finished_at = timezone.now()
+        logger.error(f"Analysis job {job.id} failed after {job.attempts} attempts: {error}")
+    job.save()
+    return job
+
+
+def work_loop(stop_event: threading.Event, poll_interval: float, worker_id: Optional[str] = None):
+    """
+    Claim and run jobs until ``stop_event`` is set
+
+    Used by each thread or process of the run_analysis_worker command. Every
+    ``ANALYSIS_JOB_REQUEUE_INTERVAL`` seconds it also requeues jobs left
+    running by a worker that died, here or on another node.
+    """
+    worker_id = worker_id or default_worker_id()
+    next_requeue = time.monotonic() + settings.ANALYSIS_JOB_REQUEUE_INTERVAL
+    while not stop_event.is_set():
+        close_old_connections()
+        if time.monotonic() >= next_requeue:
+            next_requeue = time.monotonic() + settings.ANALYSIS_JOB_REQUEUE_INTERVAL
+            try:
+                requeued = requeue_stale_jobs()
+                if requeued:
+                    logger.warning(f"Worker {worker_id} requeued {requeued} stale running jobs")
+            except Exception as e:
+                logger.error(f"Worker {worker_id} failed to requeue stale jobs: {str(e)}")
+        try:
+            job = claim_next_job(worker_id)
+        except Exception as e:
+            logger.error(f"Worker {worker_id} failed to claim a job: {str(e)}")
+            job = None
+
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+
+        try:
+            run_job(job)
+        except Exception:
+            logger.exception(f"Worker {worker_id} crashed running job {job.id}")
+    close_old_connections()
+
+
+async def await_job(job_id: int, user, timeout: float) -> Optional[AnalysisJob]:
+    """
+    Long-poll a job until it finishes or ``timeout`` seconds pass
+
+    Only the async views use this; a sync worker would be held for the whole wait.
+
+    Returns:
+        The job in its latest state, or None if it does not belong to ``user``
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await AnalysisJob.objects.filter(pk=job_id, user=user).afirst()
+        if job is None or job.is_finished or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(settings.ANALYSIS_JOB_POLL_INTERVAL)
+
+
+def serialize_batch(batch: AnalysisBatch, include_jobs: bool = True) -> Dict:
+    """Aggregate and per-address progress of a batch"""
+    jobs = list(batch.jobs.order_by('id'))
+    counts = {status: 0 for status, _label in AnalysisJob.STATUS_CHOICES}
+    for job in jobs:
+        counts[job.status] += 1
+    finished = counts[AnalysisJob.STATUS_SUCCEEDED] + counts[AnalysisJob.STATUS_FAILED]
+
+    started = [job.started_at for job in jobs if job.started_at]
+    finished_at = [job.finished_at for job in jobs if job.finished_at]
+    throughput = None
+    eta_seconds = None
+    if started and finished_at:
+        # Completed analyses per minute since the batch started running
+        elapsed = (max(finished_at) - min(started)).total_seconds()
+        if elapsed > 0:
+            throughput = round(finished / elapsed * 60, 2)
+            if finished < len(jobs):
+                eta_seconds = round((len(jobs) - finished) / (finished / elapsed))
+
+    data = {
+        'batch_id': batch.id,
+        'name': batch.name,
+        'package_name': batch.package_name,
+        'status': 'finished' if finished == len(jobs) else ('running' if started else 'queued'),
+        'concurrency': batch.concurrency,
+        'total': len(jobs),
+        'counts': counts,
+        'progress': round(finished / len(jobs), 3) if jobs else 1.0,
+        'analyses_per_minute': throughput,
+        'eta_seconds': eta_seconds,
+        'created_at': batch.created_at.isoformat(),
+        'finished_at': max(finished_at).isoformat() if jobs and finished == len(jobs) else None,
+    }
+    if include_jobs:
+        data['jobs'] = [serialize_job(job, include_queue=False) for job in jobs]
+    return data
+
+
+def queue_position(job: AnalysisJob) -> Tuple[int, Optional[int]]:
+    """
+    Place of a queued job in the fair queue and its estimated wait
+
+    The wait assumes the workers keep the throughput of the last
+    ``ANALYSIS_QUEUE_THROUGHPUT_WINDOW`` seconds; it is None when no job
+    finished in that window.
+
+    Returns:
+        (1-based position, estimated seconds until the job starts or None)
+    """
+    ahead = AnalysisJob.objects.filter(status=AnalysisJob.STATUS_QUEUED).filter(
+        Q(virtual_finish__lt=job.virtual_finish)
+        | Q(virtual_finish=job.virtual_finish, created_at__lt=job.created_at)
+    ).count()
+    window = settings.ANALYSIS_QUEUE_THROUGHPUT_WINDOW
+    finished = AnalysisJob.objects.filter(
+        status__in=AnalysisJob.FINISHED_STATUSES,
+        finished_at__gte=timezone.now() - timedelta(seconds=window),
+    ).count()
+    wait_seconds = round((ahead + 1) * window / finished) if finished else None
+    return ahead + 1, wait_seconds
+
+
+def serialize_job(job: AnalysisJob, include_queue: bool = True) -> Dict:
+    """
+    Job status payload returned by the job endpoints
+
+    Queued jobs also report ``queue_position`` and ``estimated_wait_seconds``
+    unless ``include_queue`` is False (batch listings skip the extra queries).
+    """
+    data = {
+        'job_id': job.id,
+        'batch_id': job.batch_id,
+        'status': job.status,
+        'address': job.address,
+        'package_name': job.package_name,
+        'attempts': job.attempts,
+        'error': job.error or None,
+        'analysis_id': job.property_analysis_id,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if include_queue and job.status == AnalysisJob.STATUS_QUEUED:
+        data['queue_position'], data['estimated_wait_seconds'] = queue_position(job)
+    return data
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authentication_handler.analysis_prompts import render_sections
+from authentication_handler.html_normalizer import normalize_analysis_html
+
+# What the model typically slips into a section: markdown, citations and the odd script
+_NOISE = (
+    '\n<p>### Market **snapshot**: prices up *4%* this year [1][2]. `Median` days on market: 21 [3].</p>\n'
+    '<p>  Buyers   love the <span style="color: red; display: inline">schools</span><sup>[4]</sup>.  </p>\n'
+    '<script>alert(1)</script><!-- note --><custom-tag onclick="x()">Unknown tag</custom-tag>\n'
+)
+
+
+class Command(BaseCommand):
+    help = 'Time analysis HTML normalization on synthetic reports of growing size'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1,2,4,8,16',
+            help='Comma-separated report sizes, in multiples of a full generated report',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Runs per size; the fastest is reported',
+        )
+
+    def handle(self, *args, **options):
+        report = '<div class="property-analysis">' + render_sections('123 Main St, Springfield').replace(
+            '</section>', _NOISE + '</section>') + '</div>'
+        sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        repeat = max(1, options['repeat'])
+
+        base_rate = None
+        for size in sizes:
+            document = report * size
+            best = float('inf')
+            for _ in range(repeat):
+                started = time.perf_counter()
+                normalize_analysis_html(document)
+                best = min(best, time.perf_counter() - started)
+            rate = len(document) / best / 1_000_000
+            base_rate = base_rate or rate
+            self.stdout.write(
+                f'{size:>4}x {len(document) / 1024:>9.1f} KiB  {best * 1000:>9.2f} ms  '
+                f'{rate:>6.2f} MB/s  ({rate / base_rate:.2f} of the 1x rate)'
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            'Normalization is linear when the MB/s rate stays flat as the size grows'
+        ))
@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+# Rebuilt by migrate on the target, or not worth moving
+EXCLUDED = ['contenttypes', 'auth.permission', 'sessions']
+
+
+class Command(BaseCommand):
+    help = ('Copy every row from db.sqlite3 into the configured database server. '
+            'Run once after switching a deployment to DATABASE_URL or POSTGRES_*')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Copy even if the target database already has users (rows with the same id are overwritten)',
+        )
+
+    def handle(self, *args, **options):
+        if 'sqlite' not in connections.databases:
+            raise CommandError('Nothing to copy: db.sqlite3 does not exist or is still the default database')
+
+        # Both schemas must match the models for the rows to load
+        call_command('migrate', database='default', interactive=False, verbosity=0)
+        if User.objects.using('default').exists() and not options['force']:
+            raise CommandError('The target database already has users; pass --force to copy into it anyway')
+        call_command('migrate', database='sqlite', interactive=False, verbosity=0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            dump = os.path.join(directory, 'sqlite.json')
+            call_command('dumpdata', database='sqlite', natural_foreign=True, exclude=EXCLUDED,
+                         output=dump, verbosity=0)
+            # loaddata also resets the target's id sequences past the copied rows
+            call_command('loaddata', dump, database='default', verbosity=0)
+
+        users = User.objects.using('default').count()
+        self.stdout.write(self.style.SUCCESS(f'Copied db.sqlite3 into the default database ({users} users)'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from authentication_handler.address_research import purge_research
+from authentication_handler.generation_results import purge_results
+from authentication_handler.response_cache import perplexity_cache
+from authentication_handler.resumable_stream import purge_generations
+
+
+class Command(BaseCommand):
+    help = 'Delete expired entries from the Perplexity response cache, stale address research, old streamed generations and expired generation results'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Delete every cached response, not only expired ones',
+        )
+
+    def handle(self, *args, **options):
+        deleted = perplexity_cache.purge(expired_only=not options['all'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} cached Perplexity responses'))
+
+        deleted = purge_research()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} stale address research sections'))
+
+        deleted = purge_generations()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} old streamed generations'))
+
+        deleted = purge_results()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired generation results'))
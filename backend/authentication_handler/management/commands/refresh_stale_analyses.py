@@ -0,0 +1,110 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from authentication_handler.analysis_prompts import SECTION_KEYS
+from authentication_handler.analysis_refresh import refresh_analysis
+from authentication_handler.models import PropertyAnalysis
+from authentication_handler.upstream_limiter import reset_client_key, set_client_key
+
+
+def _refresh(analysis, keys):
+    # Count the refresh against the owner's per-user upstream limit
+    token = set_client_key(f'user:{analysis.user_id}')
+    try:
+        return refresh_analysis(analysis, keys=keys)
+    except Exception as e:
+        return e
+    finally:
+        reset_client_key(token)
+        # Pool threads open their own database connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the time-sensitive sections of analyses that have not been refreshed recently'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=float,
+            default=settings.ANALYSIS_REFRESH_AFTER / 86400,
+            help='Refresh analyses created or last refreshed more than this many days ago',
+        )
+        parser.add_argument(
+            '--sections',
+            default='',
+            help='Comma-separated section keys to regenerate (default: the time-sensitive ones)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.ANALYSIS_REFRESH_CONCURRENCY,
+            help='Analyses refreshed in parallel (upstream limits still apply)',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Stop after this many analyses',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only count the analyses that would be refreshed',
+        )
+
+    def handle(self, *args, **options):
+        keys = [key.strip() for key in options['sections'].split(',') if key.strip()] or None
+        unknown = set(keys or []) - set(SECTION_KEYS)
+        if unknown:
+            raise CommandError(f'Unknown sections: {", ".join(sorted(unknown))}')
+
+        cutoff = timezone.now() - timedelta(days=options['older_than'])
+        # Analyses from the old client-side prompt have no section markers to refresh
+        queryset = (
+            PropertyAnalysis.objects.exclude(prompt_version='')
+            .annotate(last_refreshed=Coalesce('refreshed_at', 'created_at'))
+            .filter(last_refreshed__lt=cutoff)
+            .order_by('last_refreshed')
+        )
+        if options['limit'] is not None:
+            queryset = queryset[:options['limit']]
+        analyses = list(queryset)
+
+        if options['dry_run']:
+            self.stdout.write(f'{len(analyses)} analyses would be refreshed')
+            return
+
+        refreshed = unchanged = failed = 0
+        failed_ids = []
+        sections = 0
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, options['concurrency']),
+                                thread_name_prefix='analysis-refresh') as executor:
+            for analysis, result in zip(analyses, executor.map(_refresh, analyses, [keys] * len(analyses))):
+                if isinstance(result, Exception) or result.failed:
+                    failed += 1
+                    failed_ids.append(analysis.pk)
+                elif result.refreshed:
+                    refreshed += 1
+                else:
+                    unchanged += 1
+                if not isinstance(result, Exception):
+                    sections += len(result.refreshed)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Done in {elapsed:.1f}s: {refreshed} analyses refreshed ({sections} sections), '
+            f'{unchanged} without refreshable sections, {failed} failed'
+        ))
+        if failed_ids:
+            self.stdout.write(self.style.WARNING(
+                f'Failed analysis ids (retried on the next run): {", ".join(str(pk) for pk in failed_ids)}'
+            ))
@@ -0,0 +1,138 @@
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from authentication_handler.agent_description_generator import (
+    DESCRIPTION_PROMPT_VERSION, FAILED, GENERATED, UNCHANGED, refresh_agent_description,
+)
+from authentication_handler.models import AgentProfile
+
+DEFAULT_CHECKPOINT = os.path.join(tempfile.gettempdir(), 'regenerate_agent_descriptions.json')
+
+
+def _refresh(agent_profile, force):
+    try:
+        return refresh_agent_description(agent_profile, force=force)
+    finally:
+        # Pool threads open their own database connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Regenerate stored agent descriptions whose profile or prompt changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.AGENT_DESCRIPTION_REFRESH_WORKERS,
+            help='Descriptions generated in parallel (upstream limits still apply)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=100,
+            help='Profiles loaded and checkpointed at a time',
+        )
+        parser.add_argument(
+            '--checkpoint',
+            default=DEFAULT_CHECKPOINT,
+            help='File recording the last completed profile id, used to resume',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore an existing checkpoint and start from the first profile',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Regenerate every description, even unchanged ones',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=None,
+            help='Stop after this many profiles',
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        chunk_size = max(1, options['chunk_size'])
+        checkpoint_path = options['checkpoint']
+        limit = options['limit']
+
+        last_id = 0 if options['restart'] else self._read_checkpoint(checkpoint_path)
+        if last_id:
+            self.stdout.write(f'Resuming after profile {last_id}')
+
+        totals = {GENERATED: 0, UNCHANGED: 0, FAILED: 0}
+        failed_ids = []
+        processed = 0
+        started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='agent-description') as executor:
+            while limit is None or processed < limit:
+                size = chunk_size if limit is None else min(chunk_size, limit - processed)
+                chunk = list(
+                    AgentProfile.objects.select_related('user')
+                    .filter(pk__gt=last_id)
+                    .order_by('pk')[:size]
+                )
+                if not chunk:
+                    break
+
+                outcomes = list(executor.map(_refresh, chunk, [options['force']] * len(chunk)))
+                for agent_profile, outcome in zip(chunk, outcomes):
+                    totals[outcome] += 1
+                    if outcome == FAILED:
+                        failed_ids.append(agent_profile.pk)
+
+                processed += len(chunk)
+                last_id = chunk[-1].pk
+                # Only whole chunks are checkpointed, so a resumed run never skips a profile
+                self._write_checkpoint(checkpoint_path, last_id)
+
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'{processed} profiles (up to id {last_id}): {totals[GENERATED]} generated, '
+                    f'{totals[UNCHANGED]} unchanged, {totals[FAILED]} failed - '
+                    f'{processed / elapsed:.1f} profiles/s, {totals[GENERATED] / elapsed:.2f} generated/s'
+                )
+
+        finished = limit is None or processed < limit
+        if finished and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Done in {elapsed:.1f}s: {totals[GENERATED]} generated, {totals[UNCHANGED]} unchanged, '
+            f'{totals[FAILED]} failed'
+        ))
+        if failed_ids:
+            self.stdout.write(self.style.WARNING(
+                f'Failed profile ids (re-run to retry): {", ".join(str(pk) for pk in failed_ids)}'
+            ))
+
+    def _read_checkpoint(self, path):
+        try:
+            with open(path) as checkpoint:
+                data = json.load(checkpoint)
+        except (OSError, ValueError):
+            return 0
+        # A checkpoint from an older prompt covers descriptions that are now out of date
+        if data.get('prompt_version') != DESCRIPTION_PROMPT_VERSION:
+            return 0
+        return int(data.get('last_id') or 0)
+
+    def _write_checkpoint(self, path, last_id):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump({'last_id': last_id, 'prompt_version': DESCRIPTION_PROMPT_VERSION}, checkpoint)
+        os.replace(tmp_path, path)
@@ -0,0 +1,93 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from authentication_handler.jobs import requeue_stale_jobs, work_loop
+
+logger = logging.getLogger(__name__)
+
+
+def _run_threads(concurrency, poll_interval, stop_event):
+    """Run ``concurrency`` work loops in this process until stopped"""
+    threads = [
+        threading.Thread(target=work_loop, args=(stop_event, poll_interval), daemon=True,
+                         name=f'analysis-worker-{i}')
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _process_main(concurrency, poll_interval):
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+    _run_threads(concurrency, poll_interval, stop_event)
+
+
+class Command(BaseCommand):
+    help = 'Run the background worker pool that executes queued analysis jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=settings.ANALYSIS_WORKER_CONCURRENCY,
+            help='Worker threads per process',
+        )
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='Worker processes, each running --concurrency threads',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=settings.ANALYSIS_JOB_POLL_INTERVAL,
+            help='Seconds to wait between polls when the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        processes = max(1, options['processes'])
+        poll_interval = options['poll_interval']
+
+        requeued = requeue_stale_jobs()
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale running jobs')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Starting analysis worker: {processes} process(es) x {concurrency} thread(s)'
+        ))
+
+        if processes == 1:
+            _process_main(concurrency, poll_interval)
+            return
+
+        # Forked children must not inherit the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        children = [
+            context.Process(target=_process_main, args=(concurrency, poll_interval), name=f'analysis-worker-{i}')
+            for i in range(processes)
+        ]
+        for child in children:
+            child.start()
+
+        def stop_children(*args):
+            for child in children:
+                if child.is_alive():
+                    child.terminate()
+
+        signal.signal(signal.SIGTERM, stop_children)
+        signal.signal(signal.SIGINT, stop_children)
+        for child in children:
+            child.join()
@@ -0,0 +1,77 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .deadline import reset_deadline, set_deadline
+from .priority import reset_package, set_package
+from .upstream_limiter import reset_client_key, set_client_key
+
+
+class UpstreamClientKeyMiddleware:
+    """
+    Attribute outbound upstream calls to the request that made them
+
+    The request itself is stored and resolved to a user or IP only when an
+    upstream call is made, because DRF authenticates JWT users inside the
+    view, after middleware has run. The package priority starts unset and
+    views set it with ``set_package`` once they have parsed the request; it
+    is restored here when the request ends.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = set_client_key(request)
+        package_token = set_package(None)
+        try:
+            return self.get_response(request)
+        finally:
+            reset_package(package_token)
+            reset_client_key(token)
+
+    async def __acall__(self, request):
+        token = set_client_key(request)
+        package_token = set_package(None)
+        try:
+            return await self.get_response(request)
+        finally:
+            reset_package(package_token)
+            reset_client_key(token)
+
+
+class RequestDeadlineMiddleware:
+    """
+    Give each request a deadline that outbound calls take their timeouts from
+
+    ``REQUEST_DEADLINE_SECONDS`` is kept below the worker timeout so a slow
+    upstream ends in a 504 rather than a killed worker.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = set_deadline(settings.REQUEST_DEADLINE_SECONDS)
+        try:
+            return self.get_response(request)
+        finally:
+            reset_deadline(token)
+
+    async def __acall__(self, request):
+        token = set_deadline(settings.REQUEST_DEADLINE_SECONDS)
+        try:
+            return await self.get_response(request)
+        finally:
+            reset_deadline(token)
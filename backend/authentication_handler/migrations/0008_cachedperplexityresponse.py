@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0007_alter_agentprofile_years_experience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedPerplexityResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cache_key', models.CharField(max_length=64, unique=True)),
+                ('model', models.CharField(max_length=50)),
+                ('response', models.JSONField(help_text='Full API response from Perplexity')),
+                ('size_bytes', models.PositiveIntegerField(default=0)),
+                ('hit_count', models.PositiveIntegerField(default=0)),
+                ('last_hit_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Cached Perplexity Response',
+                'verbose_name_plural': 'Cached Perplexity Responses',
+            },
+        ),
+    ]
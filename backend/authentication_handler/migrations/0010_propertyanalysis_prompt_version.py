@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0009_analysisjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='propertyanalysis',
+            name='prompt_version',
+            field=models.CharField(blank=True, default='', help_text='Version of the server-side prompt template used', max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0010_propertyanalysis_prompt_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentprofile',
+            name='agent_description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='agentprofile',
+            name='agent_description_generated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='agentprofile',
+            name='agent_description_hash',
+            field=models.CharField(blank=True, help_text='Hash of the profile fields the description was generated from', max_length=64),
+        ),
+    ]
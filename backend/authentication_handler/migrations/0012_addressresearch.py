@@ -0,0 +1,32 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0011_agentprofile_agent_description'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressResearch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_key', models.CharField(max_length=255)),
+                ('section_key', models.CharField(max_length=50)),
+                ('model', models.CharField(max_length=50)),
+                ('prompt_version', models.CharField(max_length=20)),
+                ('html', models.TextField()),
+                ('citations', models.JSONField(blank=True, default=list)),
+                ('reuse_count', models.PositiveIntegerField(default=0)),
+                ('generated_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Address Research',
+                'verbose_name_plural': 'Address Research',
+                'unique_together': {('address_key', 'section_key', 'model', 'prompt_version')},
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0012_addressresearch'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='analysisjob',
+            constraint=models.UniqueConstraint(condition=models.Q(('payment_intent_id__isnull', False), models.Q(('payment_intent_id', ''), _negated=True)), fields=('payment_intent_id',), name='unique_analysis_job_payment_intent'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:58
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0013_analysisjob_unique_payment_intent'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamedGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('model', models.CharField(max_length=50)),
+                ('content', models.TextField(blank=True)),
+                ('content_bytes', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('completion', models.JSONField(blank=True, help_text='Assembled completion once finished', null=True)),
+                ('error', models.JSONField(blank=True, help_text='Error payload if the upstream call failed', null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(help_text='Last time output was saved')),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='streamed_generations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Streamed Generation',
+                'verbose_name_plural': 'Streamed Generations',
+            },
+        ),
+    ]
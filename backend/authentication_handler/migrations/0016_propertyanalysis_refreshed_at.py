@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0015_analysisbatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='propertyanalysis',
+            name='refreshed_at',
+            field=models.DateTimeField(blank=True, help_text='Last time the time-sensitive sections were regenerated', null=True),
+        ),
+    ]
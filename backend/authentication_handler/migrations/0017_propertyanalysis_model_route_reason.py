@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0016_propertyanalysis_refreshed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='propertyanalysis',
+            name='model_route_reason',
+            field=models.CharField(blank=True, default='', help_text='Why the model router chose analysis_model', max_length=50),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0017_propertyanalysis_model_route_reason'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='streamedgeneration',
+            name='read_at',
+            field=models.DateTimeField(blank=True, help_text='Last time a client tailing it from another worker read it', null=True),
+        ),
+        migrations.AlterField(
+            model_name='streamedgeneration',
+            name='status',
+            field=models.CharField(choices=[('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='running', max_length=20),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:15
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0018_streamedgeneration_read_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='virtual_finish',
+            field=models.FloatField(default=0.0, help_text='Weighted fair queuing tag; lower tags are claimed first'),
+        ),
+        migrations.AddIndex(
+            model_name='analysisjob',
+            index=models.Index(fields=['status', 'virtual_finish'], name='authenticat_status_c7be1a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysisjob',
+            index=models.Index(fields=['virtual_finish'], name='authenticat_virtual_299464_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:19
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0019_analysisjob_virtual_finish'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UpstreamUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client_key', models.CharField(blank=True, help_text='Limiter key the call was counted under', max_length=100)),
+                ('upstream', models.CharField(default='perplexity', max_length=50)),
+                ('model', models.CharField(max_length=50)),
+                ('purpose', models.CharField(choices=[('analysis', 'Analysis'), ('agent_description', 'Agent description')], default='analysis', max_length=30)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('total_tokens', models.PositiveIntegerField(default=0)),
+                ('cost', models.FloatField(default=0.0, help_text='USD, as reported or estimated from USAGE_MODEL_PRICES')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upstream_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Upstream Usage',
+                'verbose_name_plural': 'Upstream Usage',
+                'indexes': [models.Index(fields=['client_key', 'created_at'], name='authenticat_client__2fa29d_idx'), models.Index(fields=['user', 'created_at'], name='authenticat_user_id_c2cdee_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.3 on 2026-10-17 05:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0020_upstreamusage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GenerationResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64, unique=True)),
+                ('address', models.CharField(blank=True, max_length=500)),
+                ('package_name', models.CharField(blank=True, max_length=100)),
+                ('analysis_model', models.CharField(max_length=50)),
+                ('model_route_reason', models.CharField(blank=True, max_length=50)),
+                ('prompt_version', models.CharField(blank=True, max_length=20)),
+                ('agent_description', models.TextField(blank=True)),
+                ('api_response', models.JSONField(help_text='Completion as returned to the client')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('property_analysis', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='generation_results', to='authentication_handler.propertyanalysis')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_results', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Generation Result',
+                'verbose_name_plural': 'Generation Results',
+            },
+        ),
+    ]
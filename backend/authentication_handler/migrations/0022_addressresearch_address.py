@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication_handler', '0021_generationresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='addressresearch',
+            name='address',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
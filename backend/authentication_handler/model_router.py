@@ -0,0 +1,230 @@
+"""
+Package-aware Perplexity model routing.
+
+Each package maps to a primary model and a faster fallback model
+(``MODEL_ROUTER_TIERS``). Latency and errors of every completion are kept
+per model over a rolling window; while a primary model's p95 latency is
+over ``MODEL_ROUTER_LATENCY_SLO`` or its error rate over
+``MODEL_ROUTER_MAX_ERROR_RATE``, its packages are served by their fallback
+for ``MODEL_ROUTER_FALLBACK_SECONDS``. The primary's samples are then
+cleared, so the next calls go back to it and measure it afresh. Like the
+other upstream stats, the router state is per worker process.
+
+A model requested by the client is only used when it belongs to the
+package's tier (or is the default model), so a caller cannot pick a more
+expensive model than their package pays for.
+"""
+import logging
+import math
+import threading
+import time
+from collections import deque
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'sonar'
+
+# Decision reasons recorded with each analysis
+REQUESTED = 'requested'
+PRIMARY = 'primary'
+FALLBACK_LATENCY = 'fallback_latency'
+FALLBACK_ERRORS = 'fallback_errors'
+ROUTER_DISABLED = 'router_disabled'
+BUDGET_DOWNGRADE = 'budget_downgrade'
+
+
+class ModelRoute(NamedTuple):
+    model: str
+    reason: str
+
+    def as_dict(self) -> Dict:
+        return {'model': self.model, 'reason': self.reason}
+
+
+def parse_tiers(spec: str) -> Dict[str, Tuple[str, str]]:
+    """
+    Parse ``Package:primary/fallback`` entries separated by commas
+
+    The fallback may be left out, in which case the package never switches.
+    """
+    tiers = {}
+    for entry in spec.split(','):
+        if ':' not in entry:
+            continue
+        package, models = entry.split(':', 1)
+        primary, _, fallback = models.partition('/')
+        if package.strip() and primary.strip():
+            tiers[package.strip().lower()] = (primary.strip(), fallback.strip() or primary.strip())
+    return tiers
+
+
+class ModelStats:
+    """Rolling latency and error rate of one model"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._samples = deque()  # (monotonic time, latency seconds, failed)
+
+    def record(self, latency: float, failed: bool):
+        now = time.monotonic()
+        self._samples.append((now, latency, failed))
+        self._trim(now)
+
+    def clear(self):
+        self._samples.clear()
+
+    def _trim(self, now: float):
+        while self._samples and self._samples[0][0] < now - self.window:
+            self._samples.popleft()
+
+    def snapshot(self) -> Dict:
+        self._trim(time.monotonic())
+        calls = len(self._samples)
+        if not calls:
+            return {'calls': 0, 'error_rate': 0.0, 'p95_latency_s': None}
+        latencies = sorted(latency for _at, latency, failed in self._samples if not failed)
+        p95 = latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.95) - 1)] if latencies else None
+        return {
+            'calls': calls,
+            'error_rate': round(sum(1 for sample in self._samples if sample[2]) / calls, 3),
+            'p95_latency_s': round(p95, 2) if p95 is not None else None,
+        }
+
+
+class ModelRouter:
+    """Choose a model per package, falling back while the primary breaks its SLO"""
+
+    def __init__(self, tiers: Dict[str, Tuple[str, str]], default_model: str, latency_slo: float,
+                 max_error_rate: float, min_calls: int, window: float, fallback_seconds: float):
+        self.tiers = tiers
+        self.default_model = default_model
+        self.latency_slo = latency_slo
+        self.max_error_rate = max_error_rate
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.fallback_seconds = fallback_seconds
+
+        self._lock = threading.Lock()
+        self._models: Dict[str, ModelStats] = {}
+        self._fallbacks: Dict[str, Tuple[float, str]] = {}  # primary -> (until, reason)
+        self._decisions: Dict[str, int] = {}
+
+    def route(self, package_name: Optional[str]) -> ModelRoute:
+        """Model for a package's next completion"""
+        primary, fallback = self.tiers.get((package_name or '').strip().lower(),
+                                           (self.default_model, self.default_model))
+        with self._lock:
+            route = self._route(primary, fallback)
+            self._decisions[route.reason] = self._decisions.get(route.reason, 0) + 1
+        return route
+
+    def _route(self, primary: str, fallback: str) -> ModelRoute:
+        if fallback == primary:
+            return ModelRoute(primary, PRIMARY)
+
+        now = time.monotonic()
+        until, reason = self._fallbacks.get(primary, (0.0, ''))
+        if now < until:
+            return ModelRoute(fallback, reason)
+
+        snapshot = self._stats(primary).snapshot()
+        if snapshot['calls'] >= self.min_calls:
+            reason = ''
+            if snapshot['error_rate'] > self.max_error_rate:
+                reason = FALLBACK_ERRORS
+            elif snapshot['p95_latency_s'] is not None and snapshot['p95_latency_s'] > self.latency_slo:
+                reason = FALLBACK_LATENCY
+            if reason:
+                self._fallbacks[primary] = (now + self.fallback_seconds, reason)
+                # Judge the primary on fresh calls once the fallback period ends
+                self._stats(primary).clear()
+                logger.warning(f"Routing {primary} traffic to {fallback} for {self.fallback_seconds}s "
+                               f"({reason}: {snapshot})")
+                return ModelRoute(fallback, reason)
+        return ModelRoute(primary, PRIMARY)
+
+    def allows(self, package_name: Optional[str], model: str) -> bool:
+        """The package's tier includes ``model``, or it is the default model"""
+        tier = self.tiers.get((package_name or '').strip().lower(), ())
+        return model == self.default_model or model in tier
+
+    def record(self, model: str, latency: float, failed: bool):
+        """
+        Feed the outcome of a completion into the model's stats
+
+        Args:
+            model: Model the completion was requested from
+            latency: Seconds the call took
+            failed: The call raised, timed out or the upstream answered 429/5xx
+        """
+        with self._lock:
+            self._stats(model).record(latency, failed)
+
+    def _stats(self, model: str) -> ModelStats:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = ModelStats(self.window)
+        return stats
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'models': {model: stats.snapshot() for model, stats in self._models.items()},
+                'fallbacks': {
+                    primary: {'reason': reason, 'remaining_s': round(until - now, 1)}
+                    for primary, (until, reason) in self._fallbacks.items() if until > now
+                },
+                'decisions': dict(self._decisions),
+            }
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(
+                tiers=parse_tiers(settings.MODEL_ROUTER_TIERS),
+                default_model=DEFAULT_MODEL,
+                latency_slo=settings.MODEL_ROUTER_LATENCY_SLO,
+                max_error_rate=settings.MODEL_ROUTER_MAX_ERROR_RATE,
+                min_calls=settings.MODEL_ROUTER_MIN_CALLS,
+                window=settings.MODEL_ROUTER_WINDOW,
+                fallback_seconds=settings.MODEL_ROUTER_FALLBACK_SECONDS,
+            )
+    return _router
+
+
+def choose_model(package_name: Optional[str], requested_model: Optional[str] = None) -> ModelRoute:
+    """
+    Model for a completion: the one the caller asked for if their package allows it, else the routed model
+
+    Args:
+        package_name: Package the completion is generated for
+        requested_model: Model set explicitly by the client; ignored unless it
+            is in the package's tier or is the default model
+    """
+    if requested_model:
+        if get_router().allows(package_name, requested_model):
+            return ModelRoute(requested_model, REQUESTED)
+        logger.info(f"Ignoring requested model {requested_model} outside the {package_name or 'default'} tier")
+    if not settings.MODEL_ROUTER_ENABLED:
+        return ModelRoute(DEFAULT_MODEL, ROUTER_DISABLED)
+    return get_router().route(package_name)
+
+
+def record_model_call(model: str, started: float, failed: bool = False):
+    """Record a completion that started at ``started`` (``time.monotonic()``)"""
+    if settings.MODEL_ROUTER_ENABLED and model:
+        get_router().record(model, time.monotonic() - started, failed)
+
+
+def get_model_stats() -> Dict:
+    return get_router().get_stats() if settings.MODEL_ROUTER_ENABLED else {}
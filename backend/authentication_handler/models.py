@@ -1,6 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
 import os
+import uuid
 
 def agent_headshot_path(instance, filename):
     """Generate upload path for agent headshots"""
@@ -74,7 +75,12 @@ class AgentProfile(models.Model):
     # Media Files
     headshot = models.ImageField(upload_to=agent_headshot_path, blank=True, null=True)
     logo = models.ImageField(upload_to=company_logo_path, blank=True, null=True)
-    
+
+    # Generated Welcome section, reused while the profile fields it was built from are unchanged
+    agent_description = models.TextField(blank=True)
+    agent_description_hash = models.CharField(max_length=64, blank=True, help_text="Hash of the profile fields the description was generated from")
+    agent_description_generated_at = models.DateTimeField(null=True, blank=True)
+
     # Meta information
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -101,6 +107,27 @@ class AgentProfile(models.Model):
         """Get human-readable experience name"""
         return self.years_experience or ''
     
+    def get_agent_description_data(self):
+        """Profile fields used to generate the agent description"""
+        return {
+            'first_name': self.user.first_name,
+            'last_name': self.user.last_name,
+            'company_name': self.company_name,
+            'years_experience': self.years_experience,
+            'specialty': self.specialty,
+            'awards': self.awards,
+            'mission': self.mission,
+            'value_proposition': self.value_proposition,
+            'selling_style': self.selling_style,
+            'shortest_sale': self.shortest_sale,
+            'highest_sale': self.highest_sale,
+            'avg_days_on_market': self.avg_days_on_market,
+            'testimonial_1': self.testimonial_1,
+            'testimonial_2': self.testimonial_2,
+            'testimonial_3': self.testimonial_3,
+            'community_ties': self.community_ties,
+        }
+    
     def mark_profile_complete(self):
         """Mark profile as completed if essential fields are filled"""
         essential_fields = [
@@ -137,6 +164,10 @@ class PropertyAnalysis(models.Model):
     # Analysis Data
     analysis_content = models.TextField(help_text="HTML content of the analysis")
     analysis_model = models.CharField(max_length=50, default='sonar')
+    model_route_reason = models.CharField(max_length=50, blank=True, default='',
+                                          help_text="Why the model router chose analysis_model")
+    prompt_version = models.CharField(max_length=20, blank=True, default='',
+                                      help_text="Version of the server-side prompt template used")
     agent_description = models.TextField(blank=True, null=True, help_text="Generated agent description")
     
     # Perplexity API Response (for reference)
@@ -149,6 +180,8 @@ class PropertyAnalysis(models.Model):
     # Meta information
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    refreshed_at = models.DateTimeField(null=True, blank=True,
+                                        help_text="Last time the time-sensitive sections were regenerated")
     
     class Meta:
         verbose_name = "Property Analysis"
@@ -219,3 +252,276 @@ class SharedAnalysisView(models.Model):
     
     def __str__(self):
         return f"View of {self.share.property_analysis.address} at {self.viewed_at}"
+
+
+class CachedPerplexityResponse(models.Model):
+    """Persistent tier of the Perplexity response cache"""
+    
+    # SHA-256 of the normalized (model, messages) request
+    cache_key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=50)
+    
+    # Cached completion
+    response = models.JSONField(help_text="Full API response from Perplexity")
+    size_bytes = models.PositiveIntegerField(default=0)
+    
+    # Usage tracking
+    hit_count = models.PositiveIntegerField(default=0)
+    last_hit_at = models.DateTimeField(null=True, blank=True)
+    
+    # Timestamps
+    created_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        verbose_name = "Cached Perplexity Response"
+        verbose_name_plural = "Cached Perplexity Responses"
+    
+    def __str__(self):
+        return f"{self.model} {self.cache_key[:12]} ({self.created_at.strftime('%Y-%m-%d %H:%M')})"
+
+
+class AnalysisBatch(models.Model):
+    """Group of analysis jobs submitted together, run at most ``concurrency`` at a time"""
+    
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='analysis_batches')
+    name = models.CharField(max_length=200, blank=True)
+    package_name = models.CharField(max_length=100, default='Professional')
+    
+    # Jobs of the batch the workers may run at once
+    concurrency = models.PositiveIntegerField(default=4)
+    total = models.PositiveIntegerField(default=0, help_text="Number of addresses in the batch")
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name = "Analysis Batch"
+        verbose_name_plural = "Analysis Batches"
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Batch {self.id} ({self.total} addresses) - {self.user.username}"
+
+
+class AnalysisJob(models.Model):
+    """Queued analysis generation, executed by the run_analysis_worker command"""
+    
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED)
+    
+    # Who requested the analysis
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='analysis_jobs')
+    
+    # Property Information
+    address = models.CharField(max_length=500, help_text="Property address")
+    package_name = models.CharField(max_length=100, default='Professional')
+    payment_intent_id = models.CharField(max_length=200, blank=True, null=True,
+                                        help_text="Stripe payment intent ID")
+    agent_description = models.TextField(blank=True, help_text="Agent description to store with the analysis")
+    
+    # Batch the job was submitted with, if any
+    batch = models.ForeignKey(AnalysisBatch, on_delete=models.CASCADE, null=True, blank=True, related_name='jobs')
+    
+    # Upstream request
+    request_payload = models.JSONField(help_text="Perplexity request body (model and messages)")
+    
+    # Execution state
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    run_after = models.DateTimeField(null=True, blank=True, help_text="Earliest time the job may be (re)tried")
+    virtual_finish = models.FloatField(default=0.0,
+                                       help_text="Weighted fair queuing tag; lower tags are claimed first")
+    worker_id = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    
+    # Result
+    property_analysis = models.ForeignKey(PropertyAnalysis, on_delete=models.SET_NULL, null=True, blank=True,
+                                          related_name='jobs')
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "Analysis Job"
+        verbose_name_plural = "Analysis Jobs"
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['status', 'virtual_finish']),
+            models.Index(fields=['virtual_finish']),
+            models.Index(fields=['batch', 'status']),
+        ]
+        constraints = [
+            # A payment pays for one generation, however often the webhook or client asks for it
+            models.UniqueConstraint(
+                fields=['payment_intent_id'],
+                condition=models.Q(payment_intent_id__isnull=False) & ~models.Q(payment_intent_id=''),
+                name='unique_analysis_job_payment_intent',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"Job {self.id} ({self.status}) - {self.address}"
+    
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED_STATUSES
+
+
+class AddressResearch(models.Model):
+    """Shareable analysis section, reused by every agent analyzing the same address"""
+    
+    # canonical_address() of the property address
+    address_key = models.CharField(max_length=255)
+    # The address as spelled by the request that generated the section
+    address = models.CharField(max_length=255, blank=True)
+    section_key = models.CharField(max_length=50)
+    model = models.CharField(max_length=50)
+    prompt_version = models.CharField(max_length=20)
+    
+    # Section HTML as generated, renumbered when spliced into a report
+    html = models.TextField()
+    citations = models.JSONField(default=list, blank=True)
+    
+    # Usage tracking
+    reuse_count = models.PositiveIntegerField(default=0)
+    
+    # Timestamps
+    generated_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        verbose_name = "Address Research"
+        verbose_name_plural = "Address Research"
+        unique_together = ['address_key', 'section_key', 'model', 'prompt_version']
+    
+    def __str__(self):
+        return f"{self.address_key} - {self.section_key} ({self.generated_at.strftime('%Y-%m-%d %H:%M')})"
+
+
+class StreamedGeneration(models.Model):
+    """Streamed Perplexity completion, saved as it arrives so a dropped client can resume it"""
+    
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CANCELLED = 'cancelled'
+    STATUS_CHOICES = [
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+        (STATUS_CANCELLED, 'Cancelled'),
+    ]
+    
+    # Id handed to the client in the first event of the stream
+    generation_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True,
+                             related_name='streamed_generations')
+    model = models.CharField(max_length=50)
+    
+    # Output received so far; clients resume from a byte offset into its UTF-8 encoding
+    content = models.TextField(blank=True)
+    content_bytes = models.PositiveIntegerField(default=0)
+    
+    # Final event of the stream
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    completion = models.JSONField(null=True, blank=True, help_text="Assembled completion once finished")
+    error = models.JSONField(null=True, blank=True, help_text="Error payload if the upstream call failed")
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(help_text="Last time output was saved")
+    read_at = models.DateTimeField(null=True, blank=True,
+                                   help_text="Last time a client tailing it from another worker read it")
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        verbose_name = "Streamed Generation"
+        verbose_name_plural = "Streamed Generations"
+    
+    def __str__(self):
+        return f"{self.generation_id} ({self.status}, {self.content_bytes} bytes)"
+
+
+class UpstreamUsage(models.Model):
+    """Tokens and cost of one upstream completion, the ledger budgets are checked against"""
+    
+    PURPOSE_ANALYSIS = 'analysis'
+    PURPOSE_AGENT_DESCRIPTION = 'agent_description'
+    PURPOSE_CHOICES = [
+        (PURPOSE_ANALYSIS, 'Analysis'),
+        (PURPOSE_AGENT_DESCRIPTION, 'Agent description'),
+    ]
+    
+    # Who the call was made for; anonymous calls only have their client key
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                             related_name='upstream_usage')
+    client_key = models.CharField(max_length=100, blank=True, help_text="Limiter key the call was counted under")
+    
+    # Call
+    upstream = models.CharField(max_length=50, default='perplexity')
+    model = models.CharField(max_length=50)
+    purpose = models.CharField(max_length=30, choices=PURPOSE_CHOICES, default=PURPOSE_ANALYSIS)
+    
+    # Usage reported by the upstream
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    total_tokens = models.PositiveIntegerField(default=0)
+    cost = models.FloatField(default=0.0, help_text="USD, as reported or estimated from USAGE_MODEL_PRICES")
+    
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    class Meta:
+        verbose_name = "Upstream Usage"
+        verbose_name_plural = "Upstream Usage"
+        indexes = [
+            models.Index(fields=['client_key', 'created_at']),
+            models.Index(fields=['user', 'created_at']),
+        ]
+    
+    def __str__(self):
+        return f"{self.model} {self.purpose}: {self.total_tokens} tokens ({self.created_at.strftime('%Y-%m-%d %H:%M')})"
+
+
+class GenerationResult(models.Model):
+    """Generated completion held server-side so the client can save it by token instead of uploading it"""
+    
+    # Handed to the client with the generation, then sent back to save_property_analysis
+    token = models.CharField(max_length=64, unique=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='generation_results')
+    
+    # What was generated
+    address = models.CharField(max_length=500, blank=True)
+    package_name = models.CharField(max_length=100, blank=True)
+    analysis_model = models.CharField(max_length=50)
+    model_route_reason = models.CharField(max_length=50, blank=True)
+    prompt_version = models.CharField(max_length=20, blank=True)
+    agent_description = models.TextField(blank=True)
+    api_response = models.JSONField(help_text="Completion as returned to the client")
+    
+    # Set once saved, so saving the same token again returns the same analysis
+    property_analysis = models.ForeignKey(PropertyAnalysis, on_delete=models.SET_NULL, null=True, blank=True,
+                                          related_name='generation_results')
+    
+    # Timestamps
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        verbose_name = "Generation Result"
+        verbose_name_plural = "Generation Results"
+    
+    def __str__(self):
+        return f"{self.token[:8]}... ({self.analysis_model}, expires {self.expires_at.strftime('%Y-%m-%d %H:%M')})"
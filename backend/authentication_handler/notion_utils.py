@@ -0,0 +1,50 @@
+from typing import Dict
+
+NOTION_VERSION = '2022-06-28'
+
+
+def build_headers(api_key: str) -> Dict:
+    """Request headers for the Notion API"""
+    return {
+        'Authorization': f'Bearer {api_key}',
+        'Notion-Version': NOTION_VERSION,
+        'Content-Type': 'application/json',
+    }
+
+
+def build_page_payload(perplexity_data: Dict, database_id: str) -> Dict:
+    """
+    Format a Perplexity result as a Notion page in the given database
+    
+    Args:
+        perplexity_data: Dict with optional ``title`` and ``content`` keys
+        database_id: Notion database the page is created in
+        
+    Returns:
+        Request body for the Notion create-page endpoint
+    """
+    # You may want to adjust the properties and content structure based on your Notion database schema
+    title = perplexity_data.get('title', 'Perplexity Result')
+    content = perplexity_data.get('content', str(perplexity_data))
+
+    return {
+        "parent": {"database_id": database_id},
+        "properties": {
+            "Name": {
+                "title": [
+                    {"text": {"content": title}}
+                ]
+            }
+        },
+        "children": [
+            {
+                "object": "block",
+                "type": "paragraph",
+                "paragraph": {
+                    "rich_text": [
+                        {"type": "text", "text": {"content": content}}
+                    ]
+                }
+            }
+        ]
+    }
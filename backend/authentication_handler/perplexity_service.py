@@ -0,0 +1,225 @@
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from django.conf import settings
+from rest_framework import status
+
+from .api_key_pool import parse_keys
+from .deadline import DeadlineExceeded, expired, remaining
+from .model_router import record_model_call
+from .response_cache import BYPASS, HIT, MISS, STALE, make_cache_key, perplexity_cache
+from .single_flight import COALESCED, cross_process_lock, perplexity_flights
+from .upstream_client import PERPLEXITY, PERPLEXITY_CHAT_URL, get_client
+from .upstream_limiter import UpstreamBusy, current_client_key
+from .usage import BudgetExceeded, record_usage
+
+logger = logging.getLogger(__name__)
+
+
+class PerplexityError(Exception):
+    """A failed Perplexity call, carrying the error payload the proxy returns"""
+
+    def __init__(self, payload: Dict, status_code: int = status.HTTP_500_INTERNAL_SERVER_ERROR,
+                 retry_after: Optional[float] = None):
+        super().__init__(payload.get('error', 'Perplexity API error'))
+        self.payload = payload
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def busy_error(error: UpstreamBusy) -> PerplexityError:
+    """503 for a call that could not get an upstream slot in time"""
+    return PerplexityError(
+        {'error': str(error), 'retry_after': round(error.retry_after, 1)},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        retry_after=error.retry_after,
+    )
+
+
+def deadline_error() -> PerplexityError:
+    """504 for a call cut short by the request's deadline"""
+    return PerplexityError(
+        {'error': 'Perplexity did not answer in time. Please try again.'},
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+
+def budget_error(error: BudgetExceeded) -> PerplexityError:
+    """429 for a call refused because a usage budget is used up"""
+    return PerplexityError(
+        {'error': str(error), 'budget': error.scope, 'retry_after': round(error.retry_after)},
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        retry_after=error.retry_after,
+    )
+
+
+def get_api_headers() -> Dict:
+    """
+    Request headers for the Perplexity API
+
+    The Perplexity client adds the Authorization header of each call from
+    its key pool.
+
+    Raises:
+        PerplexityError: If no Perplexity API key is configured
+    """
+    if not parse_keys(settings.PERPLEXITY_API_KEYS):
+        raise PerplexityError({'error': 'API key not configured.'})
+
+    return {
+        'Content-Type': 'application/json',
+        'accept': 'application/json',
+    }
+
+
+def get_content(data: Dict) -> str:
+    """Message text of a chat completion, or '' if there is none"""
+    choices = data.get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('message') or {}).get('content') or ''
+
+
+def complete(model: str, messages: List[Dict], use_cache: bool = True) -> Tuple[Dict, str]:
+    """
+    Run a chat completion through the response cache
+
+    Identical requests that arrive while one is already in flight wait for
+    its result instead of calling the upstream again.
+
+    Args:
+        model: Perplexity model name
+        messages: Chat messages
+        use_cache: Read and write the response cache
+
+    Returns:
+        (completion, cache_status) where cache_status is one of the
+        response_cache statuses or COALESCED
+
+    Raises:
+        PerplexityError: If the upstream failed and no stale entry was available
+    """
+    headers = get_api_headers()
+    use_cache = use_cache and settings.PERPLEXITY_CACHE_ENABLED
+    cache_key = make_cache_key(model, messages)
+
+    if use_cache:
+        cached = perplexity_cache.get(cache_key)
+        if cached is not None:
+            return cached, HIT
+
+    if not settings.PERPLEXITY_SINGLE_FLIGHT_ENABLED:
+        return _fetch(headers, model, messages, cache_key, use_cache)
+
+    # Identical requests already in flight in this process wait for that call
+    # instead of paying for another one
+    flight_key = f'{cache_key}:{int(use_cache)}'
+    (data, cache_status), shared = perplexity_flights.do(
+        flight_key,
+        lambda: _fetch_once(headers, model, messages, cache_key, use_cache),
+    )
+    if shared and cache_status in (MISS, BYPASS):
+        cache_status = COALESCED
+    return data, cache_status
+
+
+def _fetch_once(headers: Dict, model: str, messages: List[Dict], cache_key: str,
+                use_cache: bool) -> Tuple[Dict, str]:
+    """Fetch under the cross-process lock so other workers reuse the result"""
+    if not use_cache:
+        # Without the cache other processes could not see the result anyway
+        return _fetch(headers, model, messages, cache_key, use_cache)
+
+    timeout = settings.PERPLEXITY_SINGLE_FLIGHT_WAIT
+    left = remaining()
+    if left is not None:
+        # Past the deadline the body still runs and fails fast with a 504
+        timeout = max(0.0, min(timeout, left))
+    # Stop waiting as soon as the holder's result is cached, without waiting for its unlock
+    with cross_process_lock(cache_key, timeout, ready=lambda: perplexity_cache.has_fresh(cache_key)):
+        # Another process may have finished the same request while we waited
+        cached = perplexity_cache.get(cache_key)
+        if cached is not None:
+            return cached, HIT
+        return _fetch(headers, model, messages, cache_key, use_cache)
+
+
+def _record_discarded(model: str, resp: requests.Response, client_key: Optional[str]):
+    try:
+        usage = resp.json().get('usage')
+    except ValueError:
+        return
+    record_usage(model, usage, client_key=client_key)
+
+
+def _fetch(headers: Dict, model: str, messages: List[Dict], cache_key: str,
+           use_cache: bool) -> Tuple[Dict, str]:
+    payload = {
+        'model': model,
+        'messages': messages
+    }
+
+    started = time.monotonic()
+    try:
+        client_key = current_client_key()
+        resp = get_client(PERPLEXITY).post(
+            PERPLEXITY_CHAT_URL, headers=headers, json=payload, hedge=True,
+            # A hedged attempt that lost the race was billed all the same
+            on_discarded=lambda discarded: _record_discarded(model, discarded, client_key),
+        )
+    except UpstreamBusy as e:
+        if use_cache:
+            stale = perplexity_cache.get_stale(cache_key)
+            if stale is not None:
+                return stale, STALE
+        raise busy_error(e)
+    except DeadlineExceeded:
+        if use_cache:
+            stale = perplexity_cache.get_stale(cache_key)
+            if stale is not None:
+                return stale, STALE
+        raise deadline_error()
+    except requests.exceptions.RequestException as e:
+        record_model_call(model, started, failed=True)
+        if use_cache:
+            stale = perplexity_cache.get_stale(cache_key)
+            if stale is not None:
+                return stale, STALE
+        if expired():
+            # The timeout was cut to what was left of the request's budget
+            raise deadline_error()
+        raise PerplexityError({'error': f'Error occurred during the API call: {str(e)}'})
+
+    # Feeds the model router's per-model latency and error rate
+    record_model_call(model, started, failed=resp.status_code == 429 or resp.status_code >= 500)
+
+    # If Perplexity returns a non-200 status, include details for debugging
+    if resp.status_code != 200:
+        # Fall back to an expired cache entry while the upstream is unhealthy
+        if use_cache and (resp.status_code == 429 or resp.status_code >= 500):
+            stale = perplexity_cache.get_stale(cache_key)
+            if stale is not None:
+                return stale, STALE
+        try:
+            error_data = resp.json()
+        except Exception:
+            error_data = {'details': resp.text}
+        raise PerplexityError(
+            {'error': 'Failed to get a valid response from Perplexity API', **error_data},
+            status_code=resp.status_code,
+        )
+
+    try:
+        data = resp.json()
+    except ValueError:
+        raise PerplexityError(
+            {'error': 'Perplexity API did not return JSON data', 'content': resp.text},
+            status_code=resp.status_code,
+        )
+
+    record_usage(model, data.get('usage'))
+    if use_cache and data.get('choices'):
+        perplexity_cache.set(cache_key, model, data)
+    return data, MISS if use_cache else BYPASS
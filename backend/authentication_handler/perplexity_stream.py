@@ -0,0 +1,278 @@
+import json
+import logging
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import requests
+
+from .deadline import DeadlineExceeded, expired, reset_deadline, set_deadline_at
+from .perplexity_service import get_content
+from .upstream_client import PERPLEXITY, PERPLEXITY_CHAT_URL, get_client
+from .upstream_limiter import UpstreamBusy, reset_client_key, set_client_key
+from .usage import arecord_usage, record_usage
+
+logger = logging.getLogger(__name__)
+
+
+def format_sse(data: Dict, event: Optional[str] = None) -> bytes:
+    """Encode one server-sent event"""
+    message = ''
+    if event:
+        message += f'event: {event}\n'
+    message += f"data: {json.dumps(data, separators=(',', ':'))}\n\n"
+    return message.encode('utf-8')
+
+
+def iter_sse_data(response: requests.Response) -> Iterator[Dict]:
+    """
+    Parse the JSON payloads of an upstream ``text/event-stream`` response
+
+    Event streams are always UTF-8, whatever the Content-Type says (without a
+    charset requests would assume ISO-8859-1), so lines are split as bytes and
+    then decoded; a character split across chunks is never cut in half.
+
+    Args:
+        response: Streaming response from the upstream
+
+    Yields:
+        Decoded ``data:`` payloads, stopping at ``[DONE]``
+    """
+    for raw_line in response.iter_lines():
+        line = raw_line.decode('utf-8', 'replace')
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return
+        try:
+            yield json.loads(data)
+        except ValueError:
+            logger.warning(f"Skipping malformed Perplexity stream chunk: {data[:200]}")
+
+
+class StreamAssembler:
+    """Rebuild a regular chat completion from streamed chunks"""
+
+    def __init__(self, model: str):
+        self.model = model
+        self.id = None
+        self.created = None
+        self.parts = []
+        self.finish_reason = None
+        self.usage = {}
+        self.citations = []
+        self.search_results = []
+
+    def add(self, chunk: Dict) -> str:
+        """Record a chunk and return the text delta it carried"""
+        self.id = chunk.get('id', self.id)
+        self.created = chunk.get('created', self.created)
+        self.model = chunk.get('model', self.model)
+        # Usage and citations are repeated or only sent on later chunks
+        self.usage = chunk.get('usage') or self.usage
+        self.citations = chunk.get('citations') or self.citations
+        self.search_results = chunk.get('search_results') or self.search_results
+
+        delta = ''
+        choices = chunk.get('choices') or []
+        if choices:
+            choice = choices[0]
+            delta = (choice.get('delta') or {}).get('content') or ''
+            self.finish_reason = choice.get('finish_reason') or self.finish_reason
+        if delta:
+            self.parts.append(delta)
+        return delta
+
+    @property
+    def content(self) -> str:
+        return ''.join(self.parts)
+
+    def completion(self) -> Dict:
+        """The assembled response in the non-streaming API shape"""
+        completion = {
+            'id': self.id,
+            'model': self.model,
+            'created': self.created,
+            'object': 'chat.completion',
+            'choices': [{
+                'index': 0,
+                'finish_reason': self.finish_reason or 'stop',
+                'message': {'role': 'assistant', 'content': self.content},
+            }],
+            'usage': self.usage,
+        }
+        if self.citations:
+            completion['citations'] = self.citations
+        if self.search_results:
+            completion['search_results'] = self.search_results
+        return completion
+
+
+def iter_completion_events(headers: Dict, payload: Dict, deadline: Optional[float] = None,
+                           client_key: Optional[str] = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Stream a Perplexity completion as decoded events
+
+    Args:
+        headers: Upstream request headers including authorization
+        payload: Chat completion request body (``stream`` is forced on)
+        deadline: ``get_deadline()`` of the request the stream answers. The
+            generator runs after the request's middleware has returned, so
+            the deadline is passed along explicitly; the stream ends with a
+            504 error event when it passes.
+        client_key: ``current_client_key()`` of the request, passed along
+            for the same reason; the call and its usage are attributed to it
+
+    Yields:
+        ``('delta', text)`` per upstream chunk carrying text, then either
+        ``('done', completion)`` with the assembled completion or
+        ``('error', payload)``
+    """
+    assembler = StreamAssembler(payload.get('model'))
+    upstream_headers = dict(headers, accept='text/event-stream')
+    resp = None
+    try:
+        token = set_deadline_at(deadline) if deadline is not None else None
+        key_token = set_client_key(client_key) if client_key is not None else None
+        try:
+            resp = get_client(PERPLEXITY).post(
+                PERPLEXITY_CHAT_URL,
+                headers=upstream_headers,
+                json=dict(payload, stream=True),
+                stream=True,
+            )
+        finally:
+            if key_token is not None:
+                reset_client_key(key_token)
+            if token is not None:
+                reset_deadline(token)
+        if resp.status_code != 200:
+            try:
+                error_data = resp.json()
+            except Exception:
+                error_data = {'details': resp.text}
+            yield 'error', {
+                'error': 'Failed to get a valid response from Perplexity API',
+                'status': resp.status_code,
+                **error_data,
+            }
+            return
+
+        for chunk in iter_sse_data(resp):
+            delta = assembler.add(chunk)
+            if delta:
+                yield 'delta', delta
+            if expired(deadline):
+                raise DeadlineExceeded()
+
+        record_usage(payload.get('model'), assembler.usage, client_key=client_key)
+        yield 'done', assembler.completion()
+
+    except UpstreamBusy as e:
+        yield 'error', {'error': str(e), 'status': 503, 'retry_after': round(e.retry_after, 1)}
+    except DeadlineExceeded:
+        yield 'error', {'error': 'Perplexity did not finish in time. Please try again.', 'status': 504}
+    except requests.exceptions.RequestException as e:
+        if expired(deadline):
+            yield 'error', {'error': 'Perplexity did not finish in time. Please try again.', 'status': 504}
+            return
+        yield 'error', {'error': f'Error occurred during the API call: {str(e)}'}
+    finally:
+        # Runs when the consumer stops early too, releasing the upstream connection
+        if resp is not None:
+            resp.close()
+
+
+def stream_completion(headers: Dict, payload: Dict,
+                      on_complete: Optional[Callable[[Dict], Optional[Dict]]] = None,
+                      deadline: Optional[float] = None, client_key: Optional[str] = None) -> Iterator[bytes]:
+    """
+    Forward a Perplexity completion to the client as server-sent events
+
+    Emits one ``delta`` event per upstream chunk, then a ``done`` event
+    carrying the assembled completion (or an ``error`` event).
+
+    Args:
+        headers: Upstream request headers including authorization
+        payload: Chat completion request body (``stream`` is forced on)
+        on_complete: Called with the assembled completion once the stream ends;
+            fields of a dict it returns are added to the ``done`` event
+        deadline: ``get_deadline()`` of the request, see ``iter_completion_events``
+        client_key: ``current_client_key()`` of the request, see ``iter_completion_events``
+
+    Yields:
+        Encoded SSE messages
+    """
+    for event, data in iter_completion_events(headers, payload, deadline, client_key):
+        if event == 'delta':
+            yield format_sse({'content': data}, event='delta')
+            continue
+        if event == 'done' and on_complete is not None and get_content(data):
+            try:
+                data = dict(data, **(on_complete(data) or {}))
+            except Exception as e:
+                logger.error(f"Failed to store streamed completion: {str(e)}")
+        yield format_sse(data, event=event)
+
+
+async def astream_completion(headers: Dict, payload: Dict,
+                             on_complete: Optional[Callable[[Dict], Optional[Dict]]] = None,
+                             client_key: Optional[str] = None):
+    """
+    Async counterpart of ``stream_completion`` for the ASGI views
+
+    ``on_complete`` is a sync callable and is run in a worker thread. The
+    usage is recorded for ``client_key``.
+    """
+    import httpx
+    from asgiref.sync import sync_to_async
+
+    assembler = StreamAssembler(payload.get('model'))
+    upstream_headers = dict(headers, accept='text/event-stream')
+    try:
+        async with get_client(PERPLEXITY).astream(
+            'POST',
+            PERPLEXITY_CHAT_URL,
+            headers=upstream_headers,
+            json=dict(payload, stream=True),
+        ) as resp:
+            if resp.status_code != 200:
+                body = await resp.aread()
+                try:
+                    error_data = json.loads(body)
+                except ValueError:
+                    error_data = {'details': body.decode('utf-8', 'replace')}
+                yield format_sse({
+                    'error': 'Failed to get a valid response from Perplexity API',
+                    'status': resp.status_code,
+                    **error_data,
+                }, event='error')
+                return
+
+            async for line in resp.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                data = line[len('data:'):].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    logger.warning(f"Skipping malformed Perplexity stream chunk: {data[:200]}")
+                    continue
+                delta = assembler.add(chunk)
+                if delta:
+                    yield format_sse({'content': delta}, event='delta')
+
+        await arecord_usage(payload.get('model'), assembler.usage, client_key=client_key)
+        completion = assembler.completion()
+        if on_complete is not None and assembler.content:
+            try:
+                completion = dict(completion, **(await sync_to_async(on_complete)(completion) or {}))
+            except Exception as e:
+                logger.error(f"Failed to store streamed completion: {str(e)}")
+        yield format_sse(completion, event='done')
+
+    except UpstreamBusy as e:
+        yield format_sse({'error': str(e), 'status': 503, 'retry_after': round(e.retry_after, 1)}, event='error')
+    except httpx.HTTPError as e:
+        yield format_sse({'error': f'Error occurred during the API call: {str(e)}'}, event='error')
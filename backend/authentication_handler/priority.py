@@ -0,0 +1,54 @@
+"""
+Package-tier priorities for generation work.
+
+Each package has a weight (``ANALYSIS_PRIORITY_WEIGHTS``). Queued analysis
+jobs and calls waiting for an upstream slot are ordered by weighted fair
+queuing: every item gets a virtual finish tag of
+``max(virtual time, last tag of its package) + 1 / weight`` and the lowest
+tag goes first. A package with twice the weight gets about twice the
+throughput while both are backlogged, and lower tiers still make progress.
+"""
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from django.conf import settings
+
+# Package the current upstream call generates for, set by the views and the job runner
+_package: ContextVar[Optional[str]] = ContextVar('generation_package', default=None)
+
+_weights_cache: Dict[str, Dict[str, float]] = {}
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Parse ``Package:weight`` entries separated by commas (package names are case-insensitive)"""
+    weights = {}
+    for entry in spec.split(','):
+        package, _, weight = entry.rpartition(':')
+        try:
+            weight = float(weight)
+        except ValueError:
+            continue
+        if package.strip() and weight > 0:
+            weights[package.strip().lower()] = weight
+    return weights
+
+
+def package_weight(package_name: Optional[str]) -> float:
+    spec = settings.ANALYSIS_PRIORITY_WEIGHTS
+    weights = _weights_cache.get(spec)
+    if weights is None:
+        weights = _weights_cache[spec] = parse_weights(spec)
+    return weights.get((package_name or '').strip().lower(), settings.ANALYSIS_PRIORITY_DEFAULT_WEIGHT)
+
+
+def set_package(package_name: Optional[str]):
+    """Schedule upstream calls in this context with the package's priority"""
+    return _package.set(package_name)
+
+
+def reset_package(token):
+    _package.reset(token)
+
+
+def current_package() -> Optional[str]:
+    return _package.get()
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Cache statuses reported back to clients in the X-Cache header
+HIT = 'HIT'
+MISS = 'MISS'
+STALE = 'STALE'
+BYPASS = 'BYPASS'
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def make_cache_key(model: str, messages: List[Dict]) -> str:
+    """
+    Build a stable cache key for a Perplexity chat request
+
+    Roles are lower-cased and whitespace runs inside message content are
+    collapsed, so prompts that only differ in indentation share an entry.
+
+    Args:
+        model: Perplexity model name
+        messages: Chat messages as sent to the API
+
+    Returns:
+        Hex SHA-256 digest of the normalized request
+    """
+    normalized = []
+    for message in messages:
+        content = message.get('content', '')
+        if isinstance(content, str):
+            content = _WHITESPACE_RE.sub(' ', content).strip()
+        normalized.append({
+            'role': str(message.get('role', '')).strip().lower(),
+            'content': content,
+        })
+
+    canonical = json.dumps(
+        {'model': (model or '').strip().lower(), 'messages': normalized},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Two-tier cache for upstream completions
+
+    The first tier is an in-process LRU bounded by a byte budget. The second
+    tier is the ``CachedPerplexityResponse`` table, which is shared between
+    gunicorn workers and survives restarts. Entries older than ``ttl`` are
+    not served as hits, but stay available as stale fallbacks for
+    ``stale_ttl`` more seconds in case the upstream is down.
+    """
+
+    def __init__(self, max_bytes: int, ttl: int, stale_ttl: int, persist: bool = True):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.persist = persist
+
+        self._entries: "OrderedDict[str, Tuple[Dict, int, object]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'db_hits': 0,
+            'misses': 0,
+            'stale_served': 0,
+            'stores': 0,
+            'evictions': 0,
+        }
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _age_seconds(self, created_at) -> float:
+        return (timezone.now() - created_at).total_seconds()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return a fresh cached response, or None on a miss"""
+        entry = self._get_entry(key)
+        if entry is not None:
+            data, created_at, tier = entry
+            if self._age_seconds(created_at) <= self.ttl:
+                self._count('memory_hits' if tier == 'memory' else 'db_hits')
+                return data
+        self._count('misses')
+        return None
+
+    def has_fresh(self, key: str) -> bool:
+        """Whether a fresh response is cached, without counting a hit or miss (for polling)"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and self._age_seconds(entry[2]) <= self.ttl:
+            return True
+        if not self.persist:
+            return False
+
+        from .models import CachedPerplexityResponse
+
+        try:
+            return CachedPerplexityResponse.objects.filter(
+                cache_key=key,
+                created_at__gte=timezone.now() - timedelta(seconds=self.ttl),
+            ).exists()
+        except Exception as e:
+            logger.warning(f"Response cache DB read failed: {str(e)}")
+            return False
+
+    def get_stale(self, key: str) -> Optional[Dict]:
+        """Return an expired response that is still inside the stale window"""
+        entry = self._get_entry(key)
+        if entry is None:
+            return None
+        data, created_at, _tier = entry
+        if self._age_seconds(created_at) > self.ttl + self.stale_ttl:
+            return None
+        self._count('stale_served')
+        return data
+
+    def _get_entry(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                data, _size, created_at = entry
+                return data, created_at, 'memory'
+
+        if not self.persist:
+            return None
+
+        from .models import CachedPerplexityResponse
+
+        try:
+            row = CachedPerplexityResponse.objects.filter(cache_key=key).first()
+            if row is None:
+                return None
+            CachedPerplexityResponse.objects.filter(pk=row.pk).update(
+                hit_count=F('hit_count') + 1,
+                last_hit_at=timezone.now(),
+            )
+        except Exception as e:
+            logger.warning(f"Response cache DB read failed: {str(e)}")
+            return None
+
+        self._remember(key, row.response, row.size_bytes, row.created_at)
+        return row.response, row.created_at, 'db'
+
+    def set(self, key: str, model: str, data: Dict):
+        """Store a successful response in both tiers"""
+        size = len(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+        created_at = timezone.now()
+        self._remember(key, data, size, created_at)
+        self._count('stores')
+
+        if not self.persist:
+            return
+
+        from .models import CachedPerplexityResponse
+
+        try:
+            CachedPerplexityResponse.objects.update_or_create(
+                cache_key=key,
+                defaults={
+                    'model': model,
+                    'response': data,
+                    'size_bytes': size,
+                    'created_at': created_at,
+                },
+            )
+        except Exception as e:
+            logger.warning(f"Response cache DB write failed: {str(e)}")
+
+    def _remember(self, key: str, data: Dict, size: int, created_at):
+        """Insert into the in-process LRU, evicting until under budget"""
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (data, size, created_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _key, (_data, evicted_size, _created) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._counters['evictions'] += 1
+
+    def purge(self, expired_only: bool = True) -> int:
+        """
+        Remove entries from both tiers
+
+        Args:
+            expired_only: Only drop entries past the TTL and stale window
+
+        Returns:
+            Number of persistent rows deleted
+        """
+        from .models import CachedPerplexityResponse
+
+        with self._lock:
+            if expired_only:
+                cutoff_age = self.ttl + self.stale_ttl
+                for key in [k for k, (_d, _s, created_at) in self._entries.items()
+                            if self._age_seconds(created_at) > cutoff_age]:
+                    _data, size, _created = self._entries.pop(key)
+                    self._bytes -= size
+            else:
+                self._entries.clear()
+                self._bytes = 0
+
+        rows = CachedPerplexityResponse.objects.all()
+        if expired_only:
+            cutoff = timezone.now() - timedelta(seconds=self.ttl + self.stale_ttl)
+            rows = rows.filter(created_at__lt=cutoff)
+        deleted, _ = rows.delete()
+        return deleted
+
+    def get_stats(self) -> Dict:
+        """Counters and occupancy for sizing the cache"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        hits = stats['memory_hits'] + stats['db_hits']
+        lookups = hits + stats['misses']
+        stats['hit_ratio'] = round(hits / lookups, 3) if lookups else 0.0
+        stats['max_bytes'] = self.max_bytes
+        stats['ttl'] = self.ttl
+        stats['stale_ttl'] = self.stale_ttl
+        return stats
+
+
+perplexity_cache = ResponseCache(
+    max_bytes=settings.PERPLEXITY_CACHE_MAX_BYTES,
+    ttl=settings.PERPLEXITY_CACHE_TTL,
+    stale_ttl=settings.PERPLEXITY_CACHE_STALE_TTL,
+    persist=settings.PERPLEXITY_CACHE_PERSIST,
+)
@@ -0,0 +1,367 @@
+"""
+Resumable streamed generations.
+
+A streamed Perplexity completion is read from the upstream on a background
+thread and saved under a generation id as it arrives, so the upstream call
+(and what it cost) survives the client disconnecting. A client that
+reconnects resumes from the last ``offset`` it received: output stored after
+that offset is replayed and the rest is forwarded live.
+
+Offsets are byte offsets into the UTF-8 encoded output. Streams tailed in
+the process that runs the generation are fed from memory; other workers
+poll the database row, which is updated every
+``STREAM_GENERATION_FLUSH_INTERVAL`` seconds.
+
+A tail ends at its request's deadline without a final event, and the client
+resumes it on a new request. A generation nobody has tailed for
+``STREAM_GENERATION_ABANDON_AFTER`` seconds is cancelled, closing the
+upstream call.
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import timedelta
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .deadline import clear_deadline, expired, remaining
+from .models import StreamedGeneration
+from .perplexity_service import get_content
+from .perplexity_stream import format_sse, iter_completion_events
+
+logger = logging.getLogger(__name__)
+
+# SSE comment sent while waiting, so proxies keep an idle stream open
+KEEPALIVE = b': keepalive\n\n'
+
+
+class LiveGeneration:
+    """In-memory output of a generation running in this process"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.final = None
+        self.listeners = 0
+        self.detached_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def attach(self):
+        with self._cond:
+            self.listeners += 1
+
+    def detach(self):
+        with self._cond:
+            self.listeners -= 1
+            self.detached_at = time.monotonic()
+
+    def unattended_for(self) -> float:
+        """Seconds since the last tail in this process went away, 0 while one is attached"""
+        with self._cond:
+            return 0.0 if self.listeners else time.monotonic() - self.detached_at
+
+    def append(self, delta: str):
+        with self._cond:
+            self.buffer += delta.encode('utf-8')
+            self._cond.notify_all()
+
+    def finish(self, event: str, data: Dict):
+        with self._cond:
+            self.final = (event, data)
+            self._cond.notify_all()
+
+    def text(self) -> Tuple[str, int]:
+        with self._cond:
+            return self.buffer.decode('utf-8'), len(self.buffer)
+
+    def read(self, offset: int, wait: float = 0) -> Tuple[bytes, Optional[Tuple[str, Dict]]]:
+        """
+        Output after ``offset``, waiting up to ``wait`` seconds for some
+
+        Returns:
+            (new output, final event) - the final event is None while running
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.buffer) > offset or self.final is not None, timeout=wait)
+            return bytes(self.buffer[offset:]), self.final
+
+
+_live: Dict[str, LiveGeneration] = {}
+_live_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _live_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, settings.STREAM_GENERATION_WORKERS),
+                thread_name_prefix='stream-generation',
+            )
+    return _executor
+
+
+def _get_live(generation_id: str) -> Optional[LiveGeneration]:
+    with _live_lock:
+        return _live.get(generation_id)
+
+
+def start_generation(headers: Dict, payload: Dict, user=None,
+                     on_complete: Optional[Callable[[Dict], Optional[Dict]]] = None) -> StreamedGeneration:
+    """
+    Start streaming a completion from the upstream in the background
+
+    Args:
+        headers: Upstream request headers including authorization
+        payload: Chat completion request body
+        user: The signed-in user starting it, the only one allowed to resume it
+        on_complete: Called with the assembled completion once the stream ends;
+            fields of a dict it returns are added to the final ``done`` event
+
+    Returns:
+        The StreamedGeneration row; tail it with ``tail_generation``
+    """
+    generation = StreamedGeneration.objects.create(
+        user=user,
+        model=payload.get('model') or '',
+        updated_at=timezone.now(),
+    )
+    generation_id = str(generation.generation_id)
+    live = LiveGeneration()
+    with _live_lock:
+        _live[generation_id] = live
+    # The copied context keeps upstream calls attributed to the requesting client
+    _get_executor().submit(copy_context().run, _produce, generation.pk, generation_id, live,
+                           headers, payload, on_complete)
+    return generation
+
+
+def _produce(pk: int, generation_id: str, live: LiveGeneration, headers: Dict, payload: Dict,
+             on_complete: Optional[Callable[[Dict], Optional[Dict]]]):
+    """Read the upstream stream to the end, unless every client has gone for good"""
+    # The generation outlives the request that started it
+    clear_deadline()
+    final = ('error', {'error': 'Generation ended unexpectedly'})
+    last_flush = time.monotonic()
+    events = iter_completion_events(headers, payload)
+    try:
+        for event, data in events:
+            if event == 'delta':
+                live.append(data)
+                if time.monotonic() - last_flush >= settings.STREAM_GENERATION_FLUSH_INTERVAL:
+                    _save_progress(pk, live)
+                    last_flush = time.monotonic()
+                    if _abandoned(pk, live):
+                        logger.info(f"Cancelling streamed generation {generation_id}: no client is reading it")
+                        final = ('cancelled', {'error': 'Generation was cancelled because no client was reading it.'})
+                        break
+                continue
+            if event == 'done' and on_complete is not None and get_content(data):
+                try:
+                    data = dict(data, **(on_complete(data) or {}))
+                except Exception as e:
+                    logger.error(f"Failed to store streamed completion: {str(e)}")
+            final = (event, data)
+    except Exception as e:
+        logger.error(f"Streamed generation {generation_id} failed: {str(e)}")
+        final = ('error', {'error': f'Error occurred during the API call: {str(e)}'})
+    finally:
+        # Closes the upstream response if the stream was cut short
+        events.close()
+        _save_final(pk, live, final)
+        live.finish('error' if final[0] == 'cancelled' else final[0], final[1])
+        with _live_lock:
+            _live.pop(generation_id, None)
+        connection.close()
+
+
+def _abandoned(pk: int, live: LiveGeneration) -> bool:
+    """No tail here or in another worker for STREAM_GENERATION_ABANDON_AFTER seconds"""
+    abandon_after = settings.STREAM_GENERATION_ABANDON_AFTER
+    if not abandon_after or live.unattended_for() < abandon_after:
+        return False
+    cutoff = timezone.now() - timedelta(seconds=abandon_after)
+    try:
+        read_at = StreamedGeneration.objects.filter(pk=pk).values_list('read_at', flat=True).first()
+    except Exception:
+        return False
+    return read_at is None or read_at < cutoff
+
+
+def _save_progress(pk: int, live: LiveGeneration):
+    content, content_bytes = live.text()
+    try:
+        StreamedGeneration.objects.filter(pk=pk).update(
+            content=content, content_bytes=content_bytes, updated_at=timezone.now(),
+        )
+    except Exception as e:
+        # Live listeners are unaffected; only resuming from another worker lags behind
+        logger.warning(f"Saving streamed generation {pk} failed: {str(e)}")
+
+
+def _save_final(pk: int, live: LiveGeneration, final: Tuple[str, Dict]):
+    event, data = final
+    content, content_bytes = live.text()
+    now = timezone.now()
+    statuses = {'done': StreamedGeneration.STATUS_COMPLETED, 'cancelled': StreamedGeneration.STATUS_CANCELLED}
+    try:
+        StreamedGeneration.objects.filter(pk=pk).update(
+            content=content,
+            content_bytes=content_bytes,
+            status=statuses.get(event, StreamedGeneration.STATUS_FAILED),
+            completion=data if event == 'done' else None,
+            error=data if event != 'done' else None,
+            updated_at=now,
+            finished_at=now,
+        )
+    except Exception as e:
+        logger.error(f"Saving finished generation {pk} failed: {str(e)}")
+
+
+def _char_boundary(data: bytes, offset: int) -> int:
+    """Move an offset back to the start of the UTF-8 character it falls in"""
+    # Offsets past the saved output are kept: another worker may not have flushed it yet
+    offset = max(0, offset)
+    while 0 < offset < len(data) and data[offset] & 0xC0 == 0x80:
+        offset -= 1
+    return offset
+
+
+def _read_stored(generation_id: str, offset: int) -> Tuple[bytes, Optional[Tuple[str, Dict]]]:
+    """Output after ``offset`` from the database, for generations running in another process"""
+    generation = StreamedGeneration.objects.get(generation_id=generation_id)
+    data = generation.content.encode('utf-8')
+    if generation.status == StreamedGeneration.STATUS_COMPLETED:
+        return data[offset:], ('done', generation.completion)
+    if generation.status in (StreamedGeneration.STATUS_FAILED, StreamedGeneration.STATUS_CANCELLED):
+        return data[offset:], ('error', generation.error or {'error': 'Generation failed'})
+    now = timezone.now()
+    stale_after = now - timedelta(seconds=settings.STREAM_GENERATION_STALE_SECONDS)
+    if generation.updated_at < stale_after:
+        # The worker running it died without recording a result
+        return data[offset:], ('error', {'error': 'Generation was interrupted. Please start a new one.'})
+    # Tells the worker running it that a client is still reading
+    StreamedGeneration.objects.filter(pk=generation.pk).update(read_at=now)
+    return data[offset:], None
+
+
+def _events(data: bytes, offset: int, final: Optional[Tuple[str, Dict]]) -> Tuple[bytes, int]:
+    """Encode new output and the final event, returning the next offset"""
+    message = b''
+    if data:
+        offset += len(data)
+        message += format_sse({'content': data.decode('utf-8'), 'offset': offset}, event='delta')
+    if final is not None:
+        message += format_sse(final[1], event=final[0])
+    return message, offset
+
+
+def _first_event(generation_id: str, offset: int) -> bytes:
+    return format_sse({'generation_id': generation_id, 'offset': offset}, event='generation')
+
+
+def _start_offset(generation_id: str, offset: int) -> int:
+    live = _get_live(generation_id)
+    if live is not None:
+        data = live.read(0)[0]
+    else:
+        data = StreamedGeneration.objects.get(generation_id=generation_id).content.encode('utf-8')
+    return _char_boundary(data, offset)
+
+
+def tail_generation(generation_id, offset: int = 0, deadline: Optional[float] = None) -> Iterator[bytes]:
+    """
+    Stream a generation to a client as server-sent events
+
+    Emits a ``generation`` event with the id and starting offset, ``delta``
+    events carrying the output and the offset after it, then the ``done``
+    (or ``error``) event. Closing the stream does not stop the generation
+    right away; it is cancelled once no client has read it for a while.
+
+    Args:
+        generation_id: StreamedGeneration.generation_id
+        offset: Byte offset of the output the client already has
+        deadline: ``get_deadline()`` of the request; the stream ends there
+            without a final event and the client resumes it
+
+    Yields:
+        Encoded SSE messages
+    """
+    generation_id = str(generation_id)
+    offset = _start_offset(generation_id, offset)
+    yield _first_event(generation_id, offset)
+    live = _get_live(generation_id)
+    if live is not None:
+        live.attach()
+    try:
+        while not expired(deadline):
+            if live is not None:
+                wait = settings.STREAM_GENERATION_KEEPALIVE
+                left = remaining(deadline)
+                if left is not None:
+                    wait = max(0.0, min(wait, left))
+                data, final = live.read(offset, wait=wait)
+            else:
+                data, final = _read_stored(generation_id, offset)
+            message, offset = _events(data, offset, final)
+            if final is not None:
+                yield message
+                return
+            yield message or KEEPALIVE
+            if live is None:
+                time.sleep(settings.STREAM_GENERATION_POLL_INTERVAL)
+    finally:
+        # Also runs when the client disconnects and the server closes the stream
+        if live is not None:
+            live.detach()
+
+
+async def atail_generation(generation_id, offset: int = 0):
+    """Async counterpart of ``tail_generation`` for the ASGI views"""
+    from asgiref.sync import sync_to_async
+
+    generation_id = str(generation_id)
+    offset = await sync_to_async(_start_offset)(generation_id, offset)
+    yield _first_event(generation_id, offset)
+    waited = 0.0
+    live = _get_live(generation_id)
+    if live is not None:
+        live.attach()
+    try:
+        while True:
+            if live is not None:
+                # Never blocks: the buffer is only locked while it is appended to
+                data, final = live.read(offset)
+                interval = settings.STREAM_GENERATION_LIVE_POLL_INTERVAL
+            else:
+                data, final = await sync_to_async(_read_stored)(generation_id, offset)
+                interval = settings.STREAM_GENERATION_POLL_INTERVAL
+            message, offset = _events(data, offset, final)
+            if final is not None:
+                yield message
+                return
+            if message:
+                waited = 0.0
+                yield message
+            elif waited >= settings.STREAM_GENERATION_KEEPALIVE:
+                waited = 0.0
+                yield KEEPALIVE
+            await asyncio.sleep(interval)
+            waited += interval
+    finally:
+        # A disconnect cancels the stream, which lands here
+        if live is not None:
+            live.detach()
+
+
+def purge_generations() -> int:
+    """Delete finished or abandoned generations older than the retention window"""
+    cutoff = timezone.now() - timedelta(seconds=settings.STREAM_GENERATION_RETENTION)
+    deleted, _ = StreamedGeneration.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
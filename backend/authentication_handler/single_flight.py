@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from django.db import connection
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Reported in X-Cache when a request was answered by another caller's upstream call
+COALESCED = 'COALESCED'
+
+_LOCK_POLL_INTERVAL = 0.1
+
+
+class _Call:
+    """One in-flight call that later callers can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key into one execution
+
+    The first caller for a key runs the function; callers that arrive while
+    it is running block until it finishes and receive the same result (or
+    the same exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self._stats = {'leaders': 0, 'coalesced': 0, 'cancelled': 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Run ``fn`` once per key at a time
+
+        Args:
+            key: Identity of the call
+            fn: Zero-argument callable doing the actual work
+
+        Returns:
+            (result, shared) where shared is True if another caller ran ``fn``
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self._stats['leaders'] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Async counterpart of ``do`` for callers on the same event loop
+
+        The call runs as its own task, so a caller that disconnects does not
+        cancel it for the others still waiting. It is cancelled when the
+        last caller waiting for it is.
+        """
+        loop = asyncio.get_running_loop()
+        task_key = (id(loop), key)
+        with self._lock:
+            task = self._tasks.get(task_key)
+            shared = task is not None
+            if shared:
+                self._stats['coalesced'] += 1
+            else:
+                task = loop.create_task(fn())
+                self._tasks[task_key] = task
+                self._stats['leaders'] += 1
+            self._waiters[task] = self._waiters.get(task, 0) + 1
+
+        if not shared:
+            task.add_done_callback(lambda _task: self._forget_task(task_key, _task))
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # The client went away; stop the upstream call if nobody else wants it
+            if self._leave(task) == 0 and not task.done():
+                task.cancel()
+                with self._lock:
+                    self._stats['cancelled'] += 1
+            raise
+        except Exception:
+            self._leave(task)
+            raise
+        self._leave(task)
+        return result, shared
+
+    def _leave(self, task: asyncio.Task) -> int:
+        """Drop one waiter of ``task``, returning how many are left"""
+        with self._lock:
+            waiters = self._waiters.get(task, 1) - 1
+            if waiters > 0:
+                self._waiters[task] = waiters
+            else:
+                self._waiters.pop(task, None)
+            return waiters
+
+    def _forget_task(self, task_key: Tuple[int, str], task: asyncio.Task):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls) + len(self._tasks)
+        return stats
+
+
+def _advisory_lock_id(key: str) -> int:
+    """Map a key onto the signed 64-bit id space of pg_advisory_lock"""
+    return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+
+@contextmanager
+def cross_process_lock(key: str, timeout: float, ready: Optional[Callable[[], bool]] = None):
+    """
+    Serialize work on ``key`` across worker processes and nodes
+
+    Uses a PostgreSQL session advisory lock when the default database is
+    PostgreSQL, and an flock()ed file in the temp directory otherwise (which
+    only covers processes on the same host). Neither blocks: the lock is
+    polled with try-locks, so waiters never sit in the database. If it cannot
+    be taken within ``timeout`` seconds the body runs anyway, so a slow or
+    stuck holder only delays the others by ``timeout``.
+
+    Args:
+        key: Identity of the work
+        timeout: Longest wait for the lock, in seconds
+        ready: Polled while waiting; returning True (e.g. once the holder's
+            result is in the cache) ends the wait without the lock
+
+    Yields:
+        True if the lock was acquired
+    """
+    if connection.vendor == 'postgresql':
+        lock_id = _advisory_lock_id(key)
+        acquired = _wait_for(lambda: _pg_try_lock(lock_id), timeout, ready)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [lock_id])
+        return
+
+    if fcntl is None:
+        yield False
+        return
+
+    path = os.path.join(tempfile.gettempdir(), f'real_estate_flight_{key[:32]}.lock')
+    with open(path, 'a') as lock_file:
+        acquired = _wait_for(lambda: _flock(lock_file), timeout, ready)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _pg_try_lock(lock_id: int) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [lock_id])
+        return bool(cursor.fetchone()[0])
+
+
+def _flock(lock_file) -> bool:
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _wait_for(try_acquire: Callable[[], bool], timeout: float,
+              ready: Optional[Callable[[], bool]] = None) -> bool:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if try_acquire():
+                return True
+            if ready is not None and ready():
+                return False
+        except Exception as e:
+            logger.warning(f"Single-flight lock unavailable, continuing without it: {str(e)}")
+            return False
+        if time.monotonic() >= deadline:
+            logger.warning("Timed out waiting for single-flight lock, continuing without it")
+            return False
+        time.sleep(_LOCK_POLL_INTERVAL)
+
+
+# Shared by the proxy view and the analysis worker
+perplexity_flights = SingleFlight()
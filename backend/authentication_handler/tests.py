@@ -1,3 +1,1433 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from email.utils import formatdate
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import async_views
+from . import agent_description_generator as descriptions
+from .address_research import canonical_address, load_research, store_research
+from .analysis_generator import AnalysisResult, SectionResult, generate_sections
+from .analysis_prompts import SECTION_KEYS, SHARED_SECTION_KEYS, TIME_SENSITIVE_SECTION_KEYS
+from .analysis_refresh import refresh_analysis
+from .api_key_pool import ApiKeyPool, parse_keys
+from .circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+from .generation_results import store_result
+from .html_normalizer import normalize_analysis_html
+from .jobs import (
+    await_job, claim_next_job, parse_batch_addresses, requeue_stale_jobs, serialize_batch, submit_analysis_batch,
+    submit_analysis_job, submit_paid_analysis_job, work_loop,
+)
+from .model_router import (
+    BUDGET_DOWNGRADE, FALLBACK_ERRORS, FALLBACK_LATENCY, PRIMARY, REQUESTED, ModelRoute, ModelRouter, choose_model,
+)
+from .models import AgentProfile, AnalysisJob, PropertyAnalysis, StreamedGeneration
+from .perplexity_service import PerplexityError, complete
+from .perplexity_stream import StreamAssembler, iter_sse_data, stream_completion
+from .response_cache import HIT, MISS, STALE, ResponseCache, make_cache_key, perplexity_cache
+from .resumable_stream import LiveGeneration, _abandoned
+from .single_flight import SingleFlight, cross_process_lock
+from .upstream_client import UpstreamClient
+from .upstream_limiter import (
+    AdaptiveLimiter, UpstreamBusy, current_client_key, parse_retry_after, reset_client_key, set_client_key,
+)
+from .usage import CLIENT, BudgetExceeded, apply_budget, check_budget, record_usage
+
+
+class ClaimNextJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+
+    def _job(self, address, virtual_finish=0.0, **fields):
+        job = submit_analysis_job(self.user, address, 'Professional', 'sonar')
+        AnalysisJob.objects.filter(pk=job.pk).update(virtual_finish=virtual_finish, **fields)
+        return job
+
+    def test_claims_lowest_tag_first(self):
+        later = self._job('2 Oak Ave', virtual_finish=2.0)
+        first = self._job('1 Main St', virtual_finish=1.0)
+
+        claimed = claim_next_job('worker-a')
+
+        self.assertEqual(claimed.pk, first.pk)
+        self.assertEqual(claimed.status, AnalysisJob.STATUS_RUNNING)
+        self.assertEqual(claimed.worker_id, 'worker-a')
+        self.assertEqual(claim_next_job('worker-b').pk, later.pk)
+
+    def test_job_is_claimed_once(self):
+        job = self._job('1 Main St')
+
+        self.assertEqual(claim_next_job('worker-a').pk, job.pk)
+        self.assertIsNone(claim_next_job('worker-b'))
+        job.refresh_from_db()
+        self.assertEqual(job.worker_id, 'worker-a')
+
+    def test_skips_jobs_deferred_to_later(self):
+        self._job('1 Main St', run_after=timezone.now() + timedelta(minutes=5))
+
+        self.assertIsNone(claim_next_job('worker-a'))
+
+    @override_settings(ANALYSIS_JOB_STALE_SECONDS=60)
+    def test_stale_jobs_are_requeued_until_attempts_run_out(self):
+        started_at = timezone.now() - timedelta(minutes=5)
+        retried = self._job('1 Main St', status=AnalysisJob.STATUS_RUNNING, started_at=started_at,
+                            attempts=0, max_attempts=3)
+        exhausted = self._job('2 Oak Ave', status=AnalysisJob.STATUS_RUNNING, started_at=started_at,
+                              attempts=2, max_attempts=3)
+
+        self.assertEqual(requeue_stale_jobs(), 1)
+        retried.refresh_from_db()
+        exhausted.refresh_from_db()
+        self.assertEqual((retried.status, retried.attempts), (AnalysisJob.STATUS_QUEUED, 1))
+        self.assertEqual((exhausted.status, exhausted.attempts), (AnalysisJob.STATUS_FAILED, 3))
+
+    @override_settings(ANALYSIS_JOB_STALE_SECONDS=60, ANALYSIS_JOB_REQUEUE_INTERVAL=0)
+    def test_running_worker_recovers_a_job_abandoned_by_a_dead_one(self):
+        job = self._job('1 Main St')
+        claim_next_job('dead-worker')
+        AnalysisJob.objects.filter(pk=job.pk).update(started_at=timezone.now() - timedelta(minutes=5))
+        stop_event = threading.Event()
+        ran = []
+
+        def run_job(claimed):
+            ran.append((claimed.pk, claimed.worker_id))
+            stop_event.set()
+
+        # The test transaction would be dropped by the per-iteration connection cleanup
+        with mock.patch('authentication_handler.jobs.run_job', side_effect=run_job), \
+                mock.patch('authentication_handler.jobs.close_old_connections'):
+            work_loop(stop_event, poll_interval=0, worker_id='live-worker')
+
+        self.assertEqual(ran, [(job.pk, 'live-worker')])
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 1)
+
+
+@override_settings(ANALYSIS_JOB_CLIENT_POLL_INTERVAL=3, ANALYSIS_JOB_POLL_INTERVAL=0.01)
+class WaitAnalysisJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        self.job = submit_analysis_job(self.user, '1 Main St', 'Professional', 'sonar')
+
+    def test_sync_view_answers_at_once_with_a_retry_hint(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.get(f'/api/auth/jobs/{self.job.pk}/wait/?timeout=25')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], AnalysisJob.STATUS_QUEUED)
+        self.assertEqual(response['Retry-After'], '3')
+
+    async def test_await_job_returns_when_the_timeout_passes(self):
+        job = await await_job(self.job.pk, self.user, timeout=0.05)
+
+        self.assertEqual(job.status, AnalysisJob.STATUS_QUEUED)
+
+    async def test_await_job_hides_other_users_jobs(self):
+        other = await User.objects.acreate(username='other')
+
+        self.assertIsNone(await await_job(self.job.pk, other, timeout=0))
+
+
+@override_settings(GENERATION_RESULTS_ENABLED=True)
+class TakeOverPaidJobTests(TestCase):
+    completion = {'model': 'sonar-pro', 'choices': [{'message': {'content': '<p>Report</p>'}}]}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.job, _created = submit_paid_analysis_job(self.user, 'pi_123', '1 Main St', 'Premium')
+
+    def _take_over(self):
+        return self.client.post(f'/api/auth/jobs/{self.job.pk}/take-over/')
+
+    def test_taken_over_job_is_not_claimed_by_workers(self):
+        response = self._take_over()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], AnalysisJob.STATUS_RUNNING)
+        self.assertIsNone(claim_next_job('worker-a'))
+        self.assertEqual(self._take_over().status_code, 409)
+
+    def test_job_a_worker_claimed_is_not_taken_over(self):
+        claim_next_job('worker-a')
+
+        response = self._take_over()
+
+        self.assertEqual(response.status_code, 409)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.worker_id, 'worker-a')
+
+    def test_inline_save_settles_the_taken_over_job(self):
+        self._take_over()
+        token = store_result(self.user, self.completion, 'sonar-pro', address='1 Main St')
+
+        saved = self.client.post('/api/auth/analyses/save/', {'result_token': token, 'payment_intent_id': 'pi_123'},
+                                 format='json')
+
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, AnalysisJob.STATUS_SUCCEEDED)
+        self.assertEqual(self.job.property_analysis_id, saved.json()['analysis_id'])
+
+    def test_other_users_jobs_are_not_found(self):
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(username='other', password='secret'))
+
+        self.assertEqual(other.post(f'/api/auth/jobs/{self.job.pk}/take-over/').status_code, 404)
+
+
+class GenerationOptionsTests(TestCase):
+    endpoints = (
+        ('/api/auth/analyses/generate/', {'address': '1 Main St'}),
+        ('/api/auth/jobs/', {'address': '1 Main St'}),
+        ('/api/auth/batches/', {'addresses': ['1 Main St']}),
+    )
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_options_that_are_not_an_object_are_rejected(self):
+        for url, body in self.endpoints:
+            for options in ('fast', ['single'], '["single"]', 3):
+                with self.subTest(url=url, options=options):
+                    response = self.client.post(url, {**body, 'options': options}, format='json')
+
+                    self.assertEqual(response.status_code, 400)
+                    self.assertEqual(response.json()['error'], 'Field "options" must be a JSON object.')
+
+    def test_unknown_mode_is_rejected(self):
+        for url, body in self.endpoints:
+            with self.subTest(url=url):
+                response = self.client.post(url, {**body, 'options': {'mode': 'fastest'}}, format='json')
+
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Option "mode"', response.json()['error'])
+
+    def test_valid_options_queue_the_job(self):
+        response = self.client.post('/api/auth/jobs/', {'address': '1 Main St', 'options': '{"mode": "single"}'},
+                                    format='json')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(AnalysisJob.objects.get().request_payload.get('mode'), 'single')
+
+
+@override_settings(
+    USAGE_TRACKING_ENABLED=True,
+    USAGE_CLIENT_TOKEN_BUDGET=1000,
+    USAGE_CLIENT_COST_BUDGET=0,
+    USAGE_GLOBAL_TOKEN_BUDGET=0,
+    USAGE_GLOBAL_COST_BUDGET=0,
+    USAGE_BUDGET_DOWNGRADE_AT=0.8,
+    USAGE_BUDGET_DOWNGRADE_MODEL='sonar',
+)
+class BudgetTests(TestCase):
+    client_key = 'ip:203.0.113.7'
+    route = ModelRoute('sonar-pro', 'package_tier')
+
+    def _use(self, tokens):
+        record_usage('sonar-pro', {'total_tokens': tokens}, client_key=self.client_key)
+
+    def test_route_is_kept_under_the_downgrade_threshold(self):
+        self._use(500)
+
+        self.assertAlmostEqual(check_budget(self.client_key), 0.5)
+        self.assertEqual(apply_budget(self.route, self.client_key), self.route)
+
+    def test_route_is_downgraded_near_the_budget(self):
+        self._use(850)
+
+        self.assertEqual(apply_budget(self.route, self.client_key), ModelRoute('sonar', BUDGET_DOWNGRADE))
+
+    def test_used_up_budget_is_rejected(self):
+        self._use(1000)
+
+        with self.assertRaises(BudgetExceeded) as raised:
+            apply_budget(self.route, self.client_key)
+        self.assertEqual(raised.exception.scope, CLIENT)
+        self.assertGreaterEqual(raised.exception.retry_after, 60)
+
+    def test_other_clients_are_not_counted(self):
+        self._use(1000)
+
+        self.assertEqual(check_budget('ip:198.51.100.1'), 0.0)
+
+
+class ModelRouterTests(TestCase):
+    def _router(self, **options):
+        return ModelRouter(**{
+            'tiers': {'pro': ('sonar-pro', 'sonar')}, 'default_model': 'sonar', 'latency_slo': 10,
+            'max_error_rate': 0.5, 'min_calls': 2, 'window': 60, 'fallback_seconds': 60, **options,
+        })
+
+    def test_falls_back_while_the_primary_is_slow(self):
+        router = self._router()
+        router.record('sonar-pro', 20, failed=False)
+        router.record('sonar-pro', 20, failed=False)
+
+        self.assertEqual(router.route('Pro'), ModelRoute('sonar', FALLBACK_LATENCY))
+        self.assertEqual(router.route('Pro'), ModelRoute('sonar', FALLBACK_LATENCY))
+
+    def test_falls_back_on_errors_then_retries_the_primary(self):
+        router = self._router(fallback_seconds=0)
+        router.record('sonar-pro', 1, failed=True)
+        router.record('sonar-pro', 1, failed=True)
+
+        self.assertEqual(router.route('Pro'), ModelRoute('sonar', FALLBACK_ERRORS))
+        self.assertEqual(router.route('Pro'), ModelRoute('sonar-pro', PRIMARY))
+
+    def test_requested_model_must_be_in_the_package_tier(self):
+        self.assertEqual(choose_model('Pro', 'sonar-pro'), ModelRoute('sonar-pro', REQUESTED))
+        self.assertEqual(choose_model('Starter', 'sonar'), ModelRoute('sonar', REQUESTED))
+        self.assertEqual(choose_model('Starter', 'sonar-pro').model, 'sonar')
+        self.assertEqual(choose_model(None, 'sonar-reasoning-pro').model, 'sonar')
+
+    @override_settings(PERPLEXITY_CACHE_ENABLED=False, PERPLEXITY_API_KEYS='pplx-test')
+    def test_anonymous_proxy_calls_cannot_pick_an_expensive_model(self):
+        completion = {'model': 'sonar', 'choices': [{'message': {'content': 'Hi'}}]}
+        with mock.patch('authentication_handler.views.complete', return_value=(completion, 'BYPASS')) as complete:
+            response = APIClient().post('/api/auth/perplexity/', {
+                'messages': [{'role': 'user', 'content': 'Hi'}], 'model': 'sonar-reasoning-pro',
+            }, format='json')
+
+        self.assertEqual(complete.call_args.args[0], 'sonar')
+        self.assertTrue(response['X-Model-Route'].startswith('sonar;'))
+
+
+class ClientKeyTests(TestCase):
+    def _key(self, request):
+        token = set_client_key(request)
+        try:
+            return current_client_key()
+        finally:
+            reset_client_key(token)
+
+    def _request(self, forwarded_for):
+        return RequestFactory().get('/', HTTP_X_FORWARDED_FOR=forwarded_for, REMOTE_ADDR='10.0.0.1')
+
+    @override_settings(TRUSTED_PROXY_COUNT=0)
+    def test_forwarded_for_is_ignored_without_trusted_proxies(self):
+        self.assertEqual(self._key(self._request('198.51.100.9')), 'ip:10.0.0.1')
+
+    @override_settings(TRUSTED_PROXY_COUNT=1)
+    def test_hop_appended_by_the_trusted_proxy_is_used(self):
+        self.assertEqual(self._key(self._request('198.51.100.9, 203.0.113.7')), 'ip:203.0.113.7')
+        self.assertEqual(self._key(self._request('')), 'ip:10.0.0.1')
+
+    @override_settings(TRUSTED_PROXY_COUNT=1)
+    def test_signed_in_users_are_keyed_by_id(self):
+        user = User.objects.create_user(username='agent', password='secret')
+        request = self._request('198.51.100.9')
+        request.user = user
+
+        self.assertEqual(self._key(request), f'user:{user.pk}')
+
+    @override_settings(
+        TRUSTED_PROXY_COUNT=1,
+        PERPLEXITY_API_KEYS='pplx-test',
+        USAGE_TRACKING_ENABLED=True,
+        USAGE_CLIENT_TOKEN_BUDGET=1000,
+        USAGE_GLOBAL_TOKEN_BUDGET=0,
+        USAGE_GLOBAL_COST_BUDGET=0,
+    )
+    def test_rotating_forwarded_for_does_not_reset_the_budget(self):
+        record_usage('sonar', {'total_tokens': 1000}, client_key='ip:203.0.113.7')
+
+        for spoofed in ('198.51.100.1', '198.51.100.2'):
+            response = APIClient().post(
+                '/api/auth/perplexity/', {'messages': [{'role': 'user', 'content': 'hi'}]}, format='json',
+                HTTP_X_FORWARDED_FOR=f'{spoofed}, 203.0.113.7',
+            )
+
+            self.assertEqual(response.status_code, 429)
+
+
+class AdaptiveLimiterTests(TestCase):
+    def _limiter(self, max_concurrency=4, per_client_limit=2):
+        return AdaptiveLimiter('test', max_concurrency, per_client_limit, queue_timeout=0,
+                               base_backoff=1, max_backoff=30)
+
+    def test_client_share_is_capped(self):
+        limiter = self._limiter()
+        limiter.acquire('ip:203.0.113.7')
+        limiter.acquire('ip:203.0.113.7')
+
+        with self.assertRaises(UpstreamBusy):
+            limiter.acquire('ip:203.0.113.7')
+        limiter.acquire('user:1')
+        self.assertEqual(limiter.get_stats()['in_flight'], 3)
+
+    @override_settings(TRUSTED_PROXY_COUNT=0)
+    def test_rotating_forwarded_for_shares_one_client_slot_count(self):
+        limiter = self._limiter(per_client_limit=1)
+        keys = []
+        for spoofed in ('198.51.100.1', '198.51.100.2'):
+            token = set_client_key(RequestFactory().get('/', HTTP_X_FORWARDED_FOR=spoofed))
+            try:
+                keys.append(current_client_key())
+            finally:
+                reset_client_key(token)
+
+        limiter.acquire(keys[0])
+        with self.assertRaises(UpstreamBusy):
+            limiter.acquire(keys[1])
+
+    def test_throttle_halves_the_limit_and_closes_the_gate(self):
+        limiter = self._limiter(max_concurrency=8)
+        limiter.acquire()
+        limiter.release(throttled=True, retry_after=5)
+
+        stats = limiter.get_stats()
+        self.assertEqual(stats['limit'], 4)
+        self.assertGreater(stats['backoff_remaining_s'], 4)
+        with self.assertRaises(UpstreamBusy) as raised:
+            limiter.acquire()
+        self.assertGreater(raised.exception.retry_after, 4)
+
+    def test_limit_grows_back_after_successes(self):
+        limiter = self._limiter(max_concurrency=8)
+        limiter.acquire()
+        limiter.release(throttled=True, retry_after=0)
+        # Additive increase: about one slot per round of successful calls
+        for _ in range(40):
+            limiter.acquire()
+            limiter.release()
+
+        self.assertEqual(limiter.get_stats()['limit'], 8)
+
+    def test_queued_callers_are_let_in_by_tier_weight(self):
+        limiter = AdaptiveLimiter('test', 1, 10, queue_timeout=5, base_backoff=1, max_backoff=30)
+        limiter.acquire()
+        order = []
+
+        def call(tier, weight):
+            limiter.acquire(tier=tier, weight=weight)
+            order.append(tier)
+            limiter.release()
+
+        threads = [threading.Thread(target=call, args=('Basic', 1.0))]
+        threads[0].start()
+        while limiter.get_stats()['queue_depth'] < 1:
+            time.sleep(0.01)
+        threads.append(threading.Thread(target=call, args=('Premium', 4.0)))
+        threads[1].start()
+        while limiter.get_stats()['queue_depth'] < 2:
+            time.sleep(0.01)
+        limiter.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, ['Premium', 'Basic'])
+
+    def test_queued_caller_gives_up_after_the_queue_timeout(self):
+        limiter = AdaptiveLimiter('test', 1, 10, queue_timeout=0.1, base_backoff=1, max_backoff=30)
+        limiter.acquire()
+        started = time.monotonic()
+
+        with self.assertRaises(UpstreamBusy):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(limiter.get_stats()['queue_depth'], 0)
+
+    async def test_async_caller_gets_the_slot_when_released(self):
+        limiter = AdaptiveLimiter('test', 1, 10, queue_timeout=2, base_backoff=1, max_backoff=30)
+        await limiter.aacquire()
+
+        waiter = asyncio.ensure_future(limiter.aacquire())
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiter.done())
+        limiter.release()
+
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(limiter.get_stats()['in_flight'], 1)
+
+    def test_retry_after_accepts_seconds_and_dates(self):
+        self.assertEqual(parse_retry_after('7'), 7.0)
+        self.assertAlmostEqual(parse_retry_after(formatdate(time.time() + 30, usegmt=True)), 30, delta=2)
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+def _upstream_response(status_code=200, headers=None, body=b'{}'):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(body)
+    return response
+
+
+class UpstreamClientTests(TestCase):
+    def _client(self, responses, **options):
+        limiter = AdaptiveLimiter('test', 4, 4, queue_timeout=1, base_backoff=0, max_backoff=1)
+        client = UpstreamClient('test', 1, 5, pool_size=4, max_retries=0, backoff_factor=0, limiter=limiter,
+                                **options)
+        client.session.post = mock.Mock(side_effect=responses)
+        return client
+
+    def test_streamed_response_holds_its_slot_until_closed(self):
+        client = self._client([_upstream_response()])
+
+        response = client.post('https://upstream.test/', stream=True)
+
+        self.assertEqual(client.limiter.get_stats()['in_flight'], 1)
+        response.close()
+        response.close()
+        self.assertEqual(client.limiter.get_stats()['in_flight'], 0)
+
+    def test_throttled_call_is_retried_through_the_limiter(self):
+        client = self._client([_upstream_response(429, {'Retry-After': '0'}), _upstream_response()],
+                              throttle_retries=1)
+
+        response = client.post('https://upstream.test/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.session.post.call_count, 2)
+        stats = client.limiter.get_stats()
+        self.assertEqual((stats['in_flight'], stats['throttled']), (0, 1))
+
+
+class _TrickleStream(io.BytesIO):
+    """Upstream body that arrives a few bytes at a time"""
+
+    def read(self, size=-1):
+        return super().read(3 if size is None or size < 0 else min(size, 3))
+
+
+class StreamAssemblyTests(TestCase):
+    def _stream(self, *chunks):
+        body = ''.join(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n' for chunk in chunks) + 'data: [DONE]\n\n'
+        response = _upstream_response(headers={'Content-Type': 'text/event-stream'})
+        response.raw = _TrickleStream(body.encode('utf-8'))
+        # What requests picks for text/* without a charset
+        response.encoding = 'ISO-8859-1'
+        return response
+
+    def _chunk(self, content, **fields):
+        return {'id': 'c1', 'model': 'sonar', 'choices': [{'delta': {'content': content}}], **fields}
+
+    def test_multibyte_text_split_across_chunks_is_decoded(self):
+        response = self._stream(self._chunk('Café on Rue Saint-Étienne — €450k'))
+
+        chunks = list(iter_sse_data(response))
+
+        self.assertEqual(chunks[0]['choices'][0]['delta']['content'], 'Café on Rue Saint-Étienne — €450k')
+
+    def test_chunks_are_assembled_into_a_completion(self):
+        response = self._stream(
+            self._chunk('Hello '),
+            self._chunk('world', citations=['https://example.com']),
+            {'id': 'c1', 'choices': [{'delta': {}, 'finish_reason': 'stop'}], 'usage': {'total_tokens': 12}},
+        )
+        assembler = StreamAssembler('sonar')
+
+        deltas = [assembler.add(chunk) for chunk in iter_sse_data(response)]
+
+        completion = assembler.completion()
+        self.assertEqual(deltas, ['Hello ', 'world', ''])
+        self.assertEqual(completion['choices'][0]['message']['content'], 'Hello world')
+        self.assertEqual(completion['choices'][0]['finish_reason'], 'stop')
+        self.assertEqual(completion['usage'], {'total_tokens': 12})
+        self.assertEqual(completion['citations'], ['https://example.com'])
+
+    def test_malformed_chunks_are_skipped(self):
+        response = _upstream_response()
+        response.raw = io.BytesIO(b'data: {not json}\n\ndata: {"id": "c1"}\n\ndata: [DONE]\n\ndata: {"id": "c2"}\n\n')
+
+        self.assertEqual(list(iter_sse_data(response)), [{'id': 'c1'}])
+
+    def _events(self, upstream, on_complete=None):
+        with mock.patch('authentication_handler.perplexity_stream.get_client') as get_client:
+            get_client.return_value.post.return_value = upstream
+            body = b''.join(stream_completion({}, {'model': 'sonar', 'messages': []}, on_complete=on_complete))
+        return [(block.split('\n')[0][len('event: '):], json.loads(block.split('\n')[1][len('data: '):]))
+                for block in body.decode('utf-8').strip().split('\n\n')]
+
+    def test_proxy_stream_forwards_deltas_then_the_completion(self):
+        upstream = self._stream(self._chunk('Hello '), self._chunk('world'))
+
+        events = self._events(upstream, on_complete=lambda completion: {'result_token': 'tok'})
+
+        self.assertEqual(events[:2], [('delta', {'content': 'Hello '}), ('delta', {'content': 'world'})])
+        self.assertEqual(events[2][0], 'done')
+        self.assertEqual(events[2][1]['choices'][0]['message']['content'], 'Hello world')
+        self.assertEqual(events[2][1]['result_token'], 'tok')
+
+    def test_upstream_error_becomes_an_error_event(self):
+        on_complete = mock.Mock()
+
+        events = self._events(_upstream_response(500, body=b'{"message": "overloaded"}'), on_complete=on_complete)
+
+        self.assertEqual(events, [('error', {
+            'error': 'Failed to get a valid response from Perplexity API', 'status': 500, 'message': 'overloaded',
+        })])
+        on_complete.assert_not_called()
+
+
+class ResumeGenerationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        self.client = APIClient()
+
+    def _generation(self, user):
+        now = timezone.now()
+        return StreamedGeneration.objects.create(
+            user=user, model='sonar', content='Hello there', content_bytes=11,
+            status=StreamedGeneration.STATUS_COMPLETED, completion={'choices': []},
+            updated_at=now, finished_at=now,
+        )
+
+    def _resume(self, generation, offset=0):
+        return self.client.get(f'/api/auth/perplexity/generations/{generation.generation_id}/?offset={offset}')
+
+    def test_owner_resumes_from_the_offset(self):
+        self.client.force_authenticate(self.user)
+
+        response = self._resume(self._generation(self.user), offset=6)
+
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn('"offset":6}', body)
+        self.assertIn('"content":"there"', body)
+        self.assertIn('event: done', body)
+
+    def test_other_users_and_anonymous_callers_cannot_resume(self):
+        other = User.objects.create_user(username='other', password='secret')
+        generation = self._generation(other)
+
+        self.assertEqual(self._resume(generation).status_code, 404)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self._resume(generation).status_code, 404)
+
+    def test_unowned_generations_are_not_resumable(self):
+        self.client.force_authenticate(self.user)
+
+        self.assertEqual(self._resume(self._generation(None)).status_code, 404)
+
+    async def test_async_resume_checks_the_owner(self):
+        other = await User.objects.acreate(username='other')
+        generation = await sync_to_async(self._generation)(other)
+        request = AsyncRequestFactory().get(f'/api/auth/perplexity/generations/{generation.generation_id}/')
+
+        with mock.patch.object(async_views, '_authenticate', return_value=(self.user, None)):
+            response = await async_views.resume_generation(request, generation.generation_id)
+
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(STREAM_RESUME_ENABLED=True, PERPLEXITY_CACHE_ENABLED=False, PERPLEXITY_API_KEYS='pplx-test')
+    def test_anonymous_streams_do_not_start_a_resumable_generation(self):
+        with mock.patch('authentication_handler.views.start_generation') as start, \
+                mock.patch('authentication_handler.views.stream_completion', return_value=iter([b''])) as stream:
+            self.client.post('/api/auth/perplexity/', {
+                'messages': [{'role': 'user', 'content': 'Hi'}], 'stream': True,
+            }, format='json')
+
+        start.assert_not_called()
+        stream.assert_called_once()
+
+
+class AbandonGenerationTests(TestCase):
+    def _unattended(self, seconds):
+        generation = StreamedGeneration.objects.create(model='sonar', updated_at=timezone.now())
+        live = LiveGeneration()
+        live.detached_at = time.monotonic() - seconds
+        return generation.pk, live
+
+    @override_settings(STREAM_GENERATION_ABANDON_AFTER=300)
+    def test_survives_a_reconnect_gap(self):
+        self.assertFalse(_abandoned(*self._unattended(60)))
+
+    @override_settings(STREAM_GENERATION_ABANDON_AFTER=300)
+    def test_cancelled_once_nobody_reads_for_the_window(self):
+        self.assertTrue(_abandoned(*self._unattended(301)))
+
+    @override_settings(STREAM_GENERATION_ABANDON_AFTER=300)
+    def test_a_reader_in_another_worker_keeps_it_running(self):
+        pk, live = self._unattended(301)
+        StreamedGeneration.objects.filter(pk=pk).update(read_at=timezone.now())
+
+        self.assertFalse(_abandoned(pk, live))
+
+
+@override_settings(GENERATION_RESULTS_ENABLED=True)
+class SaveByResultTokenTests(TestCase):
+    completion = {'model': 'sonar-pro', 'choices': [{'message': {'content': '<p>Great **schools** [1]</p>'}}]}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _save(self, token, **edits):
+        return self.client.post('/api/auth/analyses/save/', {'result_token': token, **edits}, format='json')
+
+    def test_saves_the_kept_completion(self):
+        token = store_result(self.user, self.completion, 'sonar-pro', 'package_tier',
+                             address='1 Main St', package_name='Premium')
+
+        response = self._save(token)
+
+        self.assertEqual(response.status_code, 201)
+        analysis = PropertyAnalysis.objects.get(pk=response.json()['analysis_id'])
+        self.assertEqual(analysis.address, '1 Main St')
+        self.assertEqual(analysis.package_name, 'Premium')
+        self.assertEqual(analysis.analysis_model, 'sonar-pro')
+        self.assertEqual(analysis.analysis_content, '<p>Great <strong>schools</strong></p>')
+
+    def test_saving_twice_returns_the_first_analysis(self):
+        token = store_result(self.user, self.completion, 'sonar-pro', address='1 Main St')
+
+        first = self._save(token)
+        second = self._save(token, address='2 Oak Ave')
+
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['analysis_id'], first.json()['analysis_id'])
+        self.assertEqual(PropertyAnalysis.objects.count(), 1)
+
+    def test_unknown_or_foreign_token_is_not_found(self):
+        other = User.objects.create_user(username='other', password='secret')
+        token = store_result(other, self.completion, 'sonar-pro', address='1 Main St')
+
+        self.assertEqual(self._save('not-a-token').status_code, 404)
+        self.assertEqual(self._save(token).status_code, 404)
+
+    def test_anonymous_results_are_not_kept(self):
+        self.assertIsNone(store_result(None, self.completion, 'sonar-pro'))
+
+
+@override_settings(GENERATION_RESULTS_ENABLED=True, PERPLEXITY_CACHE_ENABLED=True, PERPLEXITY_API_KEYS='pplx-test')
+class CachedProxyResultTokenTests(TestCase):
+    messages = [{'role': 'user', 'content': 'Tell me about 1 Main St'}]
+    completion = {'model': 'sonar', 'choices': [{'message': {'content': '<p>Cached report</p>'}}]}
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        model = choose_model('Professional').model
+        perplexity_cache.set(make_cache_key(model, self.messages), model, self.completion)
+        self.addCleanup(perplexity_cache.purge, expired_only=False)
+
+    def _body(self, **fields):
+        return {'messages': self.messages, 'package_name': 'Professional', **fields}
+
+    def test_sync_hit_carries_a_result_token(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post('/api/auth/perplexity/', self._body(), format='json')
+
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertTrue(response['X-Result-Token'])
+
+    async def _async_post(self, **fields):
+        request = AsyncRequestFactory().post('/api/auth/perplexity/', self._body(**fields),
+                                             content_type='application/json')
+        with mock.patch.object(async_views, '_authenticate', return_value=(self.user, None)):
+            return await async_views.perplexity_proxy(request)
+
+    async def test_async_hit_carries_a_result_token(self):
+        response = await self._async_post()
+
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertTrue(response['X-Result-Token'])
+
+    async def test_async_streamed_hit_sends_the_token_in_the_done_event(self):
+        response = await self._async_post(stream=True)
+
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertTrue(body.startswith('event: done\n'))
+        self.assertIn('"result_token":', body)
+
+
+@override_settings(GENERATION_RESULTS_ENABLED=True)
+class AsyncGenerateAnalysisTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+
+    async def _post(self, body):
+        request = AsyncRequestFactory().post('/api/auth/analyses/generate/', body, content_type='application/json')
+        with mock.patch.object(async_views, '_authenticate', return_value=(self.user, None)):
+            return await async_views.generate_property_analysis(request)
+
+    async def test_generates_off_the_thread_sensitive_executor(self):
+        threads = []
+
+        def generate_analysis(user, address, **options):
+            threads.append(threading.current_thread())
+            data = {'model': options['model'], 'choices': [{'message': {'content': f'<p>{address}</p>'}}]}
+            return AnalysisResult(data, 'MISS', 'Agent bio', 'v1')
+
+        with mock.patch('authentication_handler.analysis_generator.generate_analysis', side_effect=generate_analysis):
+            response = await self._post({'address': '1 Main St', 'package_name': 'Professional'})
+
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual(body['agent_description'], 'Agent bio')
+        self.assertTrue(body['result_token'])
+        self.assertNotEqual(threads, [threading.main_thread()])
+
+    async def test_rejects_bad_options(self):
+        response = await self._post({'address': '1 Main St', 'options': ['single']})
+
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(ADDRESS_RESEARCH_ENABLED=True)
+class AddressResearchTests(TestCase):
+    def _section(self, key, address):
+        return (f'<section class="analysis-section" data-section="9" data-section-key="{key}">'
+                f'<div class="section-content"><p>Homes near {address}</p></div></section>')
+
+    def test_spellings_of_an_address_share_a_key(self):
+        self.assertEqual(canonical_address('123 Main Street, Springfield, IL'),
+                         canonical_address('  123 main st springfield il '))
+        self.assertEqual(canonical_address('5 Oak Ave Unit 4'), canonical_address('5 Oak Avenue #4'))
+
+    def test_agent_facing_sections_are_not_shared(self):
+        agent_facing = {'pricing_strategy', 'marketing_plan', 'selling_timeline'}
+        self.assertFalse(agent_facing & SHARED_SECTION_KEYS)
+
+        sections = {key: self._section(key, '1 Main St') for key in SECTION_KEYS}
+        self.assertEqual(store_research('1 Main St', 'sonar', sections), len(SHARED_SECTION_KEYS))
+        self.assertFalse(agent_facing & set(load_research('1 Main St', 'sonar')))
+
+    def test_reuse_swaps_in_the_readers_spelling(self):
+        store_research('123 Main Street, Springfield', 'sonar',
+                       {'neighborhood': self._section('neighborhood', '123 Main Street, Springfield')})
+        research = load_research('123 main st springfield', 'sonar')
+
+        def generate_section(address, key, number, model, use_cache):
+            return SectionResult(key, self._section(key, address), {}, 'MISS', 1, 0.0)
+
+        with mock.patch('authentication_handler.analysis_generator._generate_section', side_effect=generate_section):
+            data, _status = generate_sections('123 main st springfield', 'sonar', use_cache=False, research=research)
+
+        content = data['choices'][0]['message']['content']
+        self.assertNotIn('123 Main Street', content)
+        self.assertEqual(content.count('Homes near 123 main st springfield'), len(SECTION_KEYS))
+
+
+@override_settings(ANALYSIS_HTML_NORMALIZE=True)
+class NormalizeAnalysisHtmlTests(TestCase):
+    def test_output_is_stable(self):
+        content = (
+            '```html\n<div class="property-analysis"><section data-section="1">'
+            '<h2>### Market</h2><p>  Prices up *4%* [1][2].  </p><ul><li>one<li>two</ul>'
+            '<span style="color: rgb(0, 0, 255); display: inline">blue</span><sup>[3]</sup>'
+            '<custom-tag>kept text</custom-tag><div>unclosed\n```'
+        )
+
+        normalized = normalize_analysis_html(content)
+
+        self.assertEqual(normalize_analysis_html(normalized), normalized)
+
+    def test_unsafe_markup_is_removed(self):
+        normalized = normalize_analysis_html(
+            '<p onclick="steal()">Hi<script>alert(1)</script></p>'
+            '<a href="javascript:alert(1)">bad</a><a href="https://example.com">good</a>'
+            '<p style="background-image: url(https://x.test/a.png); color: expression(alert(1))">styled</p>'
+            '<iframe src="https://x.test"><p>inside</p></iframe><!-- note -->'
+        )
+
+        self.assertEqual(
+            normalized,
+            '<p>Hi</p><a>bad</a><a href="https://example.com">good</a><p>styled</p>',
+        )
+
+    def test_user_formatting_is_kept(self):
+        content = '<p style="color: #c00; font-size: 18px; text-align: center;">Open house</p>'
+
+        self.assertEqual(
+            normalize_analysis_html(content),
+            '<p style="color: #c00; font-size: 18px; text-align: center;">Open house</p>',
+        )
+
+    def test_markdown_reply_is_converted(self):
+        self.assertEqual(
+            normalize_analysis_html('## Summary\n\nA **great** home [1].'),
+            '<h2>Summary</h2><p>A <strong>great</strong> home.</p>',
+        )
+
+    @override_settings(ANALYSIS_HTML_NORMALIZE=False)
+    def test_disabled_leaves_content_unchanged(self):
+        self.assertEqual(normalize_analysis_html('<p>**x**</p>'), '<p>**x**</p>')
+
+
+class ResponseCacheTests(TestCase):
+    completion = {'model': 'sonar', 'choices': [{'message': {'content': 'Cached'}}]}
+
+    def _cache(self, **options):
+        return ResponseCache(**{'max_bytes': 10_000, 'ttl': 60, 'stale_ttl': 600, 'persist': False, **options})
+
+    def _age(self, cache, key, seconds):
+        data, size, created_at = cache._entries[key]
+        cache._entries[key] = (data, size, created_at - timedelta(seconds=seconds))
+
+    def test_key_ignores_whitespace_and_role_case(self):
+        self.assertEqual(
+            make_cache_key('sonar', [{'role': 'User', 'content': 'Tell me\n   about  it '}]),
+            make_cache_key('Sonar', [{'role': 'user', 'content': 'Tell me about it'}]),
+        )
+        self.assertNotEqual(make_cache_key('sonar', [{'role': 'user', 'content': 'a'}]),
+                            make_cache_key('sonar-pro', [{'role': 'user', 'content': 'a'}]))
+
+    def test_evicts_least_recently_used_over_the_byte_budget(self):
+        size = len(json.dumps(self.completion, separators=(',', ':')))
+        cache = self._cache(max_bytes=size * 2)
+        cache.set('a', 'sonar', self.completion)
+        cache.set('b', 'sonar', self.completion)
+        cache.get('a')
+
+        cache.set('c', 'sonar', self.completion)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_expired_entries_are_only_served_as_stale(self):
+        cache = self._cache()
+        cache.set('a', 'sonar', self.completion)
+
+        self._age(cache, 'a', 120)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stale('a'), self.completion)
+
+        self._age(cache, 'a', 600)
+        self.assertIsNone(cache.get_stale('a'))
+
+    def test_database_tier_is_shared_across_processes(self):
+        self._cache(persist=True).set('a', 'sonar', self.completion)
+
+        other_process = self._cache(persist=True)
+
+        self.assertEqual(other_process.get('a'), self.completion)
+        self.assertEqual(other_process.get_stats()['db_hits'], 1)
+
+    @override_settings(PERPLEXITY_CACHE_ENABLED=True, PERPLEXITY_SINGLE_FLIGHT_ENABLED=False,
+                       PERPLEXITY_API_KEYS='pplx-test')
+    def test_upstream_outage_serves_the_stale_entry(self):
+        messages = [{'role': 'user', 'content': 'Outage'}]
+        self.addCleanup(perplexity_cache.purge, expired_only=False)
+
+        with mock.patch('authentication_handler.perplexity_service.get_client') as get_client:
+            post = get_client.return_value.post
+            post.return_value = _upstream_response(body=json.dumps(self.completion).encode())
+            self.assertEqual(complete('sonar', messages), (self.completion, MISS))
+            self.assertEqual(complete('sonar', messages), (self.completion, HIT))
+
+            self._age(perplexity_cache, make_cache_key('sonar', messages), perplexity_cache.ttl + 1)
+            post.return_value = _upstream_response(503)
+            self.assertEqual(complete('sonar', messages), (self.completion, STALE))
+        self.assertEqual(post.call_count, 2)
+
+
+class SingleFlightTests(TestCase):
+    def _wait_until(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('condition not reached')
+
+    def test_concurrent_callers_share_one_call(self):
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('key', fetch))) for _ in range(3)]
+        threads[0].start()
+        self._wait_until(lambda: calls)
+        for thread in threads[1:]:
+            thread.start()
+        self._wait_until(lambda: flights.get_stats()['coalesced'] == 2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('result', False), ('result', True), ('result', True)])
+        self.assertEqual(flights.get_stats()['in_flight'], 0)
+
+    def test_waiters_get_the_leaders_error(self):
+        flights = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError('upstream down')
+
+        def call():
+            try:
+                flights.do('key', fail)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(2)]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        self._wait_until(lambda: flights.get_stats()['coalesced'] == 1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(errors), 2)
+        self.assertIs(errors[0], errors[1])
+
+    async def test_async_call_survives_one_waiter_leaving(self):
+        flights = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await release.wait()
+            return 'result'
+
+        first = asyncio.ensure_future(flights.ado('key', fetch))
+        second = asyncio.ensure_future(flights.ado('key', fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+
+        self.assertEqual(await second, ('result', True))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.get_stats()['cancelled'], 0)
+
+    async def test_async_call_is_cancelled_with_its_last_waiter(self):
+        flights = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fetch():
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.ensure_future(flights.ado('key', fetch))
+        await asyncio.sleep(0)
+        waiter.cancel()
+
+        await asyncio.wait_for(cancelled.wait(), 1)
+        self.assertEqual(flights.get_stats()['cancelled'], 1)
+
+    def test_cross_process_lock_waits_for_the_holder_or_its_result(self):
+        with cross_process_lock('flight-test', timeout=1) as held:
+            self.assertTrue(held)
+            started = time.monotonic()
+            with cross_process_lock('flight-test', timeout=0.2) as second:
+                self.assertFalse(second)
+            self.assertGreaterEqual(time.monotonic() - started, 0.2)
+            with cross_process_lock('flight-test', timeout=5, ready=lambda: True) as third:
+                self.assertFalse(third)
+        with cross_process_lock('flight-test', timeout=0) as after:
+            self.assertTrue(after)
+
+
+class CircuitBreakerTests(TestCase):
+    def _breaker(self, **options):
+        return CircuitBreaker('test', **{
+            'failure_rate': 0.5, 'slow_call_seconds': 1, 'min_calls': 4, 'window': 60, 'open_seconds': 60,
+            **options,
+        })
+
+    def _trip(self, breaker):
+        for failed in (False, True, True, False):
+            breaker.allow_request()
+            breaker.record(failed)
+
+    def test_opens_at_the_failure_rate_and_fails_fast(self):
+        breaker = self._breaker()
+        self._trip(breaker)
+
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpen) as raised:
+            breaker.allow_request()
+        self.assertGreater(raised.exception.retry_after, 50)
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = self._breaker()
+        for latency in (0.1, 5, 5, 0.1):
+            breaker.record(False, latency)
+
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_one_probe_after_the_open_period_decides(self):
+        breaker = self._breaker(open_seconds=0)
+        self._trip(breaker)
+
+        breaker.allow_request()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.record(True)
+        self.assertEqual(breaker.state, OPEN)
+
+        breaker.allow_request()
+        breaker.record(False)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_only_the_probe_goes_out_while_half_open(self):
+        breaker = self._breaker(open_seconds=0.2)
+        self._trip(breaker)
+        time.sleep(0.2)
+
+        breaker.allow_request()
+        with self.assertRaises(CircuitOpen):
+            breaker.allow_request()
+
+
+class HedgedRequestTests(TestCase):
+    def _client(self, post, **options):
+        client = UpstreamClient('test', 1, 5, pool_size=4, max_retries=0, backoff_factor=0,
+                                hedge_min_delay=0.05, hedge_max_ratio=1, **options)
+        client.session.post = mock.Mock(side_effect=post)
+        # Enough history for a p95 and hedging budget
+        client._latencies.extend([0.01] * 20)
+        client._stats['requests'] = 20
+        return client
+
+    def test_slow_attempt_is_raced_and_the_loser_accounted_for(self):
+        slow, fast = _upstream_response(body=b'slow'), _upstream_response(body=b'fast')
+        calls = []
+
+        def post(url, **kwargs):
+            calls.append(url)
+            if len(calls) == 1:
+                time.sleep(0.3)
+                return slow
+            return fast
+
+        discarded = threading.Event()
+        client = self._client(post)
+
+        response = client.post('https://upstream.test/', hedge=True, on_discarded=lambda r: discarded.set())
+
+        self.assertIs(response, fast)
+        self.assertTrue(discarded.wait(2))
+        stats = client.get_stats()
+        self.assertEqual((stats['hedged'], stats['hedge_wins'], stats['hedge_discarded']), (1, 1, 1))
+
+    def test_fast_attempt_is_not_hedged(self):
+        client = self._client([_upstream_response()])
+
+        client.post('https://upstream.test/', hedge=True)
+
+        self.assertEqual(client.session.post.call_count, 1)
+        self.assertEqual(client.get_stats()['hedged'], 0)
+
+    def test_open_circuit_fails_without_calling_the_upstream(self):
+        breaker = CircuitBreaker('test', failure_rate=0.5, slow_call_seconds=10, min_calls=1, window=60,
+                                 open_seconds=60)
+        breaker.record(True)
+        client = self._client([_upstream_response()], breaker=breaker)
+
+        with self.assertRaises(CircuitOpen):
+            client.post('https://upstream.test/', hedge=True)
+        client.session.post.assert_not_called()
+
+
+class ApiKeyPoolTests(TestCase):
+    def _pool(self, *keys):
+        return ApiKeyPool('test', list(keys), base_backoff=1, max_backoff=30)
+
+    def test_keys_are_parsed_in_order_without_duplicates(self):
+        self.assertEqual(parse_keys(' pplx-a, pplx-b,,pplx-a '), ['pplx-a', 'pplx-b'])
+
+    def test_concurrent_calls_use_different_keys(self):
+        pool = self._pool('pplx-a', 'pplx-b')
+
+        self.assertNotEqual(pool.checkout().value, pool.checkout().value)
+
+    def test_throttled_key_sits_out_its_retry_after(self):
+        pool = self._pool('pplx-a', 'pplx-b')
+        key = pool.checkout()
+        pool.release(key, throttled=True, retry_after=30)
+
+        for _ in range(3):
+            other = pool.checkout()
+            self.assertNotEqual(other.value, key.value)
+            pool.release(other)
+        self.assertEqual(pool.available_in(), 0)
+
+    def test_backoff_doubles_without_retry_after(self):
+        pool = self._pool('pplx-a')
+        for _ in range(3):
+            pool.release(pool.checkout(), throttled=True)
+
+        self.assertGreater(pool.available_in(), 3)
+        self.assertLessEqual(pool.available_in(), 4)
+        # With every key cooling down, the one back first is still handed out
+        self.assertEqual(pool.checkout().value, 'pplx-a')
+
+    def test_throttled_call_is_retried_on_another_key(self):
+        limiter = AdaptiveLimiter('test', 4, 4, queue_timeout=1, base_backoff=0, max_backoff=1)
+        client = UpstreamClient('test', 1, 5, pool_size=4, max_retries=0, backoff_factor=0, limiter=limiter,
+                                throttle_retries=1, key_pool=self._pool('pplx-a', 'pplx-b'))
+        client.session.post = mock.Mock(side_effect=[_upstream_response(429, {'Retry-After': '0'}),
+                                                     _upstream_response()])
+
+        self.assertEqual(client.post('https://upstream.test/', headers={'accept': 'application/json'}).status_code, 200)
+
+        used = [call.kwargs['headers']['Authorization'] for call in client.session.post.call_args_list]
+        self.assertEqual(sorted(used), ['Bearer pplx-a', 'Bearer pplx-b'])
+
+
+@override_settings(ANALYSIS_BATCH_CONCURRENCY=2, ANALYSIS_BATCH_MAX_CONCURRENCY=4)
+class AnalysisBatchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+
+    def test_csv_uses_the_address_column(self):
+        self.assertEqual(parse_batch_addresses('id,Address\n1,1 Main St\n2,\n3,"2 Oak Ave, Springfield"\n'),
+                         ['1 Main St', '2 Oak Ave, Springfield'])
+        self.assertEqual(parse_batch_addresses('1 Main St,x\n\n2 Oak Ave\n'), ['1 Main St', '2 Oak Ave'])
+
+    def test_duplicate_spellings_are_queued_once(self):
+        batch = submit_analysis_batch(self.user, ['1 Main Street', '1 main st', '2 Oak Ave'], 'Professional',
+                                      concurrency=10)
+
+        self.assertEqual(batch.total, 2)
+        self.assertEqual(batch.concurrency, 4)
+        self.assertEqual(list(batch.jobs.values_list('address', flat=True).order_by('id')),
+                         ['1 Main Street', '2 Oak Ave'])
+
+    def test_workers_respect_the_batch_concurrency(self):
+        batch = submit_analysis_batch(self.user, ['1 Main St', '2 Oak Ave', '3 Elm St'], 'Professional',
+                                      concurrency=1)
+        single = submit_analysis_job(self.user, '9 Pine Rd', 'Professional', 'sonar')
+
+        first = claim_next_job('worker-a')
+        second = claim_next_job('worker-b')
+
+        self.assertEqual(first.batch_id, batch.id)
+        self.assertEqual(second.pk, single.pk)
+        self.assertIsNone(claim_next_job('worker-c'))
+
+    def test_progress_is_reported_per_batch(self):
+        batch = submit_analysis_batch(self.user, ['1 Main St', '2 Oak Ave'], 'Professional')
+        job = claim_next_job('worker-a')
+        AnalysisJob.objects.filter(pk=job.pk).update(status=AnalysisJob.STATUS_SUCCEEDED, finished_at=timezone.now())
+
+        data = serialize_batch(batch)
+
+        self.assertEqual(data['status'], 'running')
+        self.assertEqual(data['progress'], 0.5)
+        self.assertEqual((data['counts']['succeeded'], data['counts']['queued']), (1, 1))
+        self.assertEqual(len(data['jobs']), 2)
+
+    def test_api_queues_the_batch_for_its_owner_only(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post('/api/auth/batches/', {'addresses': ['1 Main St', ' '], 'package_name': 'Professional'},
+                               format='json')
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['total'], 1)
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(username='other', password='secret'))
+        self.assertEqual(other.get(f"/api/auth/batches/{response.json()['batch_id']}/").status_code, 404)
+        self.assertEqual(client.post('/api/auth/batches/', {'addresses': []}, format='json').status_code, 400)
+
+
+@override_settings(ADDRESS_RESEARCH_ENABLED=True, ANALYSIS_HTML_NORMALIZE=False)
+class RefreshAnalysisTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='agent', password='secret')
+        blocks = ''.join(self._block(key, number, 'Old') for number, key in enumerate(SECTION_KEYS, start=2))
+        self.analysis = PropertyAnalysis.objects.create(
+            user=self.user, address='1 Main St', analysis_model='sonar', api_response={},
+            analysis_content=f'<div class="property-analysis"><section data-section-key="welcome">Hi</section>{blocks}</div>',
+        )
+
+    def _block(self, key, number, text):
+        return (f'<section class="analysis-section" data-section="{number}" data-section-key="{key}">'
+                f'<div class="section-content"><p>{text} {key}</p></div></section>')
+
+    def _generate(self, failing=()):
+        def generate_section(address, key, number, model, use_cache):
+            if key in failing:
+                raise PerplexityError({'error': 'upstream down'}, status_code=503)
+            return SectionResult(key, self._block(key, number, 'New'), {}, 'MISS', 1, 0.0)
+        return mock.patch('authentication_handler.analysis_refresh._generate_section', side_effect=generate_section)
+
+    def test_only_time_sensitive_sections_are_regenerated_in_place(self):
+        with self._generate() as generate:
+            result = refresh_analysis(self.analysis, use_cache=False)
+
+        self.assertEqual(sorted(result.refreshed), sorted(TIME_SENSITIVE_SECTION_KEYS))
+        self.assertEqual(generate.call_count, len(TIME_SENSITIVE_SECTION_KEYS))
+        self.analysis.refresh_from_db()
+        content = self.analysis.analysis_content
+        for key in SECTION_KEYS:
+            self.assertIn(f"{'New' if key in TIME_SENSITIVE_SECTION_KEYS else 'Old'} {key}", content)
+        self.assertIn('data-section-key="welcome">Hi', content)
+        self.assertIsNotNone(self.analysis.refreshed_at)
+
+    def test_failed_sections_are_left_for_the_next_run(self):
+        with self._generate(failing={'market_report'}):
+            result = refresh_analysis(self.analysis, use_cache=False)
+
+        self.assertEqual(result.failed, ['market_report'])
+        self.analysis.refresh_from_db()
+        self.assertIn('New market_snapshot', self.analysis.analysis_content)
+        self.assertIn('Old market_report', self.analysis.analysis_content)
+        self.assertIsNone(self.analysis.refreshed_at)
+
+    def test_newer_address_research_is_reused(self):
+        store_research('1 main street', 'sonar', {'market_snapshot': self._block('market_snapshot', 9, 'Shared')})
+
+        with self._generate() as generate:
+            result = refresh_analysis(self.analysis, keys=['market_snapshot'])
+
+        self.assertEqual(result.reused, ['market_snapshot'])
+        generate.assert_not_called()
+        self.analysis.refresh_from_db()
+        self.assertIn('Shared market_snapshot', self.analysis.analysis_content)
+        self.assertIn('data-section="5" data-section-key="market_snapshot"', self.analysis.analysis_content)
+
+    def test_api_refreshes_only_the_owners_analysis(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='other', password='secret'))
+        url = f'/api/auth/analyses/{self.analysis.id}/refresh/'
+
+        self.assertEqual(client.post(url, {}, format='json').status_code, 404)
+        client.force_authenticate(self.user)
+        self.assertEqual(client.post(url, {'sections': ['nope']}, format='json').status_code, 400)
+
+
+@override_settings(AGENT_DESCRIPTION_PRECOMPUTE=True)
+class CachedAgentDescriptionTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username='agent', password='secret', first_name='Dana')
+        self.profile = AgentProfile.objects.create(user=user, company_name='Acme Realty', mission='Happy homes')
+        self.generate = mock.patch.object(descriptions, 'generate_agent_description',
+                                          side_effect=lambda data: f"<p>{data['mission']}</p>").start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_description_is_generated_once_per_profile_content(self):
+        first = descriptions.get_cached_agent_description(self.profile)
+        again = descriptions.get_cached_agent_description(AgentProfile.objects.get(pk=self.profile.pk))
+
+        self.assertEqual((first, again), ('<p>Happy homes</p>', '<p>Happy homes</p>'))
+        self.assertEqual(self.generate.call_count, 1)
+
+        self.profile.mission = 'Fast sales'
+        self.assertEqual(descriptions.get_cached_agent_description(self.profile), '<p>Fast sales</p>')
+        self.assertEqual(self.generate.call_count, 2)
+
+    def test_profile_save_queues_one_refresh_when_out_of_date(self):
+        self.addCleanup(descriptions._refresh_pending.discard, self.profile.pk)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertTrue(descriptions.schedule_description_refresh(self.profile))
+            self.assertFalse(descriptions.schedule_description_refresh(self.profile))
+        self.assertEqual(len(callbacks), 1)
+
+        descriptions._refresh_pending.discard(self.profile.pk)
+        descriptions.get_cached_agent_description(self.profile)
+        self.assertFalse(descriptions.schedule_description_refresh(self.profile))
+
+
+class RegenerateAgentDescriptionsTests(TransactionTestCase):
+    def setUp(self):
+        self.profiles = [
+            AgentProfile.objects.create(user=User.objects.create_user(username=f'agent{number}'),
+                                        company_name='Acme Realty', mission=f'Mission {number}')
+            for number in range(3)
+        ]
+        self.generate = mock.patch.object(descriptions, 'generate_agent_description',
+                                          side_effect=lambda data: f"<p>{data['mission']}</p>").start()
+        self.addCleanup(mock.patch.stopall)
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+
+    def _run(self, *args):
+        call_command('regenerate_agent_descriptions', '--concurrency', '2', '--chunk-size', '2',
+                     '--checkpoint', self.checkpoint, *args, stdout=io.StringIO())
+
+    def test_interrupted_run_resumes_after_the_last_chunk(self):
+        self._run('--limit', '2')
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        self._run()
+
+        self.assertEqual(self.generate.call_count, 3)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(AgentProfile.objects.get(pk=self.profiles[2].pk).agent_description, '<p>Mission 2</p>')
+
+    def test_unchanged_profiles_are_skipped_unless_forced(self):
+        self._run()
+        self._run()
+        self.assertEqual(self.generate.call_count, 3)
+
+        self._run('--force')
+        self.assertEqual(self.generate.call_count, 6)
+
+
+@override_settings(ANALYSIS_SECTION_CONCURRENCY=4, ANALYSIS_SECTION_MAX_ATTEMPTS=2, ANALYSIS_SECTION_RETRY_BACKOFF=0)
+class SectionFanOutTests(TestCase):
+    def _complete(self, failures=None):
+        failures = dict(failures or {})
+        lock = threading.Lock()
+
+        def complete(model, messages, use_cache=True):
+            key = messages[0]['content'].split('data-section-key="')[1].split('"')[0]
+            with lock:
+                status_code = failures.get(key)
+                if isinstance(status_code, list):
+                    status_code = status_code.pop(0) if status_code else None
+            if status_code:
+                raise PerplexityError({'error': f'{key} failed'}, status_code=status_code)
+            content = f'Here you go: <section data-section="1" data-section-key="{key}"><p>{key}</p></section>'
+            return {'model': model, 'choices': [{'message': {'content': content}}], 'usage': {'total_tokens': 10},
+                    'citations': ['https://example.com']}, 'MISS'
+        return mock.patch('authentication_handler.analysis_generator.complete', side_effect=complete)
+
+    def test_sections_are_assembled_in_order_and_numbered(self):
+        with self._complete():
+            data, cache_status = generate_sections('1 Main St', 'sonar', reserve_welcome=True, use_cache=False)
+
+        content = data['choices'][0]['message']['content']
+        keys = [block.split('"')[0] for block in content.split('data-section-key="')[1:]]
+        self.assertEqual(keys, list(SECTION_KEYS))
+        self.assertIn(f'data-section="2" data-section-key="{SECTION_KEYS[0]}"', content)
+        self.assertNotIn('Here you go', content)
+        self.assertEqual(data['usage'], {'total_tokens': 10 * len(SECTION_KEYS)})
+        self.assertEqual(data['citations'], ['https://example.com'])
+        self.assertEqual(cache_status, 'MISS')
+
+    def test_transient_failures_are_retried_per_section(self):
+        with self._complete({'neighborhood': [503]}):
+            data, _status = generate_sections('1 Main St', 'sonar', use_cache=False)
+
+        self.assertEqual(data['generation']['sections']['neighborhood']['attempts'], 2)
+        self.assertEqual(data['generation']['sections']['buyers_love']['attempts'], 1)
+
+    def test_failed_sections_are_reported_together(self):
+        with self._complete({'neighborhood': 400, 'market_report': [503, 503]}):
+            with self.assertRaises(PerplexityError) as raised:
+                generate_sections('1 Main St', 'sonar', use_cache=False)
+
+        self.assertEqual(raised.exception.payload['failed_sections'], ['neighborhood', 'market_report'])
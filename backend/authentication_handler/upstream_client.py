@@ -0,0 +1,632 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FutureTimeout, wait
+from contextlib import asynccontextmanager
+from contextvars import copy_context
+from functools import partial
+from typing import Callable, Dict, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .api_key_pool import ApiKey, ApiKeyPool, parse_keys
+from .circuit_breaker import CLOSED, CircuitBreaker
+from .deadline import remaining_timeout, within_deadline
+from .priority import current_package, package_weight
+from .upstream_limiter import AdaptiveLimiter, current_client_key, parse_retry_after
+
+logger = logging.getLogger(__name__)
+
+PERPLEXITY = 'perplexity'
+NOTION = 'notion'
+
+PERPLEXITY_CHAT_URL = 'https://api.perplexity.ai/chat/completions'
+NOTION_PAGES_URL = 'https://api.notion.com/v1/pages'
+
+# Upstream statuses that are retried by the connection adapter, for GETs only:
+# a POST that got an answer may already be billed. 429 is left to the caller
+# because it needs Retry-After aware handling.
+RETRY_STATUSES = (502, 503, 504)
+
+# Recent latencies kept for the hedge delay, and how many are needed before hedging
+_LATENCY_SAMPLES = 200
+_HEDGE_MIN_SAMPLES = 20
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client for a single third-party upstream"""
+
+    def __init__(self, name: str, connect_timeout: float, read_timeout: float,
+                 pool_size: int, max_retries: int, backoff_factor: float,
+                 limiter: Optional[AdaptiveLimiter] = None, throttle_retries: int = 0,
+                 breaker: Optional[CircuitBreaker] = None, hedge_min_delay: Optional[float] = None,
+                 hedge_max_ratio: float = 0.0, key_pool: Optional[ApiKeyPool] = None):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # Concurrency limit and 429 handling; throttled calls are retried
+        # through the limiter, which holds them until the backoff has passed
+        self.limiter = limiter
+        self.throttle_retries = throttle_retries
+        # Fails calls fast while the upstream is erroring or too slow
+        self.breaker = breaker
+        # Hedging is enabled by a minimum delay; at most hedge_max_ratio of
+        # all requests may send a second attempt
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        # Sets the Authorization header of every attempt, replacing the caller's
+        self.key_pool = key_pool
+        self._hedge_pool = None
+        self.session = self._build_session()
+        # One httpx.AsyncClient per event loop: connections cannot be shared across loops
+        self._async_sessions = weakref.WeakKeyDictionary()
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=_LATENCY_SAMPLES)
+        self._stats = {
+            'requests': 0,
+            'errors': 0,
+            'status_codes': {},
+            'total_latency_ms': 0.0,
+            'max_latency_ms': 0.0,
+            'last_error': None,
+            'hedged': 0,
+            'hedge_wins': 0,
+            # Attempts that lost the race after the upstream answered (and billed) them
+            'hedge_discarded': 0,
+        }
+
+    def _build_session(self) -> requests.Session:
+        """Create a session with one connection pool and retry policy"""
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,  # Never replay a request the upstream may already be billing for
+            status=self.max_retries,
+            status_forcelist=RETRY_STATUSES,
+            # Connection failures are retried for any method since nothing was
+            # sent; status retries only replay GETs
+            allowed_methods=frozenset(['GET']),
+            backoff_factor=self.backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def post(self, url: str, timeout=None, hedge: bool = False,
+             on_discarded: Optional[Callable[[requests.Response], None]] = None,
+             **kwargs) -> requests.Response:
+        """
+        POST to the upstream through the pooled session
+
+        Waits for a limiter slot first. A 429 answer is fed back into the
+        limiter and retried up to ``throttle_retries`` times. Queueing and
+        the call itself are limited to the time left before the request's
+        deadline. With ``stream=True`` the slot (and pool key) is held until
+        the caller closes the response.
+
+        Args:
+            url: Absolute upstream URL
+            timeout: Optional override, either read seconds or a (connect, read) tuple
+            hedge: If hedging is configured, send a second attempt when the
+                first is slower than the recent p95 latency and return
+                whichever answers first
+            on_discarded: Called with the successful response of a hedged
+                attempt that lost the race, before it is closed, so its
+                usage can still be accounted for. Runs on a hedge thread.
+            **kwargs: Passed through to ``requests.Session.post``
+
+        Returns:
+            The upstream response (non-2xx responses are returned, not raised)
+
+        Raises:
+            UpstreamBusy: If no limiter slot became free in time
+            CircuitOpen: If the circuit breaker is open
+            DeadlineExceeded: If the request's deadline passed first
+        """
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (self.timeout[0], timeout)
+
+        client_key = current_client_key()
+        delay = self._hedge_delay() if hedge and not kwargs.get('stream') else None
+        if delay is None:
+            return self._post(url, timeout, client_key, **kwargs)
+        return self._hedged_post(url, timeout, client_key, delay, on_discarded, **kwargs)
+
+    def _post(self, url: str, timeout, client_key: Optional[str], **kwargs) -> requests.Response:
+        for attempt in range(self.throttle_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(client_key, timeout=within_deadline(self.limiter.queue_timeout),
+                                     **self._priority())
+            throttled, retry_after = False, None
+            key = None
+            held_by_response = False
+            try:
+                call_timeout = remaining_timeout(timeout)
+                if self.breaker is not None:
+                    self.breaker.allow_request()
+                key, call_kwargs = self._authorize(kwargs)
+                started = time.monotonic()
+                try:
+                    response = self.session.post(url, timeout=call_timeout, **call_kwargs)
+                except requests.exceptions.RequestException as e:
+                    self._record(None, started, error=str(e))
+                    raise
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                elif kwargs.get('stream'):
+                    # The call is not over until its body has been read: like
+                    # astream, keep the slot and key until the response is closed
+                    _release_on_close(response, lambda: self._release(client_key, key, False, None))
+                    held_by_response = True
+            finally:
+                if not held_by_response:
+                    self._release(client_key, key, throttled, retry_after)
+            # A streamed response returns at the headers, so its latency says nothing about the call
+            self._record(response.status_code, started, sample=not kwargs.get('stream'))
+
+            if throttled and attempt < self.throttle_retries and self.limiter is not None:
+                response.close()
+                continue
+            return response
+
+    def _hedged_post(self, url: str, timeout, client_key: Optional[str], delay: float,
+                     on_discarded: Optional[Callable[[requests.Response], None]],
+                     **kwargs) -> requests.Response:
+        """Race a second attempt against a first one still running after ``delay`` seconds"""
+        pool = self._get_hedge_pool()
+        primary = pool.submit(copy_context().run, self._post, url, timeout, client_key, **kwargs)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        if not self._take_hedge_budget():
+            return primary.result()
+        logger.info(f"{self.name} request slower than {delay:.1f}s, sending hedged attempt")
+        secondary = pool.submit(copy_context().run, self._post, url, timeout, client_key, **kwargs)
+
+        pending = {primary, secondary}
+        fallback, error = None, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if response.status_code >= 500:
+                    # Only returned if the other attempt does no better
+                    if fallback is None:
+                        fallback = response
+                    else:
+                        response.close()
+                    continue
+
+                # The loser cannot be interrupted: its slot is released when it
+                # returns, then its response is accounted for and closed
+                for loser in (done | pending) - {future}:
+                    loser.add_done_callback(partial(self._discard_hedge, on_discarded))
+                if fallback is not None:
+                    fallback.close()
+                if future is secondary:
+                    with self._lock:
+                        self._stats['hedge_wins'] += 1
+                return response
+
+        if fallback is not None:
+            return fallback
+        raise error
+
+    def _discard_hedge(self, on_discarded: Optional[Callable[[requests.Response], None]], future):
+        """Account for and close the response of a hedged attempt that lost the race"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        try:
+            if response.status_code == 200:
+                with self._lock:
+                    self._stats['hedge_discarded'] += 1
+                if on_discarded is not None:
+                    on_discarded(response)
+        except Exception as e:
+            logger.warning(f"Failed to account for discarded {self.name} hedge: {str(e)}")
+        finally:
+            response.close()
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Seconds before hedging (recent p95, at least hedge_min_delay), or None to not hedge"""
+        if self.hedge_min_delay is None:
+            return None
+        # Doubling traffic to an upstream that is already failing only makes it worse
+        if self.breaker is not None and self.breaker.state != CLOSED:
+            return None
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return max(self.hedge_min_delay, p95)
+
+    def _take_hedge_budget(self) -> bool:
+        with self._lock:
+            if self._stats['hedged'] >= self.hedge_max_ratio * self._stats['requests']:
+                return False
+            self._stats['hedged'] += 1
+            return True
+
+    def _get_hedge_pool(self) -> ThreadPoolExecutor:
+        if self._hedge_pool is None:
+            with self._lock:
+                if self._hedge_pool is None:
+                    self._hedge_pool = ThreadPoolExecutor(
+                        max_workers=self.pool_size * 2,
+                        thread_name_prefix=f'{self.name}-hedge',
+                    )
+        return self._hedge_pool
+
+    def _get_async_session(self):
+        """Return the httpx client bound to the running event loop"""
+        import httpx
+
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+        if session is None:
+            connect_timeout, read_timeout = self.timeout
+            session = httpx.AsyncClient(
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                transport=httpx.AsyncHTTPTransport(
+                    # Like the sync adapter, only connection failures are retried
+                    retries=self.max_retries,
+                    limits=httpx.Limits(
+                        max_connections=settings.UPSTREAM_ASYNC_MAX_CONNECTIONS,
+                        max_keepalive_connections=self.pool_size,
+                    ),
+                ),
+            )
+            self._async_sessions[loop] = session
+        return session
+
+    async def apost(self, url: str, timeout=None, hedge: bool = False, **kwargs):
+        """
+        Non-blocking POST for async views, with the same limiter, circuit
+        breaker and hedging behaviour as ``post``
+
+        Args:
+            url: Absolute upstream URL
+            timeout: Optional override, either read seconds or a (connect, read) tuple
+            hedge: Race a second attempt against a slow first one
+            **kwargs: Passed through to ``httpx.AsyncClient.post``
+
+        Returns:
+            The upstream ``httpx.Response``
+
+        Raises:
+            UpstreamBusy: If no limiter slot became free in time
+            CircuitOpen: If the circuit breaker is open
+            DeadlineExceeded: If the request's deadline passed first
+        """
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (self.timeout[0], timeout)
+
+        client_key = current_client_key()
+        delay = self._hedge_delay() if hedge else None
+        if delay is None:
+            return await self._apost(url, timeout, client_key, **kwargs)
+
+        primary = asyncio.ensure_future(self._apost(url, timeout, client_key, **kwargs))
+        done, _pending = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._take_hedge_budget():
+            return await primary
+        logger.info(f"{self.name} request slower than {delay:.1f}s, sending hedged attempt")
+        secondary = asyncio.ensure_future(self._apost(url, timeout, client_key, **kwargs))
+
+        pending = {primary, secondary}
+        fallback, error = None, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    response = task.result()
+                    if response.status_code >= 500:
+                        fallback = fallback or response
+                        continue
+                    if task is secondary:
+                        with self._lock:
+                            self._stats['hedge_wins'] += 1
+                    return response
+        finally:
+            # Cancelling the loser also releases its limiter slot; the upstream
+            # may still bill it, so it is counted
+            for task in pending:
+                task.cancel()
+                with self._lock:
+                    self._stats['hedge_discarded'] += 1
+
+        if fallback is not None:
+            return fallback
+        raise error
+
+    async def _apost(self, url: str, timeout, client_key: Optional[str], **kwargs):
+        import httpx
+
+        for attempt in range(self.throttle_retries + 1):
+            if self.limiter is not None:
+                await self.limiter.aacquire(client_key, timeout=within_deadline(self.limiter.queue_timeout),
+                                            **self._priority())
+            throttled, retry_after = False, None
+            key = None
+            try:
+                connect_timeout, read_timeout = remaining_timeout(timeout)
+                if self.breaker is not None:
+                    self.breaker.allow_request()
+                key, call_kwargs = self._authorize(kwargs)
+                started = time.monotonic()
+                try:
+                    response = await self._get_async_session().post(
+                        url, timeout=httpx.Timeout(read_timeout, connect=connect_timeout), **call_kwargs)
+                except httpx.HTTPError as e:
+                    self._record(None, started, error=str(e))
+                    raise
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                self._release(client_key, key, throttled, retry_after)
+            self._record(response.status_code, started)
+
+            if throttled and attempt < self.throttle_retries and self.limiter is not None:
+                continue
+            return response
+
+    @asynccontextmanager
+    async def astream(self, method: str, url: str, **kwargs):
+        """
+        Async context manager for a streamed upstream response
+
+        The limiter slot is held until the stream is closed. Each read may
+        take up to the time left before the request's deadline.
+        """
+        import httpx
+
+        client_key = current_client_key()
+        if self.limiter is not None:
+            await self.limiter.aacquire(client_key, timeout=within_deadline(self.limiter.queue_timeout),
+                                        **self._priority())
+        throttled, retry_after = False, None
+        key = None
+        try:
+            connect_timeout, read_timeout = remaining_timeout(self.timeout)
+            kwargs.setdefault('timeout', httpx.Timeout(read_timeout, connect=connect_timeout))
+            if self.breaker is not None:
+                self.breaker.allow_request()
+            key, kwargs = self._authorize(kwargs)
+            started = time.monotonic()
+            try:
+                stream = self._get_async_session().stream(method, url, **kwargs)
+                response = await stream.__aenter__()
+            except httpx.HTTPError as e:
+                self._record(None, started, error=str(e))
+                raise
+            try:
+                throttled = response.status_code == 429
+                if throttled:
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                self._record(response.status_code, started, sample=False)
+                yield response
+            finally:
+                await stream.__aexit__(None, None, None)
+        finally:
+            self._release(client_key, key, throttled, retry_after)
+
+    @staticmethod
+    def _priority() -> Dict:
+        """Limiter queueing tier of the current call: its package and the package's weight"""
+        package = current_package()
+        return {'tier': package, 'weight': package_weight(package)}
+
+    def _authorize(self, kwargs: Dict):
+        """
+        Check out a key from the pool for one attempt
+
+        Returns:
+            (key, request kwargs with its Authorization header) - key is None
+            without a pool, and the kwargs are returned as they are
+        """
+        if self.key_pool is None:
+            return None, kwargs
+        key = self.key_pool.checkout()
+        headers = dict(kwargs.get('headers') or {}, Authorization=f'Bearer {key.value}')
+        return key, dict(kwargs, headers=headers)
+
+    def _release(self, client_key: Optional[str], key: Optional[ApiKey], throttled: bool,
+                 retry_after: Optional[float]):
+        """Return the pool key and the limiter slot of a finished attempt"""
+        if key is not None:
+            self.key_pool.release(key, throttled=throttled, retry_after=retry_after)
+            if throttled:
+                # The upstream as a whole only backs off once every key is cooling down
+                retry_after = self.key_pool.available_in()
+                throttled = retry_after > 0
+                retry_after = retry_after or None
+        if self.limiter is not None:
+            self.limiter.release(client_key, throttled=throttled, retry_after=retry_after)
+
+    def _record(self, status_code: Optional[int], started: float, error: Optional[str] = None,
+                sample: bool = True):
+        latency = time.monotonic() - started
+        latency_ms = latency * 1000
+        failed = error is not None or (status_code is not None and status_code >= 500)
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['total_latency_ms'] += latency_ms
+            self._stats['max_latency_ms'] = max(self._stats['max_latency_ms'], latency_ms)
+            if status_code is not None:
+                key = str(status_code)
+                self._stats['status_codes'][key] = self._stats['status_codes'].get(key, 0) + 1
+            if failed:
+                self._stats['errors'] += 1
+                self._stats['last_error'] = error or f'HTTP {status_code}'
+            elif sample:
+                self._latencies.append(latency)
+
+        # 429s are the limiter's business and do not count against the circuit
+        if self.breaker is not None:
+            self.breaker.record(failed, latency if sample else 0.0)
+        if error is not None:
+            logger.warning(f"{self.name} upstream request failed after {latency_ms:.0f}ms: {error}")
+
+    def get_stats(self) -> Dict:
+        """Snapshot of request counters for this upstream"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['status_codes'] = dict(self._stats['status_codes'])
+        requests_made = stats['requests']
+        stats['avg_latency_ms'] = round(stats['total_latency_ms'] / requests_made, 1) if requests_made else 0.0
+        stats['total_latency_ms'] = round(stats['total_latency_ms'], 1)
+        stats['max_latency_ms'] = round(stats['max_latency_ms'], 1)
+        stats['timeout'] = list(self.timeout)
+        stats['pool_size'] = self.pool_size
+        hedge_delay = self._hedge_delay()
+        stats['hedge_delay_s'] = round(hedge_delay, 2) if hedge_delay is not None else None
+        if self.limiter is not None:
+            stats['limiter'] = self.limiter.get_stats()
+        if self.breaker is not None:
+            stats['circuit'] = self.breaker.get_stats()
+        if self.key_pool is not None:
+            stats['keys'] = self.key_pool.get_stats()
+        return stats
+
+
+def _release_on_close(response: requests.Response, release: Callable[[], None]):
+    """Call ``release`` once, when ``response`` is closed (or garbage collected unclosed)"""
+    lock = threading.Lock()
+    pending = [release]
+
+    def release_once():
+        with lock:
+            callbacks = pending[:]
+            pending.clear()
+        for callback in callbacks:
+            callback()
+
+    close = response.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release_once()
+
+    response.close = close_and_release
+    weakref.finalize(response, release_once)
+
+
+_clients: Dict[str, UpstreamClient] = {}
+_clients_lock = threading.Lock()
+
+
+def _client_config(name: str) -> Dict:
+    """Read the per-upstream configuration from settings"""
+    breaker = None
+    hedge_min_delay = None
+    hedge_max_ratio = 0.0
+    key_pool = None
+    if name == PERPLEXITY:
+        connect_timeout = settings.PERPLEXITY_CONNECT_TIMEOUT
+        read_timeout = settings.PERPLEXITY_READ_TIMEOUT
+        max_concurrency = settings.PERPLEXITY_MAX_CONCURRENCY
+        keys = parse_keys(settings.PERPLEXITY_API_KEYS)
+        if keys:
+            key_pool = ApiKeyPool(
+                name,
+                keys,
+                base_backoff=settings.UPSTREAM_THROTTLE_BASE_BACKOFF,
+                max_backoff=settings.UPSTREAM_THROTTLE_MAX_BACKOFF,
+            )
+            # The concurrency limit is per key
+            max_concurrency *= len(keys)
+        if settings.PERPLEXITY_BREAKER_ENABLED:
+            breaker = CircuitBreaker(
+                name,
+                failure_rate=settings.PERPLEXITY_BREAKER_FAILURE_RATE,
+                slow_call_seconds=settings.PERPLEXITY_BREAKER_SLOW_CALL_SECONDS,
+                min_calls=settings.PERPLEXITY_BREAKER_MIN_CALLS,
+                window=settings.PERPLEXITY_BREAKER_WINDOW,
+                open_seconds=settings.PERPLEXITY_BREAKER_OPEN_SECONDS,
+            )
+        if settings.PERPLEXITY_HEDGE_ENABLED:
+            hedge_min_delay = settings.PERPLEXITY_HEDGE_MIN_DELAY
+            hedge_max_ratio = settings.PERPLEXITY_HEDGE_MAX_RATIO
+    elif name == NOTION:
+        connect_timeout = settings.NOTION_CONNECT_TIMEOUT
+        read_timeout = settings.NOTION_READ_TIMEOUT
+        max_concurrency = settings.NOTION_MAX_CONCURRENCY
+    else:
+        raise ValueError(f"Unknown upstream: {name}")
+
+    limiter = AdaptiveLimiter(
+        name,
+        max_concurrency=max_concurrency,
+        per_client_limit=settings.UPSTREAM_PER_USER_CONCURRENCY,
+        queue_timeout=settings.UPSTREAM_QUEUE_TIMEOUT,
+        base_backoff=settings.UPSTREAM_THROTTLE_BASE_BACKOFF,
+        max_backoff=settings.UPSTREAM_THROTTLE_MAX_BACKOFF,
+    )
+    return {
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+        'pool_size': settings.UPSTREAM_POOL_MAXSIZE,
+        'max_retries': settings.UPSTREAM_MAX_RETRIES,
+        'backoff_factor': settings.UPSTREAM_RETRY_BACKOFF,
+        'limiter': limiter,
+        'throttle_retries': settings.UPSTREAM_THROTTLE_RETRIES,
+        'breaker': breaker,
+        'hedge_min_delay': hedge_min_delay,
+        'hedge_max_ratio': hedge_max_ratio,
+        'key_pool': key_pool,
+    }
+
+
+def get_client(name: str) -> UpstreamClient:
+    """Return the process-wide client for an upstream, creating it on first use"""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = UpstreamClient(name, **_client_config(name))
+            _clients[name] = client
+        return client
+
+
+def get_upstream_stats() -> Dict:
+    """Stats for every upstream client created in this process"""
+    return {name: client.get_stats() for name, client in list(_clients.items())}
@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Window used for the observed 429 rate
+_THROTTLE_WINDOW_SECONDS = 60
+_ASYNC_POLL_INTERVAL = 0.05
+
+# Who the current upstream call is made for: a key string, or the HttpRequest
+# set by UpstreamClientKeyMiddleware (resolved lazily, after DRF has
+# authenticated the user)
+_client_key: ContextVar = ContextVar('upstream_client_key', default=None)
+
+
+class UpstreamBusy(Exception):
+    """No upstream slot became free within the queue timeout"""
+
+    def __init__(self, name: str, retry_after: float, message: Optional[str] = None):
+        super().__init__(message or f'{name} is busy, please retry in {int(retry_after) or 1} seconds.')
+        self.name = name
+        self.retry_after = retry_after
+
+
+def set_client_key(value):
+    """Attribute upstream calls in this context to a user key or request"""
+    return _client_key.set(value)
+
+
+def reset_client_key(token):
+    _client_key.reset(token)
+
+
+def current_client_key() -> Optional[str]:
+    """Per-user limiter key for the current context, or None if unknown"""
+    value = _client_key.get()
+    if value is None or isinstance(value, str):
+        return value
+
+    user = getattr(value, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return f'ip:{client_ip(value)}'
+
+
+def client_ip(request) -> str:
+    """
+    Address of the caller as seen by the outermost trusted proxy
+
+    Only the last ``TRUSTED_PROXY_COUNT`` X-Forwarded-For entries were added
+    by our proxies; anything left of them is whatever the client sent.
+    """
+    remote_addr = request.META.get('REMOTE_ADDR', '')
+    trusted = settings.TRUSTED_PROXY_COUNT
+    if trusted <= 0:
+        return remote_addr
+    hops = [hop.strip() for hop in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if hop.strip()]
+    if len(hops) < trusted:
+        return remote_addr
+    return hops[-trusted]
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """
+    Global and per-user concurrency limit for one upstream
+
+    Callers queue for a slot for up to ``queue_timeout`` seconds and are let
+    in by weighted fair queuing on their priority tier. The global limit
+    adapts to the upstream (AIMD): it halves on every 429 and grows back by
+    roughly one slot per round of successful calls. A 429 also
+    closes the gate for the ``Retry-After`` delay, or an exponential delay
+    scaled by the recent 429 rate when the upstream does not send one, so
+    queued calls wait out the throttle instead of hammering it.
+
+    Limits are per process.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, per_client_limit: int, queue_timeout: float,
+                 base_backoff: float, max_backoff: float):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_client_limit = max(1, per_client_limit)
+        self.queue_timeout = queue_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self._cond = threading.Condition()
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._per_client: Dict[str, int] = {}
+        # Waiting callers as (virtual finish tag, sequence, key)
+        self._queue: List[Tuple[float, int, Optional[str]]] = []
+        self._sequence = 0
+        self._virtual_time = 0.0
+        self._last_tags: Dict[Optional[str], float] = {}
+        self._backoff_until = 0.0
+        self._consecutive_throttles = 0
+        self._outcomes = deque()  # (monotonic time, throttled)
+        self._stats = {
+            'acquired': 0,
+            'rejected': 0,
+            'throttled': 0,
+            'total_wait_ms': 0.0,
+            'max_queue_depth': 0,
+        }
+
+    def _can_enter(self, key: Optional[str], now: float) -> bool:
+        if now < self._backoff_until or self._in_flight >= int(self._limit):
+            return False
+        return key is None or self._per_client.get(key, 0) < self.per_client_limit
+
+    def _enter(self, key: Optional[str], waited: float):
+        self._in_flight += 1
+        if key is not None:
+            self._per_client[key] = self._per_client.get(key, 0) + 1
+        self._stats['acquired'] += 1
+        self._stats['total_wait_ms'] += waited * 1000
+
+    def _reject(self, now: float):
+        self._stats['rejected'] += 1
+        retry_after = max(self._backoff_until - now, 1.0)
+        raise UpstreamBusy(self.name, retry_after)
+
+    def acquire(self, key: Optional[str] = None, timeout: Optional[float] = None,
+                tier: Optional[str] = None, weight: float = 1.0):
+        """
+        Block until a slot is free
+
+        Queued callers are let in by weighted fair queuing on their tier
+        rather than in arrival order (see ``priority``).
+
+        Args:
+            key: Per-client limit key
+            timeout: Seconds to queue for (``queue_timeout`` when None)
+            tier: Priority class of the call, e.g. the package name
+            weight: Share of the slots the tier gets while others queue too
+
+        Raises:
+            UpstreamBusy: If no slot was free within the timeout
+        """
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            if not self._queue and self._can_enter(key, started):
+                self._enter(key, 0.0)
+                return
+
+            entry = self._enqueue(key, tier, weight)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._can_enter(key, now) and self._is_next(entry, now):
+                        self._dequeue(entry, served=True)
+                        self._enter(key, now - started)
+                        return
+                    if now >= deadline:
+                        self._reject(now)
+                    wait = deadline - now
+                    if now < self._backoff_until:
+                        wait = min(wait, self._backoff_until - now)
+                    self._cond.wait(wait)
+            finally:
+                if entry in self._queue:
+                    self._dequeue(entry, served=False)
+
+    async def aacquire(self, key: Optional[str] = None, timeout: Optional[float] = None,
+                       tier: Optional[str] = None, weight: float = 1.0):
+        """Async counterpart of ``acquire`` that yields to the event loop while queued"""
+        timeout = self.queue_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        entry = None
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    if entry is None and not self._queue and self._can_enter(key, now):
+                        self._enter(key, now - started)
+                        return
+                    if entry is not None and self._can_enter(key, now) and self._is_next(entry, now):
+                        self._dequeue(entry, served=True)
+                        entry = None
+                        self._enter(key, now - started)
+                        return
+                    if now >= deadline:
+                        self._reject(now)
+                    if entry is None:
+                        entry = self._enqueue(key, tier, weight)
+                        # Let it in straight away if it is first in line
+                        continue
+                    wait = min(_ASYNC_POLL_INTERVAL, deadline - now)
+                    if now < self._backoff_until:
+                        wait = max(wait, min(self._backoff_until - now, deadline - now))
+                await asyncio.sleep(wait)
+        finally:
+            if entry is not None:
+                with self._cond:
+                    if entry in self._queue:
+                        self._dequeue(entry, served=False)
+
+    def _enqueue(self, key: Optional[str], tier: Optional[str], weight: float) -> Tuple[float, int, Optional[str]]:
+        """Queue a caller under its virtual finish tag"""
+        tag = max(self._virtual_time, self._last_tags.get(tier, 0.0)) + 1.0 / max(weight, 0.001)
+        self._last_tags[tier] = tag
+        self._sequence += 1
+        entry = (tag, self._sequence, key)
+        self._queue.append(entry)
+        self._stats['max_queue_depth'] = max(self._stats['max_queue_depth'], len(self._queue))
+        return entry
+
+    def _is_next(self, entry: Tuple[float, int, Optional[str]], now: float) -> bool:
+        """No queued caller that could enter now has an earlier tag"""
+        # Callers held back by their own per-client limit do not block the others
+        return not any(other < entry and self._can_enter(other[2], now) for other in self._queue)
+
+    def _dequeue(self, entry: Tuple[float, int, Optional[str]], served: bool):
+        self._queue.remove(entry)
+        if served:
+            self._virtual_time = max(self._virtual_time, entry[0])
+        if not self._queue:
+            # Nothing is backlogged: every tier starts again from the virtual time
+            self._last_tags.clear()
+        # The next in line may be able to enter now
+        self._cond.notify_all()
+
+    def release(self, key: Optional[str] = None, throttled: bool = False, retry_after: Optional[float] = None):
+        """
+        Free a slot and feed the outcome into the adaptive limit
+
+        Args:
+            key: Key the slot was acquired with
+            throttled: The upstream answered 429
+            retry_after: Parsed Retry-After of that 429, if any
+        """
+        with self._cond:
+            now = time.monotonic()
+            self._in_flight -= 1
+            if key is not None:
+                remaining = self._per_client.get(key, 1) - 1
+                if remaining > 0:
+                    self._per_client[key] = remaining
+                else:
+                    self._per_client.pop(key, None)
+
+            self._outcomes.append((now, throttled))
+            while self._outcomes and self._outcomes[0][0] < now - _THROTTLE_WINDOW_SECONDS:
+                self._outcomes.popleft()
+
+            if throttled:
+                self._on_throttled(now, retry_after)
+            else:
+                self._consecutive_throttles = 0
+                self._limit = min(float(self.max_concurrency), self._limit + 1.0 / max(self._limit, 1.0))
+            self._cond.notify_all()
+
+    def _on_throttled(self, now: float, retry_after: Optional[float]):
+        self._stats['throttled'] += 1
+        self._consecutive_throttles += 1
+        self._limit = max(1.0, self._limit / 2)
+
+        if retry_after is None:
+            retry_after = self.base_backoff * (2 ** (self._consecutive_throttles - 1))
+            retry_after *= 1 + self._throttle_rate()
+        delay = min(retry_after, self.max_backoff)
+        self._backoff_until = max(self._backoff_until, now + delay)
+        logger.warning(f"{self.name} upstream throttled, limit now {int(self._limit)}, backing off {delay:.1f}s")
+
+    def _throttle_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _at, throttled in self._outcomes if throttled) / len(self._outcomes)
+
+    def get_stats(self) -> Dict:
+        """Current in-flight, queue depth and adaptive limit"""
+        with self._cond:
+            now = time.monotonic()
+            stats = dict(self._stats)
+            stats.update({
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._queue),
+                'limit': int(self._limit),
+                'max_concurrency': self.max_concurrency,
+                'per_client_limit': self.per_client_limit,
+                'clients_in_flight': len(self._per_client),
+                'throttle_rate': round(self._throttle_rate(), 3),
+                'backoff_remaining_s': round(max(0.0, self._backoff_until - now), 2),
+            })
+        stats['total_wait_ms'] = round(stats['total_wait_ms'], 1)
+        return stats
@@ -1,20 +1,38 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# In the ASGI deployment mode the I/O-bound views are served by their async versions
+upstream_views = async_views if settings.ASYNC_UPSTREAM_VIEWS else views
 
 urlpatterns = [
     path('register/', views.register, name='register'),
     path('login/', views.login, name='login'),
     path('refresh/', views.refresh_token, name='refresh-token'),
     path('profile/', views.profile, name='profile'),
-    path('perplexity/', views.perplexity_proxy, name='perplexity-proxy'),
-    path('notion/format/', views.notion_format, name='notion-format'),
+    path('perplexity/', upstream_views.perplexity_proxy, name='perplexity-proxy'),
+    path('perplexity/generations/<uuid:generation_id>/', upstream_views.resume_generation, name='resume-generation'),
+    path('notion/format/', upstream_views.notion_format, name='notion-format'),
+    path('upstream/stats/', views.upstream_stats, name='upstream-stats'),
+    path('usage/', views.usage_summary, name='usage-summary'),
+    path('usage/stats/', views.usage_stats, name='usage-stats'),
     
     # Property Analysis endpoints
+    path('analyses/generate/', upstream_views.generate_property_analysis, name='generate-property-analysis'),
     path('analyses/save/', views.save_property_analysis, name='save-property-analysis'),
     path('analyses/recent/', views.get_recent_analyses, name='get-recent-analyses'),
     path('analyses/<int:analysis_id>/', views.get_property_analysis, name='get-property-analysis'),
     path('analyses/<int:analysis_id>/delete/', views.delete_property_analysis, name='delete-property-analysis'),
     path('analyses/<int:analysis_id>/update/', views.update_property_analysis, name='update-property-analysis'),
+    path('analyses/<int:analysis_id>/refresh/', views.refresh_property_analysis, name='refresh-property-analysis'),
+    
+    # Background analysis jobs
+    path('jobs/', views.submit_analysis_job, name='submit-analysis-job'),
+    path('jobs/<int:job_id>/', views.get_analysis_job, name='get-analysis-job'),
+    path('jobs/<int:job_id>/wait/', upstream_views.wait_analysis_job, name='wait-analysis-job'),
+    path('jobs/<int:job_id>/take-over/', views.take_over_analysis_job, name='take-over-analysis-job'),
+    path('batches/', views.submit_analysis_batch, name='submit-analysis-batch'),
+    path('batches/<int:batch_id>/', views.get_analysis_batch, name='get-analysis-batch'),
     
     # Payment endpoints
     path('payments/create-payment-intent/', views.create_payment_intent, name='create-payment-intent'),
@@ -30,5 +48,5 @@ urlpatterns = [
     path('debug/shares/', views.debug_shares, name='debug-shares'),
     path('test-email/', views.test_email, name='test-email'),
     path('reset-share-stats/', views.reset_share_stats, name='reset-share-stats'),
-    path('generate-agent-description/', views.generate_agent_description, name='generate-agent-description'),
+    path('generate-agent-description/', upstream_views.generate_agent_description, name='generate-agent-description'),
 ] 
\ No newline at end of file
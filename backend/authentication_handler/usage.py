@@ -0,0 +1,284 @@
+"""
+Upstream token and cost ledger with budgets.
+
+Every Perplexity completion (analyses, proxy calls, agent descriptions) is
+recorded as an ``UpstreamUsage`` row with the tokens the upstream reported
+and its cost. Before a call is made, the usage of the calling client and of
+the whole service over the last ``USAGE_BUDGET_WINDOW`` seconds is checked
+against the configured token and cost budgets: past
+``USAGE_BUDGET_DOWNGRADE_AT`` of a budget calls are moved to the cheaper
+``USAGE_BUDGET_DOWNGRADE_MODEL``, and once a budget is used up they are
+rejected, so a few heavy users cannot use up the shared upstream capacity.
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+
+from .model_router import BUDGET_DOWNGRADE, ModelRoute
+from .models import UpstreamUsage
+from .upstream_limiter import current_client_key
+
+logger = logging.getLogger(__name__)
+
+# Budget scopes
+CLIENT = 'client'
+GLOBAL = 'global'
+
+_GLOBAL_TOTALS_TTL = 5.0
+
+_global_totals: Tuple[float, Dict] = (0.0, {})
+_global_totals_lock = threading.Lock()
+_prices_cache: Dict[str, Dict[str, Tuple[float, float]]] = {}
+
+
+class BudgetExceeded(Exception):
+    """A usage budget is used up; the call is not made"""
+
+    def __init__(self, scope: str, retry_after: float):
+        if scope == CLIENT:
+            message = 'Your usage budget is used up. Please try again later.'
+        else:
+            message = 'The analysis service has reached its usage budget. Please try again later.'
+        super().__init__(message)
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+def parse_prices(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Parse ``model:input/output`` USD prices per million tokens, separated by commas"""
+    prices = {}
+    for entry in spec.split(','):
+        if ':' not in entry:
+            continue
+        model, price = entry.split(':', 1)
+        prompt_price, _, completion_price = price.partition('/')
+        try:
+            prices[model.strip()] = (float(prompt_price), float(completion_price or prompt_price))
+        except ValueError:
+            continue
+    return prices
+
+
+def usage_cost(model: str, usage: Dict) -> float:
+    """Cost of a completion: the one Perplexity reports, else estimated from ``USAGE_MODEL_PRICES``"""
+    reported = usage.get('cost')
+    if isinstance(reported, dict):
+        reported = reported.get('total_cost')
+    if isinstance(reported, (int, float)):
+        return float(reported)
+
+    spec = settings.USAGE_MODEL_PRICES
+    prices = _prices_cache.get(spec)
+    if prices is None:
+        prices = _prices_cache[spec] = parse_prices(spec)
+    prompt_price, completion_price = prices.get(model, (0.0, 0.0))
+    return (_tokens(usage, 'prompt_tokens') * prompt_price
+            + _tokens(usage, 'completion_tokens') * completion_price) / 1_000_000
+
+
+def _tokens(usage: Dict, name: str) -> int:
+    try:
+        return max(0, int(usage.get(name) or 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _usage_row(model: str, usage: Optional[Dict], purpose: str, client_key: Optional[str]) -> UpstreamUsage:
+    usage = usage or {}
+    client_key = client_key or current_client_key() or ''
+    user_id = None
+    if client_key.startswith('user:'):
+        user_id = int(client_key[len('user:'):])
+    prompt_tokens = _tokens(usage, 'prompt_tokens')
+    completion_tokens = _tokens(usage, 'completion_tokens')
+    return UpstreamUsage(
+        user_id=user_id,
+        client_key=client_key[:100],
+        model=model or '',
+        purpose=purpose,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=_tokens(usage, 'total_tokens') or prompt_tokens + completion_tokens,
+        cost=usage_cost(model, usage),
+    )
+
+
+def record_usage(model: str, usage: Optional[Dict], purpose: str = UpstreamUsage.PURPOSE_ANALYSIS,
+                 client_key: Optional[str] = None):
+    """
+    Add a completion to the ledger (best effort)
+
+    Args:
+        model: Model the completion was requested from
+        usage: ``usage`` block of the response (None when it had none)
+        purpose: What the completion was generated for
+        client_key: Limiter key of the caller (the current one when None)
+    """
+    if not settings.USAGE_TRACKING_ENABLED:
+        return
+    try:
+        _usage_row(model, usage, purpose, client_key).save()
+    except Exception as e:
+        logger.warning(f"Failed to record upstream usage: {str(e)}")
+
+
+async def arecord_usage(model: str, usage: Optional[Dict], purpose: str = UpstreamUsage.PURPOSE_ANALYSIS,
+                        client_key: Optional[str] = None):
+    """Async counterpart of ``record_usage``"""
+    if not settings.USAGE_TRACKING_ENABLED:
+        return
+    try:
+        await _usage_row(model, usage, purpose, client_key).asave()
+    except Exception as e:
+        logger.warning(f"Failed to record upstream usage: {str(e)}")
+
+
+def _window_start():
+    return timezone.now() - timedelta(seconds=settings.USAGE_BUDGET_WINDOW)
+
+
+def _totals(queryset) -> Dict:
+    totals = queryset.aggregate(
+        calls=Count('id'), tokens=Sum('total_tokens'), cost=Sum('cost'), oldest=Min('created_at'),
+    )
+    return {
+        'calls': totals['calls'],
+        'tokens': totals['tokens'] or 0,
+        'cost': totals['cost'] or 0.0,
+        'oldest': totals['oldest'],
+    }
+
+
+def _client_totals(client_key: str) -> Dict:
+    return _totals(UpstreamUsage.objects.filter(client_key=client_key, created_at__gte=_window_start()))
+
+
+def _global_window_totals() -> Dict:
+    """Service-wide totals, reused for a few seconds so every call does not sum the whole window"""
+    global _global_totals
+    with _global_totals_lock:
+        expires, totals = _global_totals
+        if time.monotonic() < expires:
+            return totals
+    totals = _totals(UpstreamUsage.objects.filter(created_at__gte=_window_start()))
+    with _global_totals_lock:
+        _global_totals = (time.monotonic() + _GLOBAL_TOTALS_TTL, totals)
+    return totals
+
+
+def _used_fraction(totals: Dict, token_budget: int, cost_budget: float) -> float:
+    fractions = [0.0]
+    if token_budget > 0:
+        fractions.append(totals['tokens'] / token_budget)
+    if cost_budget > 0:
+        fractions.append(totals['cost'] / cost_budget)
+    return max(fractions)
+
+
+def _retry_after(totals: Dict) -> float:
+    """Seconds until the oldest usage in the window stops counting"""
+    if totals['oldest'] is None:
+        return 60.0
+    ages_out = totals['oldest'] + timedelta(seconds=settings.USAGE_BUDGET_WINDOW)
+    return max(60.0, (ages_out - timezone.now()).total_seconds())
+
+
+def check_budget(client_key: Optional[str] = None) -> float:
+    """
+    Share of the tightest budget already used by the caller or the service
+
+    Returns:
+        The highest used fraction of the client and global budgets (0 when
+        no budget is configured)
+
+    Raises:
+        BudgetExceeded: If a budget is used up
+    """
+    fraction = 0.0
+    client_key = client_key or current_client_key()
+    if client_key and (settings.USAGE_CLIENT_TOKEN_BUDGET > 0 or settings.USAGE_CLIENT_COST_BUDGET > 0):
+        totals = _client_totals(client_key)
+        used = _used_fraction(totals, settings.USAGE_CLIENT_TOKEN_BUDGET, settings.USAGE_CLIENT_COST_BUDGET)
+        if used >= 1:
+            raise BudgetExceeded(CLIENT, _retry_after(totals))
+        fraction = max(fraction, used)
+    if settings.USAGE_GLOBAL_TOKEN_BUDGET > 0 or settings.USAGE_GLOBAL_COST_BUDGET > 0:
+        totals = _global_window_totals()
+        used = _used_fraction(totals, settings.USAGE_GLOBAL_TOKEN_BUDGET, settings.USAGE_GLOBAL_COST_BUDGET)
+        if used >= 1:
+            raise BudgetExceeded(GLOBAL, _retry_after(totals))
+        fraction = max(fraction, used)
+    return fraction
+
+
+def apply_budget(route: ModelRoute, client_key: Optional[str] = None) -> ModelRoute:
+    """
+    Route for a completion once budgets are taken into account
+
+    Past ``USAGE_BUDGET_DOWNGRADE_AT`` of a budget the completion is moved to
+    ``USAGE_BUDGET_DOWNGRADE_MODEL``, even when the client asked for a model.
+
+    Raises:
+        BudgetExceeded: If a budget is used up
+    """
+    if not settings.USAGE_TRACKING_ENABLED:
+        return route
+    fraction = check_budget(client_key)
+    downgrade_model = settings.USAGE_BUDGET_DOWNGRADE_MODEL
+    if fraction >= settings.USAGE_BUDGET_DOWNGRADE_AT and downgrade_model and route.model != downgrade_model:
+        return ModelRoute(downgrade_model, BUDGET_DOWNGRADE)
+    return route
+
+
+aapply_budget = sync_to_async(apply_budget)
+
+
+def get_client_usage(client_key: str) -> Dict:
+    """A client's usage over the budget window against its budgets"""
+    totals = _client_totals(client_key)
+    return {
+        'window_seconds': settings.USAGE_BUDGET_WINDOW,
+        'calls': totals['calls'],
+        'tokens': totals['tokens'],
+        'cost': round(totals['cost'], 6),
+        'token_budget': settings.USAGE_CLIENT_TOKEN_BUDGET or None,
+        'cost_budget': settings.USAGE_CLIENT_COST_BUDGET or None,
+        'used_fraction': round(_used_fraction(
+            totals, settings.USAGE_CLIENT_TOKEN_BUDGET, settings.USAGE_CLIENT_COST_BUDGET), 3),
+    }
+
+
+def get_usage_rollup(top: int = 10) -> Dict:
+    """Service-wide usage over the budget window, by model and purpose, with the heaviest users"""
+    window = UpstreamUsage.objects.filter(created_at__gte=_window_start())
+    totals = _totals(window)
+
+    def grouped(field):
+        return [
+            {field: row[field], 'calls': row['calls'], 'tokens': row['tokens'] or 0,
+             'cost': round(row['cost'] or 0.0, 6)}
+            for row in window.values(field).annotate(
+                calls=Count('id'), tokens=Sum('total_tokens'), cost=Sum('cost'),
+            ).order_by('-tokens')
+        ]
+
+    return {
+        'window_seconds': settings.USAGE_BUDGET_WINDOW,
+        'calls': totals['calls'],
+        'tokens': totals['tokens'],
+        'cost': round(totals['cost'], 6),
+        'token_budget': settings.USAGE_GLOBAL_TOKEN_BUDGET or None,
+        'cost_budget': settings.USAGE_GLOBAL_COST_BUDGET or None,
+        'used_fraction': round(_used_fraction(
+            totals, settings.USAGE_GLOBAL_TOKEN_BUDGET, settings.USAGE_GLOBAL_COST_BUDGET), 3),
+        'by_model': grouped('model'),
+        'by_purpose': grouped('purpose'),
+        'top_clients': grouped('client_key')[:top],
+    }
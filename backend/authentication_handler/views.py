@@ -1,14 +1,33 @@
 from django.shortcuts import render
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.conf import settings
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenRefreshView
-from .models import AgentProfile, PropertyAnalysis, PropertyAnalysisShare, SharedAnalysisView
+from .deadline import DeadlineExceeded, DeadlineRequestsClient, expired, get_deadline
+from .generation_results import get_result, store_result
+from .html_normalizer import normalize_analysis_html
+from .models import AgentProfile, AnalysisBatch, AnalysisJob, PropertyAnalysis, PropertyAnalysisShare, SharedAnalysisView, StreamedGeneration
+from .model_router import choose_model, get_model_stats
+from .notion_utils import build_headers, build_page_payload
+from .perplexity_stream import format_sse, stream_completion
+from .perplexity_service import PerplexityError, budget_error, complete, get_api_headers, get_content
+from .priority import set_package
+from .response_cache import BYPASS, HIT, MISS, make_cache_key, perplexity_cache
+from .resumable_stream import start_generation, tail_generation
+from .single_flight import perplexity_flights
+from .upstream_client import NOTION, NOTION_PAGES_URL, get_client, get_upstream_stats
+from .upstream_limiter import UpstreamBusy, current_client_key
+from .usage import BudgetExceeded, apply_budget, check_budget, get_client_usage, get_usage_rollup
+import csv
 import json
+import math
 import os
 import requests
 import stripe
@@ -18,6 +37,8 @@ logger = logging.getLogger(__name__)
 
 # Configure Stripe
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+# Stripe calls time out with the request's deadline instead of the 80s default
+stripe.default_http_client = DeadlineRequestsClient()
 
 # Create your views here.
 
@@ -280,8 +301,12 @@ def profile(request):
         })
     
     elif request.method == 'PUT':
+        from .agent_description_generator import profile_hash, schedule_description_refresh
+
         # Update profile
         user = request.user
+        # Inputs of the agent description before the update
+        description_hash = profile_hash(agent_profile.get_agent_description_data())
 
         # Helper function to check if a value is not empty or null
         def is_valid(value):
@@ -330,6 +355,11 @@ def profile(request):
         agent_profile.save()
         agent_profile.mark_profile_complete()
 
+        # Precompute the Welcome section so analyses don't wait for it, only
+        # when a field it is generated from changed
+        if profile_hash(agent_profile.get_agent_description_data()) != description_hash:
+            schedule_description_refresh(agent_profile)
+
         # Return updated profile data
         updated_profile_data = {
             'companyName': agent_profile.company_name,
@@ -370,49 +400,213 @@ def profile(request):
 
 @api_view(['POST'])
 def perplexity_proxy(request):
-    api_key = os.getenv('PERPLEXITY_API_KEY')
-    print("=======>>>>> PERPLEXITY_API_KEY in view ========<<<<<<<<", api_key)
-    if not api_key:
-        return Response({'error': 'API key not configured.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    url = 'https://api.perplexity.ai/chat/completions'
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json',
-        'accept': 'application/json',
-    }
+    try:
+        headers = get_api_headers()
+    except PerplexityError as e:
+        return _perplexity_error_response(e)
 
     if not request.data:
         return Response({'error': 'No data provided in the request.'}, status=status.HTTP_400_BAD_REQUEST)
-
-    # Allow frontend to specify model, default to 'sonar' if not provided
-    model = request.data.get('model', 'sonar')
     messages = request.data.get('messages')
-
     if not messages:
         return Response({'error': 'Field "messages" is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    payload = {
-        'model': model,
-        'messages': messages
-    }
+    # A model sent by the client is used if the package's tier allows it;
+    # otherwise the router picks one for the package (package_name is optional)
+    route = choose_model(request.data.get('package_name'), request.data.get('model'))
+    try:
+        route = apply_budget(route)
+    except BudgetExceeded as e:
+        return _perplexity_error_response(budget_error(e))
+    # Queue behind the upstream limiter with the package's priority
+    set_package(request.data.get('package_name'))
+    model = route.model
+
+    # Serve identical (model, messages) requests from the response cache.
+    # Clients can send "cache": false to force a fresh generation.
+    use_cache = settings.PERPLEXITY_CACHE_ENABLED and request.data.get('cache', True) is not False
+
+    # Opt-in server-sent events mode: "stream": true forwards chunks as they arrive
+    if request.data.get('stream') is True:
+        cache_key = make_cache_key(model, messages)
+        package_name = request.data.get('package_name') or ''
+        if use_cache:
+            cached = perplexity_cache.get(cache_key)
+            if cached is not None:
+                token = store_result(request.user, cached, model, route.reason, package_name=package_name)
+                if token:
+                    cached = dict(cached, result_token=token)
+                return _with_route(_event_stream_response(iter([format_sse(cached, event='done')]), HIT), route)
+
+
+        def on_complete(completion):
+            # The cached copy stays token-free; the token only goes to this client
+            if use_cache:
+                perplexity_cache.set(cache_key, model, completion)
+            token = store_result(request.user, completion, model, route.reason, package_name=package_name)
+            return {'result_token': token} if token else None
+
+        payload = {
+            'model': model,
+            'messages': messages
+        }
+        if settings.STREAM_RESUME_ENABLED and request.user.is_authenticated:
+            # Runs to the end even if the client drops; it resumes with the generation id
+            generation = start_generation(headers, payload, user=request.user, on_complete=on_complete)
+            return _with_route(_event_stream_response(
+                tail_generation(generation.generation_id, deadline=get_deadline()),
+                MISS if use_cache else BYPASS,
+            ), route)
+        return _with_route(_event_stream_response(
+            stream_completion(headers, payload, on_complete=on_complete, deadline=get_deadline(),
+                              client_key=current_client_key()),
+            MISS if use_cache else BYPASS,
+        ), route)
 
     try:
-        resp = requests.post(url, headers=headers, json=payload)
-        # If Perplexity returns a non-200 status, include details for debugging
-        if resp.status_code != 200:
-            try:
-                error_data = resp.json()
-            except Exception:
-                error_data = {'details': resp.text}
-            return Response({'error': 'Failed to get a valid response from Perplexity API', **error_data}, status=resp.status_code)
-        try:
-            data = resp.json()
-        except ValueError:
-            return Response({'error': 'Perplexity API did not return JSON data', 'content': resp.text}, status=resp.status_code)
-        return Response(data, status=resp.status_code)
-    except requests.exceptions.RequestException as e:
-        return Response({'error': f'Error occurred during the API call: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        data, cache_status = complete(model, messages, use_cache=use_cache)
+    except PerplexityError as e:
+        return _perplexity_error_response(e)
+    response = _with_route(_perplexity_response(data, cache_status), route)
+    # Kept server-side so the client can save it by token
+    token = store_result(request.user, data, model, route.reason, package_name=request.data.get('package_name') or '')
+    if token:
+        response['X-Result-Token'] = token
+    return response
+
+@api_view(['GET'])
+def resume_generation(request, generation_id):
+    """Resume a streamed Perplexity generation from a byte offset"""
+    try:
+        offset = int(request.query_params.get('offset', 0))
+    except ValueError:
+        return Response({'error': 'Parameter "offset" must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    if offset < 0:
+        return Response({'error': 'Parameter "offset" must not be negative.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Only the user who started a generation can resume it
+    generation = StreamedGeneration.objects.filter(generation_id=generation_id).first()
+    if generation is None or generation.user_id is None or generation.user_id != request.user.id:
+        return Response({'error': 'Generation not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    return _event_stream_response(tail_generation(generation.generation_id, offset, deadline=get_deadline()))
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def generate_property_analysis(request):
+    """Generate an analysis for an address from the server-side prompt template"""
+    from .analysis_generator import generate_analysis, parse_generation_options
+
+    address = (request.data.get('address') or '').strip()
+    if not address:
+        return Response({'error': 'Address is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    package_name = request.data.get('package_name', 'Professional')
+    try:
+        options = parse_generation_options(request.data.get('options'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    mode = options.get('mode')
+
+    route = choose_model(package_name, options.get('model'))
+    set_package(package_name)
+    try:
+        route = apply_budget(route)
+        result = generate_analysis(
+            request.user,
+            address,
+            model=route.model,
+            include_agent_description=options.get('include_agent_description', True) is not False,
+            use_cache=settings.PERPLEXITY_CACHE_ENABLED and options.get('cache', True) is not False,
+            mode=mode,
+        )
+    except BudgetExceeded as e:
+        return _perplexity_error_response(budget_error(e))
+    except PerplexityError as e:
+        return _perplexity_error_response(e)
+
+    # Same shape as the proxy response, plus what the client needs to save it
+    data = dict(
+        result.data,
+        agent_description=result.agent_description,
+        prompt_version=result.prompt_version,
+        package_name=package_name,
+        model_route=route.as_dict(),
+    )
+    data['result_token'] = store_result(
+        request.user, data, route.model, route.reason,
+        address=address,
+        package_name=package_name,
+        prompt_version=result.prompt_version,
+        agent_description=result.agent_description,
+    )
+    return _with_route(_perplexity_response(data, result.cache_status), route)
+
+def _perplexity_response(data, cache_status):
+    """Wrap a Perplexity completion, reporting how it was served"""
+    response = Response(data, status=status.HTTP_200_OK)
+    response['X-Cache'] = cache_status
+    return response
+
+def _with_route(response, route):
+    """Tell the client which model served the request and why"""
+    response['X-Model-Route'] = f'{route.model}; {route.reason}'
+    return response
+
+def _perplexity_error_response(error):
+    """Return a PerplexityError payload, telling the client when to retry"""
+    response = Response(error.payload, status=error.status_code)
+    if error.retry_after is not None:
+        response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+def _busy_response(error):
+    """503 for an upstream call that could not get a slot in time"""
+    response = Response({'error': str(error), 'retry_after': round(error.retry_after, 1)},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(math.ceil(error.retry_after))
+    return response
+
+def _deadline_response(upstream):
+    """504 for an upstream call cut short by the request's deadline"""
+    return Response({'error': f'{upstream} did not answer in time. Please try again.'},
+                    status=status.HTTP_504_GATEWAY_TIMEOUT)
+
+def _event_stream_response(events, cache_status=None):
+    """Stream server-sent events without proxy buffering"""
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    if cache_status is not None:
+        response['X-Cache'] = cache_status
+    return response
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def upstream_stats(request):
+    """Per-upstream outbound request stats for this worker process"""
+    return Response({
+        'upstreams': get_upstream_stats(),
+        'perplexity_cache': perplexity_cache.get_stats(),
+        'perplexity_single_flight': perplexity_flights.get_stats(),
+        'model_router': get_model_stats(),
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def usage_summary(request):
+    """The current user's upstream usage against their budget"""
+    return Response(get_client_usage(f'user:{request.user.pk}'), status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def usage_stats(request):
+    """Service-wide upstream usage with per-model, per-purpose and per-client rollups"""
+    try:
+        top = max(1, min(int(request.query_params.get('top', 10)), 100))
+    except ValueError:
+        return Response({'error': 'Parameter "top" must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(get_usage_rollup(top=top), status=status.HTTP_200_OK)
 
 @api_view(['POST'])
 def notion_proxy(request):
@@ -439,7 +633,7 @@ def notion_proxy(request):
 
     try:
         # Forward the POST request to the Notion API
-        resp = requests.post(notion_url, headers=headers, json=payload, timeout=30)  # Added timeout to prevent hanging requests
+        resp = get_client(NOTION).post(notion_url, headers=headers, json=payload)
 
         # Handle Notion API response
         if resp.status_code != 200:
@@ -457,7 +651,13 @@ def notion_proxy(request):
 
         return Response(data, status=resp.status_code)
 
+    except UpstreamBusy as e:
+        return _busy_response(e)
+    except DeadlineExceeded:
+        return _deadline_response('Notion')
     except requests.exceptions.RequestException as e:
+        if expired():
+            return _deadline_response('Notion')
         # Handle network-related errors (e.g., connection issues, timeouts, etc.)
         return Response({'error': f'Error occurred during the API call: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -476,50 +676,17 @@ def notion_format(request):
     if not perplexity_data:
         return Response({'error': 'No Perplexity data provided.'}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Notion API endpoint for creating a page (update as needed)
-    notion_url = 'https://api.notion.com/v1/pages'
-
     # Example: Format Perplexity data into Notion page properties (customize as needed)
     # This assumes you have a Notion database to add the page to
     NOTION_DATABASE_ID = os.getenv('NOTION_DATABASE_ID')
     if not NOTION_DATABASE_ID:
         return Response({'error': 'Notion database ID not configured.'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    # Example: instruct Notion to create a formatted page
-    # You may want to adjust the properties and content structure based on your Notion database schema
-    title = perplexity_data.get('title', 'Perplexity Result')
-    content = perplexity_data.get('content', str(perplexity_data))
-
-    payload = {
-        "parent": {"database_id": NOTION_DATABASE_ID},
-        "properties": {
-            "Name": {
-                "title": [
-                    {"text": {"content": title}}
-                ]
-            }
-        },
-        "children": [
-            {
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {
-                    "rich_text": [
-                        {"type": "text", "text": {"content": content}}
-                    ]
-                }
-            }
-        ]
-    }
-
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Notion-Version': '2022-06-28',
-        'Content-Type': 'application/json',
-    }
+    payload = build_page_payload(perplexity_data, NOTION_DATABASE_ID)
+    headers = build_headers(api_key)
 
     try:
-        resp = requests.post(notion_url, headers=headers, json=payload, timeout=30)
+        resp = get_client(NOTION).post(NOTION_PAGES_URL, headers=headers, json=payload)
         if resp.status_code != 200:
             try:
                 error_data = resp.json()
@@ -531,7 +698,13 @@ def notion_format(request):
         except ValueError:
             return Response({'error': 'Notion API did not return JSON data', 'content': resp.text}, status=resp.status_code)
         return Response(data, status=resp.status_code)
+    except UpstreamBusy as e:
+        return _busy_response(e)
+    except DeadlineExceeded:
+        return _deadline_response('Notion')
     except requests.exceptions.RequestException as e:
+        if expired():
+            return _deadline_response('Notion')
         return Response({'error': f'Error occurred during the API call: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -539,14 +712,22 @@ def notion_format(request):
 @permission_classes([IsAuthenticated])
 def save_property_analysis(request):
     """Save property analysis results for logged-in users"""
+    from .jobs import settle_paid_job
+
     try:
+        result_token = request.data.get('result_token')
+        if result_token:
+            return _save_generation_result(request, result_token)
+
         # Extract data from request
         address = request.data.get('address')
         package_name = request.data.get('package_name', 'Professional')
-        analysis_content = request.data.get('analysis_content')
+        analysis_content = normalize_analysis_html(request.data.get('analysis_content'))
         analysis_model = request.data.get('analysis_model', 'sonar')
         api_response = request.data.get('api_response', {})
         agent_description = request.data.get('agent_description', '')
+        # Routing decision returned by the generate endpoint
+        model_route = (api_response.get('model_route') if isinstance(api_response, dict) else None) or {}
 
         # Validate required fields
         if not address or not analysis_content:
@@ -559,30 +740,244 @@ def save_property_analysis(request):
             package_name=package_name,
             analysis_content=analysis_content,
             analysis_model=analysis_model,
+            prompt_version=request.data.get('prompt_version') or '',
+            model_route_reason=str(model_route.get('reason') or '')[:50],
             api_response=api_response,
             agent_description=agent_description,
             payment_intent_id=request.data.get('payment_intent_id')
         )
+        settle_paid_job(request.user, analysis.payment_intent_id, analysis)
+        return _saved_analysis_response(request, analysis)
 
-        # Get agent profile for headshot and logo
-        try:
-            agent_profile = request.user.agent_profile
-            headshot_url = agent_profile.headshot.url if agent_profile.headshot else None
-            logo_url = agent_profile.logo.url if agent_profile.logo else None
-        except AgentProfile.DoesNotExist:
-            headshot_url = None
-            logo_url = None
+    except Exception as e:
+        return Response({'error': f'Error saving analysis: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        return Response({
-            'message': 'Property analysis saved successfully.',
-            'analysis_id': analysis.id,
-            'created_at': analysis.created_at.isoformat(),
-            'headshot': headshot_url,
-            'logo': logo_url
-        }, status=status.HTTP_201_CREATED)
+def _save_generation_result(request, result_token):
+    """
+    Save a result kept by the generate or proxy endpoint
 
+    The completion is not uploaded again; the request only carries edits
+    (address, package_name, analysis_content, agent_description,
+    payment_intent_id). Saving the same token twice returns the first analysis.
+    """
+    from .jobs import settle_paid_job
+
+    with transaction.atomic():
+        # Locked so a double-submitted save creates one analysis
+        result = get_result(result_token, request.user, lock=True)
+        if result is None:
+            return Response({'error': 'Result not found or expired. Please generate the analysis again.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        if result.property_analysis_id is not None:
+            return _saved_analysis_response(request, result.property_analysis, status.HTTP_200_OK)
+
+        address = request.data.get('address') or result.address
+        analysis_content = normalize_analysis_html(
+            request.data.get('analysis_content') or get_content(result.api_response))
+        if not address or not analysis_content:
+            return Response({'error': 'Address and analysis content are required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        analysis = PropertyAnalysis.objects.create(
+            user=request.user,
+            address=address,
+            package_name=request.data.get('package_name') or result.package_name or 'Professional',
+            analysis_content=analysis_content,
+            analysis_model=result.analysis_model,
+            prompt_version=result.prompt_version,
+            model_route_reason=result.model_route_reason,
+            api_response=result.api_response,
+            agent_description=request.data.get('agent_description', result.agent_description),
+            payment_intent_id=request.data.get('payment_intent_id')
+        )
+        result.property_analysis = analysis
+        result.save(update_fields=['property_analysis'])
+        settle_paid_job(request.user, analysis.payment_intent_id, analysis)
+    return _saved_analysis_response(request, analysis)
+
+def _saved_analysis_response(request, analysis, status_code=status.HTTP_201_CREATED):
+    """Response of save_property_analysis"""
+    # Get agent profile for headshot and logo
+    try:
+        agent_profile = request.user.agent_profile
+        headshot_url = agent_profile.headshot.url if agent_profile.headshot else None
+        logo_url = agent_profile.logo.url if agent_profile.logo else None
+    except AgentProfile.DoesNotExist:
+        headshot_url = None
+        logo_url = None
+
+    return Response({
+        'message': 'Property analysis saved successfully.',
+        'analysis_id': analysis.id,
+        'created_at': analysis.created_at.isoformat(),
+        'headshot': headshot_url,
+        'logo': logo_url
+    }, status=status_code)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def submit_analysis_job(request):
+    """Queue an analysis for background generation"""
+    from .analysis_generator import parse_generation_options
+    from .jobs import serialize_job, submit_analysis_job as submit_job, submit_paid_analysis_job as submit_paid_job
+
+    address = request.data.get('address')
+    if not address:
+        return Response({'error': 'Address is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Without "messages" the worker renders the server-side prompt template
+    try:
+        options = parse_generation_options(request.data.get('options'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    job_options = {
+        'model': request.data.get('model', options.get('model')),
+        'messages': request.data.get('messages'),
+        'agent_description': request.data.get('agent_description', ''),
+        'include_agent_description': options.get('include_agent_description', True) is not False,
+        'mode': options.get('mode'),
+    }
+    payment_intent_id = request.data.get('payment_intent_id')
+    try:
+        if payment_intent_id:
+            # The payment webhook may have queued this analysis already
+            job, created = submit_paid_job(
+                request.user,
+                payment_intent_id,
+                address,
+                request.data.get('package_name', 'Professional'),
+                **job_options,
+            )
+            if job.user_id != request.user.id:
+                return Response({'error': 'Payment belongs to another account.'}, status=status.HTTP_409_CONFLICT)
+            return Response(serialize_job(job), status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK)
+
+        job = submit_job(
+            user=request.user,
+            address=address,
+            package_name=request.data.get('package_name', 'Professional'),
+            **job_options,
+        )
+        return Response(serialize_job(job), status=status.HTTP_202_ACCEPTED)
     except Exception as e:
-        return Response({'error': f'Error saving analysis: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({'error': f'Error queuing analysis: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_analysis_job(request, job_id):
+    """Get the status of a queued analysis job"""
+    from .jobs import serialize_job
+
+    job = AnalysisJob.objects.filter(id=job_id, user=request.user).first()
+    if job is None:
+        return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(serialize_job(job), status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def take_over_analysis_job(request, job_id):
+    """
+    Take a still-queued job over to generate its analysis inline
+
+    Answers 409 with the job when a worker got to it first; the client should
+    then keep waiting for the job instead of generating it as well.
+    """
+    from .jobs import serialize_job, take_over_job
+
+    job, taken = take_over_job(request.user, job_id)
+    if job is None:
+        return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(serialize_job(job), status=status.HTTP_200_OK if taken else status.HTTP_409_CONFLICT)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def wait_analysis_job(request, job_id):
+    """
+    Current state of an analysis job, for clients that long-poll it
+
+    Sync workers are too few to hold a request open, so this answers at once
+    with a Retry-After hint while the job is unfinished; the async version
+    (ASGI mode) waits for up to ``timeout`` seconds instead.
+    """
+    from .jobs import serialize_job
+
+    job = AnalysisJob.objects.filter(id=job_id, user=request.user).first()
+    if job is None:
+        return Response({'error': 'Job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    response = Response(serialize_job(job), status=status.HTTP_200_OK)
+    if not job.is_finished:
+        response['Retry-After'] = str(settings.ANALYSIS_JOB_CLIENT_POLL_INTERVAL)
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def submit_analysis_batch(request):
+    """Queue analyses for a list of addresses (JSON list or CSV upload)"""
+    from .analysis_generator import parse_generation_options
+    from .jobs import parse_batch_addresses, serialize_batch, submit_analysis_batch as submit_batch
+
+    upload = request.FILES.get('file')
+    if upload is not None:
+        try:
+            addresses = parse_batch_addresses(upload.read().decode('utf-8-sig'))
+        except (UnicodeDecodeError, csv.Error) as e:
+            return Response({'error': f'Could not read the CSV file: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
+    else:
+        addresses = request.data.get('addresses')
+        if not isinstance(addresses, list):
+            return Response({'error': 'Provide "addresses" as a list or upload a CSV "file".'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        addresses = [str(address).strip() for address in addresses if str(address or '').strip()]
+
+    if not addresses:
+        return Response({'error': 'At least one address is required.'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(addresses) > settings.ANALYSIS_BATCH_MAX_ITEMS:
+        return Response({'error': f'A batch can have at most {settings.ANALYSIS_BATCH_MAX_ITEMS} addresses.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    # Multipart uploads send options as plain form fields
+    try:
+        options = parse_generation_options(request.data.get('options'))
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    concurrency = request.data.get('concurrency')
+    try:
+        concurrency = int(concurrency) if concurrency not in (None, '') else None
+    except (TypeError, ValueError):
+        return Response({'error': 'Field "concurrency" must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        batch = submit_batch(
+            request.user,
+            addresses,
+            package_name=request.data.get('package_name', 'Professional'),
+            model=options.get('model'),
+            concurrency=concurrency,
+            name=request.data.get('name') or '',
+            include_agent_description=options.get('include_agent_description', True) is not False,
+            mode=options.get('mode'),
+        )
+    except Exception as e:
+        return Response({'error': f'Error queuing batch: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(serialize_batch(batch), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_analysis_batch(request, batch_id):
+    """Get aggregate and per-address progress of an analysis batch"""
+    from .jobs import serialize_batch
+
+    batch = AnalysisBatch.objects.filter(id=batch_id, user=request.user).first()
+    if batch is None:
+        return Response({'error': 'Batch not found.'}, status=status.HTTP_404_NOT_FOUND)
+    # "?jobs=false" returns only the aggregate counts, for cheap polling
+    include_jobs = request.GET.get('jobs', 'true').lower() != 'false'
+    return Response(serialize_batch(batch, include_jobs=include_jobs), status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -648,10 +1043,13 @@ def get_property_analysis(request, analysis_id):
             'package_name': analysis.package_name,
             'analysis_content': analysis.analysis_content,
             'analysis_model': analysis.analysis_model,
+            'model_route_reason': analysis.model_route_reason,
+            'prompt_version': analysis.prompt_version,
             'api_response': analysis.api_response,
             'agent_description': analysis.agent_description,
             'created_at': analysis.created_at.isoformat(),
             'updated_at': analysis.updated_at.isoformat(),
+            'refreshed_at': analysis.refreshed_at.isoformat() if analysis.refreshed_at else None,
             'headshot': headshot_url,
             'logo': logo_url
         }
@@ -664,6 +1062,48 @@ def get_property_analysis(request, analysis_id):
         return Response({'error': f'Error fetching analysis: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def refresh_property_analysis(request, analysis_id):
+    """Regenerate the time-sensitive sections of a saved analysis"""
+    from .analysis_prompts import SECTION_KEYS
+    from .analysis_refresh import refresh_analysis
+
+    analysis = PropertyAnalysis.objects.filter(id=analysis_id, user=request.user).first()
+    if analysis is None:
+        return Response({'error': 'Analysis not found.'}, status=status.HTTP_404_NOT_FOUND)
+
+    # Defaults to the time-sensitive sections (listings, pricing, market report)
+    sections = request.data.get('sections')
+    if sections is not None and (not isinstance(sections, list) or not set(sections) <= set(SECTION_KEYS)):
+        return Response({'error': f'Field "sections" must be a list of: {", ".join(SECTION_KEYS)}.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    set_package(analysis.package_name)
+    try:
+        check_budget()
+    except BudgetExceeded as e:
+        return _perplexity_error_response(budget_error(e))
+    result = refresh_analysis(
+        analysis,
+        keys=sections,
+        use_cache=settings.PERPLEXITY_CACHE_ENABLED and request.data.get('cache', True) is not False,
+    )
+    if result.failed and not result.refreshed:
+        return Response({'error': 'Failed to refresh the analysis. Please try again.',
+                         'failed_sections': result.failed}, status=status.HTTP_502_BAD_GATEWAY)
+
+    return Response({
+        'id': analysis.id,
+        'analysis_content': analysis.analysis_content,
+        'refreshed_sections': result.refreshed,
+        'reused_sections': result.reused,
+        'failed_sections': result.failed,
+        'refreshed_at': analysis.refreshed_at.isoformat() if analysis.refreshed_at else None,
+        'updated_at': analysis.updated_at.isoformat(),
+    }, status=status.HTTP_200_OK)
+
+
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated])
 def delete_property_analysis(request, analysis_id):
@@ -692,7 +1132,7 @@ def update_property_analysis(request, analysis_id):
         # Update the analysis content
         analysis_content = request.data.get('analysis_content')
         if analysis_content is not None:
-            analysis.analysis_content = analysis_content
+            analysis.analysis_content = normalize_analysis_html(analysis_content)
             analysis.save()
 
         return Response({
@@ -751,6 +1191,8 @@ def create_payment_intent(request):
         }, status=status.HTTP_200_OK)
 
     except stripe.error.StripeError as e:
+        if isinstance(e, stripe.error.APIConnectionError) and expired():
+            return _deadline_response('Stripe')
         return Response({'error': f'Stripe error: {str(e)}'}, status=status.HTTP_400_BAD_REQUEST)
     except Exception as e:
         return Response({'error': f'Error creating payment intent: {str(e)}'}, 
@@ -790,10 +1232,13 @@ def stripe_webhook(request):
             # Log successful payment
             print(f"Payment succeeded for user {user_id}: {package_name} package for {address}")
             
+            # Start generating right away; the client picks up the job by payment_intent_id
+            from .jobs import queue_analysis_for_payment
+            queue_analysis_for_payment(payment_intent)
+            
             # You can add additional logic here, such as:
             # - Sending confirmation emails
             # - Updating user subscriptions
-            # - Triggering property analysis
             
         elif event['type'] == 'payment_intent.payment_failed':
             payment_intent = event['data']['object']
@@ -879,7 +1324,7 @@ def share_analysis(request):
                     user=request.user,
                     address=property_address,
                     package_name='Shared Analysis',
-                    analysis_content=analysis_content or '',
+                    analysis_content=normalize_analysis_html(analysis_content),
                     analysis_model='shared',
                     api_response={}
                 )
@@ -1274,30 +1719,13 @@ def generate_agent_description(request):
                           status=status.HTTP_404_NOT_FOUND)
         
         # Import the agent description generator
-        from .agent_description_generator import generate_agent_description
-        
-        # Prepare agent data for the generator
-        agent_data = {
-            'first_name': request.user.first_name,
-            'last_name': request.user.last_name,
-            'company_name': agent_profile.company_name,
-            'years_experience': agent_profile.years_experience,
-            'specialty': agent_profile.specialty,
-            'awards': agent_profile.awards,
-            'mission': agent_profile.mission,
-            'value_proposition': agent_profile.value_proposition,
-            'selling_style': agent_profile.selling_style,
-            'shortest_sale': agent_profile.shortest_sale,
-            'highest_sale': agent_profile.highest_sale,
-            'avg_days_on_market': agent_profile.avg_days_on_market,
-            'testimonial_1': agent_profile.testimonial_1,
-            'testimonial_2': agent_profile.testimonial_2,
-            'testimonial_3': agent_profile.testimonial_3,
-            'community_ties': agent_profile.community_ties,
-        }
+        from .agent_description_generator import get_cached_agent_description
         
-        # Generate the agent description
-        description = generate_agent_description(agent_data)
+        # Served from the stored description unless the profile changed
+        description = get_cached_agent_description(
+            agent_profile,
+            regenerate=request.data.get('regenerate') is True,
+        )
         
         if not description:
             return Response({'error': 'Failed to generate agent description. Please try again.'}, 
@@ -58,6 +58,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'authentication_handler.middleware.UpstreamClientKeyMiddleware',
+    'authentication_handler.middleware.RequestDeadlineMiddleware',
 ]
 
 ROOT_URLCONF = 'real_estate.urls'
@@ -88,6 +90,13 @@ POSTGRES_USER = os.getenv('POSTGRES_USER')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD')
 POSTGRES_HOST = os.getenv('POSTGRES_HOST', 'localhost')
 POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
+# Connection string provided by the hosting platform (e.g. Render's fromDatabase),
+# used when the POSTGRES_* settings are not set
+DATABASE_URL = os.getenv('DATABASE_URL')
+# Used when neither is set. A deployment that switches to a database server
+# starts empty: run "python manage.py copy_sqlite_data" once to move this
+# file's rows over (it is reachable as the "sqlite" database while it exists).
+SQLITE_DATABASE = BASE_DIR / 'db.sqlite3'
 
 if POSTGRES_DB and POSTGRES_USER and POSTGRES_PASSWORD:
     DATABASES = {
@@ -100,13 +109,22 @@ if POSTGRES_DB and POSTGRES_USER and POSTGRES_PASSWORD:
             'PORT': POSTGRES_PORT,
         }
     }
+elif DATABASE_URL:
+    DATABASES = {
+        'default': dj_database_url.parse(DATABASE_URL),
+    }
 else:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'db.sqlite3',
+            'NAME': SQLITE_DATABASE,
         }
-        # 'default': dj_database_url.config(default=os.getenv('DATABASE_URL'))
+    }
+
+if DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3' and SQLITE_DATABASE.exists():
+    DATABASES['sqlite'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': SQLITE_DATABASE,
     }
 
 
@@ -210,6 +228,12 @@ CORS_ALLOW_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
 ]
+CORS_EXPOSE_HEADERS = [
+    'x-cache',
+    'x-model-route',
+    'x-result-token',
+    'retry-after',
+]
 
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -229,3 +253,203 @@ if DEBUG and not EMAIL_HOST_USER:
 EMAIL_TIMEOUT = 30
 EMAIL_SSL_KEYFILE = None
 EMAIL_SSL_CERTFILE = None
+
+# Outbound upstream HTTP clients (Perplexity, Notion)
+# Read timeouts stay below gunicorn's 120s worker timeout so slow upstreams
+# surface as clean errors instead of worker kills.
+PERPLEXITY_CONNECT_TIMEOUT = float(os.getenv('PERPLEXITY_CONNECT_TIMEOUT', 5))
+PERPLEXITY_READ_TIMEOUT = float(os.getenv('PERPLEXITY_READ_TIMEOUT', 100))
+NOTION_CONNECT_TIMEOUT = float(os.getenv('NOTION_CONNECT_TIMEOUT', 5))
+NOTION_READ_TIMEOUT = float(os.getenv('NOTION_READ_TIMEOUT', 30))
+UPSTREAM_POOL_MAXSIZE = int(os.getenv('UPSTREAM_POOL_MAXSIZE', 10))
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 2))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', 0.5))
+
+# Upstream concurrency limits (per process). Calls queue for up to
+# UPSTREAM_QUEUE_TIMEOUT seconds for a slot, then fail with 503. A 429 halves
+# the limit and pauses the upstream for its Retry-After (or an exponential
+# backoff), after which the call is retried up to UPSTREAM_THROTTLE_RETRIES times.
+PERPLEXITY_MAX_CONCURRENCY = int(os.getenv('PERPLEXITY_MAX_CONCURRENCY', 16))
+NOTION_MAX_CONCURRENCY = int(os.getenv('NOTION_MAX_CONCURRENCY', 8))
+UPSTREAM_PER_USER_CONCURRENCY = int(os.getenv('UPSTREAM_PER_USER_CONCURRENCY', 4))
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv('UPSTREAM_QUEUE_TIMEOUT', 15))
+UPSTREAM_THROTTLE_RETRIES = int(os.getenv('UPSTREAM_THROTTLE_RETRIES', 2))
+UPSTREAM_THROTTLE_BASE_BACKOFF = float(os.getenv('UPSTREAM_THROTTLE_BASE_BACKOFF', 1))
+UPSTREAM_THROTTLE_MAX_BACKOFF = float(os.getenv('UPSTREAM_THROTTLE_MAX_BACKOFF', 30))
+# Anonymous callers are limited and budgeted by IP. X-Forwarded-For is trusted
+# only for the hops appended by this many reverse proxies in front of the app
+# (1 on Render); with 0 the header, which clients can forge, is ignored.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+
+# Perplexity API keys (comma separated; PERPLEXITY_API_KEY when unset). Each call
+# uses the least-loaded key; a throttled key sits out its backoff while the
+# others keep serving, and PERPLEXITY_MAX_CONCURRENCY applies per key.
+PERPLEXITY_API_KEYS = os.getenv('PERPLEXITY_API_KEYS') or os.getenv('PERPLEXITY_API_KEY', '')
+
+# Perplexity circuit breaker and hedged requests
+# The circuit opens when at least PERPLEXITY_BREAKER_FAILURE_RATE of the calls in
+# the last PERPLEXITY_BREAKER_WINDOW seconds failed (5xx, connection error or
+# slower than PERPLEXITY_BREAKER_SLOW_CALL_SECONDS); calls then fail fast (stale
+# cache or 503) for PERPLEXITY_BREAKER_OPEN_SECONDS before a probe is let through.
+# Hedging sends a second attempt when a call outlives the recent p95 latency
+# (at least PERPLEXITY_HEDGE_MIN_DELAY), for at most PERPLEXITY_HEDGE_MAX_RATIO of calls.
+PERPLEXITY_BREAKER_ENABLED = os.getenv('PERPLEXITY_BREAKER_ENABLED', 'True').lower() == 'true'
+PERPLEXITY_BREAKER_FAILURE_RATE = float(os.getenv('PERPLEXITY_BREAKER_FAILURE_RATE', 0.5))
+PERPLEXITY_BREAKER_SLOW_CALL_SECONDS = float(os.getenv('PERPLEXITY_BREAKER_SLOW_CALL_SECONDS', 60))
+PERPLEXITY_BREAKER_MIN_CALLS = int(os.getenv('PERPLEXITY_BREAKER_MIN_CALLS', 10))
+PERPLEXITY_BREAKER_WINDOW = float(os.getenv('PERPLEXITY_BREAKER_WINDOW', 60))
+PERPLEXITY_BREAKER_OPEN_SECONDS = float(os.getenv('PERPLEXITY_BREAKER_OPEN_SECONDS', 30))
+PERPLEXITY_HEDGE_ENABLED = os.getenv('PERPLEXITY_HEDGE_ENABLED', 'False').lower() == 'true'
+PERPLEXITY_HEDGE_MIN_DELAY = float(os.getenv('PERPLEXITY_HEDGE_MIN_DELAY', 2))
+PERPLEXITY_HEDGE_MAX_RATIO = float(os.getenv('PERPLEXITY_HEDGE_MAX_RATIO', 0.1))
+
+# Perplexity response cache
+# In-process LRU (bounded by PERPLEXITY_CACHE_MAX_BYTES) backed by a database
+# tier shared across workers. Entries older than PERPLEXITY_CACHE_TTL are only
+# served when the upstream fails, for up to PERPLEXITY_CACHE_STALE_TTL more seconds.
+PERPLEXITY_CACHE_ENABLED = os.getenv('PERPLEXITY_CACHE_ENABLED', 'True').lower() == 'true'
+PERPLEXITY_CACHE_PERSIST = os.getenv('PERPLEXITY_CACHE_PERSIST', 'True').lower() == 'true'
+PERPLEXITY_CACHE_TTL = int(os.getenv('PERPLEXITY_CACHE_TTL', 60 * 60 * 24))  # 24 hours
+PERPLEXITY_CACHE_STALE_TTL = int(os.getenv('PERPLEXITY_CACHE_STALE_TTL', 60 * 60 * 24 * 7))  # 7 days
+PERPLEXITY_CACHE_MAX_BYTES = int(os.getenv('PERPLEXITY_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # 32 MB
+# Identical Perplexity requests already in flight wait for the first call
+# (in-process, and across workers via a Postgres advisory lock / local file lock)
+PERPLEXITY_SINGLE_FLIGHT_ENABLED = os.getenv('PERPLEXITY_SINGLE_FLIGHT_ENABLED', 'True').lower() == 'true'
+# Longest another worker waits for the cross-process holder before making the call itself
+PERPLEXITY_SINGLE_FLIGHT_WAIT = float(os.getenv('PERPLEXITY_SINGLE_FLIGHT_WAIT', 20))
+
+# ASGI deployment mode (SERVER_MODE=asgi in start.sh)
+# Routes the I/O-bound views to their async versions, which share one
+# non-blocking connection pool per upstream and event loop.
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi').lower()
+ASYNC_UPSTREAM_VIEWS = SERVER_MODE == 'asgi'
+UPSTREAM_ASYNC_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_ASYNC_MAX_CONNECTIONS', 200))
+
+# Background analysis jobs (python manage.py run_analysis_worker)
+ANALYSIS_WORKER_CONCURRENCY = int(os.getenv('ANALYSIS_WORKER_CONCURRENCY', 4))
+ANALYSIS_JOB_MAX_ATTEMPTS = int(os.getenv('ANALYSIS_JOB_MAX_ATTEMPTS', 3))
+ANALYSIS_JOB_RETRY_BACKOFF = float(os.getenv('ANALYSIS_JOB_RETRY_BACKOFF', 10))
+ANALYSIS_JOB_STALE_SECONDS = int(os.getenv('ANALYSIS_JOB_STALE_SECONDS', 600))
+# How often running workers look for jobs abandoned by a worker that died
+ANALYSIS_JOB_REQUEUE_INTERVAL = float(os.getenv('ANALYSIS_JOB_REQUEUE_INTERVAL', 60))
+ANALYSIS_JOB_POLL_INTERVAL = float(os.getenv('ANALYSIS_JOB_POLL_INTERVAL', 1))
+# Long-polls of a job are held open in ASGI mode only; sync workers answer at
+# once and ask the client to poll again after ANALYSIS_JOB_CLIENT_POLL_INTERVAL
+ANALYSIS_JOB_LONG_POLL_MAX = float(os.getenv('ANALYSIS_JOB_LONG_POLL_MAX', 25))
+ANALYSIS_JOB_CLIENT_POLL_INTERVAL = int(os.getenv('ANALYSIS_JOB_CLIENT_POLL_INTERVAL', 3))
+
+# Analysis generation
+# "single" asks for the whole report in one call; "sections" fans out one
+# call per section, ANALYSIS_SECTION_CONCURRENCY at a time
+ANALYSIS_GENERATION_MODE = os.getenv('ANALYSIS_GENERATION_MODE', 'single')
+ANALYSIS_SECTION_CONCURRENCY = int(os.getenv('ANALYSIS_SECTION_CONCURRENCY', 4))
+ANALYSIS_SECTION_MAX_ATTEMPTS = int(os.getenv('ANALYSIS_SECTION_MAX_ATTEMPTS', 3))
+ANALYSIS_SECTION_RETRY_BACKOFF = float(os.getenv('ANALYSIS_SECTION_RETRY_BACKOFF', 1))
+
+# Agent descriptions are stored with a hash of the profile fields they were
+# generated from and regenerated in the background when a profile update
+# changes those fields
+AGENT_DESCRIPTION_PRECOMPUTE = os.getenv('AGENT_DESCRIPTION_PRECOMPUTE', 'True').lower() == 'true'
+AGENT_DESCRIPTION_REFRESH_WORKERS = int(os.getenv('AGENT_DESCRIPTION_REFRESH_WORKERS', 2))
+
+# Shared address research: research-only analysis sections (market, neighborhood,
+# buyer profile) are stored per canonical address and reused by every agent for
+# ADDRESS_RESEARCH_MAX_AGE seconds; agent-specific sections are always generated
+ADDRESS_RESEARCH_ENABLED = os.getenv('ADDRESS_RESEARCH_ENABLED', 'True').lower() == 'true'
+ADDRESS_RESEARCH_MAX_AGE = int(os.getenv('ADDRESS_RESEARCH_MAX_AGE', 60 * 60 * 24 * 3))  # 3 days
+
+# Resumable streaming: streamed Perplexity completions run on a background
+# thread pool and are saved under a generation id as they arrive (every
+# STREAM_GENERATION_FLUSH_INTERVAL seconds), so a client that drops can resume
+# from its last offset. Only signed-in users' streams are resumable, and only by
+# the user who started them. Generations are kept for STREAM_GENERATION_RETENTION seconds.
+STREAM_RESUME_ENABLED = os.getenv('STREAM_RESUME_ENABLED', 'True').lower() == 'true'
+STREAM_GENERATION_WORKERS = int(os.getenv('STREAM_GENERATION_WORKERS', 16))
+STREAM_GENERATION_FLUSH_INTERVAL = float(os.getenv('STREAM_GENERATION_FLUSH_INTERVAL', 1))
+STREAM_GENERATION_POLL_INTERVAL = float(os.getenv('STREAM_GENERATION_POLL_INTERVAL', 0.5))
+STREAM_GENERATION_LIVE_POLL_INTERVAL = float(os.getenv('STREAM_GENERATION_LIVE_POLL_INTERVAL', 0.05))
+STREAM_GENERATION_KEEPALIVE = float(os.getenv('STREAM_GENERATION_KEEPALIVE', 15))
+STREAM_GENERATION_STALE_SECONDS = int(os.getenv('STREAM_GENERATION_STALE_SECONDS', 120))
+STREAM_GENERATION_RETENTION = int(os.getenv('STREAM_GENERATION_RETENTION', 60 * 60 * 24))  # 1 day
+# A generation no client has read for this many seconds is cancelled (0 never cancels);
+# keep it well above the time a client takes to reconnect (tab reloads, network switches)
+STREAM_GENERATION_ABANDON_AFTER = float(os.getenv('STREAM_GENERATION_ABANDON_AFTER', 300))
+
+# Batch analyses: each batch runs at most its own concurrency of jobs at once
+# (default ANALYSIS_BATCH_CONCURRENCY). Batch jobs all count against their
+# owner's UPSTREAM_PER_USER_CONCURRENCY, so a higher cap would only queue.
+ANALYSIS_BATCH_MAX_ITEMS = int(os.getenv('ANALYSIS_BATCH_MAX_ITEMS', 200))
+ANALYSIS_BATCH_MAX_CONCURRENCY = int(os.getenv('ANALYSIS_BATCH_MAX_CONCURRENCY', UPSTREAM_PER_USER_CONCURRENCY))
+ANALYSIS_BATCH_CONCURRENCY = int(os.getenv('ANALYSIS_BATCH_CONCURRENCY', ANALYSIS_BATCH_MAX_CONCURRENCY))
+
+# Incremental refresh of saved analyses: only the time-sensitive sections
+# (listings, pricing, market report) are regenerated, on demand or by the
+# refresh_stale_analyses command for analyses older than ANALYSIS_REFRESH_AFTER
+ANALYSIS_REFRESH_AFTER = int(os.getenv('ANALYSIS_REFRESH_AFTER', 60 * 60 * 24 * 14))  # 14 days
+ANALYSIS_REFRESH_CONCURRENCY = int(os.getenv('ANALYSIS_REFRESH_CONCURRENCY', 2))
+
+# Model router: packages map to a primary and a faster fallback Perplexity
+# model ("Package:primary/fallback", comma separated; other packages use sonar).
+# A primary whose p95 latency over the last MODEL_ROUTER_WINDOW seconds exceeds
+# MODEL_ROUTER_LATENCY_SLO seconds, or whose error rate exceeds
+# MODEL_ROUTER_MAX_ERROR_RATE, is replaced by its fallback for
+# MODEL_ROUTER_FALLBACK_SECONDS. A model sent by the client is only used when it
+# is in its package's tier (or is sonar); any other is ignored and routed instead.
+MODEL_ROUTER_ENABLED = os.getenv('MODEL_ROUTER_ENABLED', 'True').lower() == 'true'
+MODEL_ROUTER_TIERS = os.getenv(
+    'MODEL_ROUTER_TIERS',
+    'Starter:sonar,Pro:sonar-pro/sonar,Elite:sonar-pro/sonar,Enterprise:sonar-pro/sonar',
+)
+MODEL_ROUTER_LATENCY_SLO = float(os.getenv('MODEL_ROUTER_LATENCY_SLO', 45))
+MODEL_ROUTER_MAX_ERROR_RATE = float(os.getenv('MODEL_ROUTER_MAX_ERROR_RATE', 0.2))
+MODEL_ROUTER_MIN_CALLS = int(os.getenv('MODEL_ROUTER_MIN_CALLS', 10))
+MODEL_ROUTER_WINDOW = float(os.getenv('MODEL_ROUTER_WINDOW', 300))
+MODEL_ROUTER_FALLBACK_SECONDS = float(os.getenv('MODEL_ROUTER_FALLBACK_SECONDS', 120))
+
+# Request deadline: outbound calls (Perplexity, Notion, Stripe, SMTP) time out
+# with what is left of REQUEST_DEADLINE_SECONDS, so a slow upstream ends in a 504
+# before gunicorn's 120s worker timeout. Streams end there too and are resumed
+# by the client. 0 disables the deadline.
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', 100))
+
+# Priority scheduling: queued analysis jobs and calls waiting for an upstream
+# slot are served by weighted fair queuing on their package ("Package:weight",
+# comma separated; other packages get ANALYSIS_PRIORITY_DEFAULT_WEIGHT). Queue
+# wait estimates use the job throughput of the last
+# ANALYSIS_QUEUE_THROUGHPUT_WINDOW seconds.
+ANALYSIS_PRIORITY_WEIGHTS = os.getenv(
+    'ANALYSIS_PRIORITY_WEIGHTS',
+    'Enterprise:8,Elite:6,Pro:4,Professional:4,Starter:2',
+)
+ANALYSIS_PRIORITY_DEFAULT_WEIGHT = float(os.getenv('ANALYSIS_PRIORITY_DEFAULT_WEIGHT', 1))
+ANALYSIS_QUEUE_THROUGHPUT_WINDOW = float(os.getenv('ANALYSIS_QUEUE_THROUGHPUT_WINDOW', 600))
+
+# Usage accounting: every Perplexity completion is recorded with its tokens and
+# cost (reported by Perplexity, else estimated from USAGE_MODEL_PRICES,
+# "model:input/output" USD per million tokens). Budgets cover the last
+# USAGE_BUDGET_WINDOW seconds, per client (signed-in user or IP) and for the
+# whole service; 0 means unlimited. Past USAGE_BUDGET_DOWNGRADE_AT of a budget
+# calls use USAGE_BUDGET_DOWNGRADE_MODEL, and a used-up budget rejects them with 429.
+USAGE_TRACKING_ENABLED = os.getenv('USAGE_TRACKING_ENABLED', 'True').lower() == 'true'
+USAGE_MODEL_PRICES = os.getenv(
+    'USAGE_MODEL_PRICES',
+    'sonar:1/1,sonar-pro:3/15,sonar-reasoning:1/5,sonar-reasoning-pro:2/8,sonar-deep-research:2/8',
+)
+USAGE_BUDGET_WINDOW = int(os.getenv('USAGE_BUDGET_WINDOW', 86400))
+USAGE_CLIENT_TOKEN_BUDGET = int(os.getenv('USAGE_CLIENT_TOKEN_BUDGET', 2000000))
+USAGE_CLIENT_COST_BUDGET = float(os.getenv('USAGE_CLIENT_COST_BUDGET', 0))
+USAGE_GLOBAL_TOKEN_BUDGET = int(os.getenv('USAGE_GLOBAL_TOKEN_BUDGET', 0))
+USAGE_GLOBAL_COST_BUDGET = float(os.getenv('USAGE_GLOBAL_COST_BUDGET', 0))
+USAGE_BUDGET_DOWNGRADE_AT = float(os.getenv('USAGE_BUDGET_DOWNGRADE_AT', 0.8))
+USAGE_BUDGET_DOWNGRADE_MODEL = os.getenv('USAGE_BUDGET_DOWNGRADE_MODEL', 'sonar')
+
+# Generation results: completions returned to signed-in users are kept for
+# GENERATION_RESULT_TTL seconds under a result token, which save_property_analysis
+# accepts instead of the uploaded completion
+GENERATION_RESULTS_ENABLED = os.getenv('GENERATION_RESULTS_ENABLED', 'True').lower() == 'true'
+GENERATION_RESULT_TTL = int(os.getenv('GENERATION_RESULT_TTL', 60 * 60 * 2))  # 2 hours
+
+# Analysis HTML normalization: stored analyses are cleaned once (stray markdown
+# converted, citation markers stripped, tags filtered against an allowlist and
+# whitespace minified) instead of on every render
+ANALYSIS_HTML_NORMALIZE = os.getenv('ANALYSIS_HTML_NORMALIZE', 'True').lower() == 'true'
@@ -8,5 +8,11 @@ echo "Starting Real Estate API..."
 echo "Running database migrations..."
 python manage.py migrate --noinput
 
-echo "Starting Gunicorn server with extended timeout..."
-gunicorn real_estate.wsgi:application --bind 0.0.0.0:$PORT --timeout 120 --keep-alive 60 --workers 2 
\ No newline at end of file
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+    # Async views hold many upstream calls per process; sync views run in threads
+    echo "Starting Uvicorn server (ASGI mode)..."
+    uvicorn real_estate.asgi:application --host 0.0.0.0 --port $PORT --workers ${WEB_CONCURRENCY:-2} --timeout-keep-alive 60
+else
+    echo "Starting Gunicorn server with extended timeout..."
+    gunicorn real_estate.wsgi:application --bind 0.0.0.0:$PORT --timeout 120 --keep-alive 60 --workers 2 
+fi
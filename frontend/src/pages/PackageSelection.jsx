@@ -79,10 +79,15 @@ const packages = [
   }
 ];
 
+// How long checkout waits for the analysis worker before taking over
+const JOB_WAIT_SECONDS = 180;
+
 const PackageSelection = ({ onSelect, onPerplexityResult, onBack, address }) => {
   const [selectedPackage, setSelectedPackage] = useState(null);
   const [showCheckout, setShowCheckout] = useState(false);
   const [isProcessing, setIsProcessing] = useState(false);
+  const [queueStatus, setQueueStatus] = useState(null);
+  const [pendingJob, setPendingJob] = useState(null);
   const [billingInfo, setBillingInfo] = useState({ name: '', email: '' });
 
   const handleSelect = async (pkg) => {
@@ -98,41 +103,74 @@ const PackageSelection = ({ onSelect, onPerplexityResult, onBack, address }) =>
     setShowCheckout(true);
   };
 
+  // Wait for the paid job; if no worker has picked it up in time, generate
+  // the analysis here instead and save it against the payment
+  const awaitPaidAnalysis = async (api, jobId, paymentIntentId) => {
+    const job = await api.waitForAnalysisJob(jobId, 25, setQueueStatus, JOB_WAIT_SECONDS);
+
+    if (job.status === 'succeeded' && job.analysis_id) {
+      // The worker saves the analysis itself, attached to the payment
+      const analysis = await api.getPropertyAnalysis(job.analysis_id);
+      onPerplexityResult(address, {
+        ...analysis.api_response,
+        agent_description: analysis.agent_description || '',
+        prompt_version: analysis.prompt_version || '',
+        package_name: analysis.package_name,
+      });
+      return;
+    }
+
+    if (job.status === 'queued') {
+      // Claim the job first so a worker cannot start it while this page
+      // generates; if one already has, keep waiting for it instead
+      const { taken } = await api.takeOverAnalysisJob(jobId);
+      if (!taken) {
+        return awaitPaidAnalysis(api, jobId, paymentIntentId);
+      }
+      setQueueStatus(null);
+      const data = await api.perplexityAnalyze(address, selectedPackage.name);
+      if (data.result_token) {
+        try {
+          // Saving against the payment also closes the taken-over job
+          await api.saveGeneratedAnalysis(data.result_token, {
+            address: address,
+            package_name: selectedPackage.name,
+            payment_intent_id: paymentIntentId,
+          });
+        } catch (saveError) {
+          console.error('Error saving property analysis:', saveError);
+        }
+      }
+      onPerplexityResult(address, data);
+      return;
+    }
+
+    if (job.status === 'running') {
+      // A worker is on it; generating here as well would bill the analysis twice
+      setPendingJob({ jobId, paymentIntentId });
+      return;
+    }
+
+    throw new Error(job.error || 'Analysis generation failed');
+  };
+
   const handlePaymentSuccess = async (paymentResult) => {
     setIsProcessing(true);
     setShowCheckout(false);
     
     try {
-      // After payment is processed, call Perplexity API
+      // After payment is processed, pick up the analysis the payment webhook
+      // already started (or start it if the webhook has not arrived yet)
       if (address && onPerplexityResult) {
-        // Call real Perplexity API
         const { api } = await import('../utils/api');
-        const data = await api.perplexityAnalyze(address);
-        
-        // Save the analysis to the database if user is logged in
-        const token = localStorage.getItem('token');
-        if (token && data.choices && data.choices[0]?.message?.content) {
-          try {
-            await api.savePropertyAnalysis({
-              address: address,
-              package_name: selectedPackage.name,
-              analysis_content: data.choices[0].message.content,
-              analysis_model: data.model || 'sonar',
-              api_response: data,
-              agent_description: data.agent_description || '',
-              payment_intent_id: paymentResult.paymentIntent.id,
-            });
-            console.log('Property analysis saved successfully');
-            
-            // Small delay to ensure the analysis is saved before showing result
-            await new Promise(resolve => setTimeout(resolve, 500));
-          } catch (saveError) {
-            console.error('Error saving property analysis:', saveError);
-            // Continue with the flow even if save fails
-          }
-        }
+        const job = await api.submitAnalysisJob({
+          address: address,
+          package_name: selectedPackage.name,
+          payment_intent_id: paymentResult.paymentIntent.id,
+        });
         
-        onPerplexityResult(address, data);
+        setQueueStatus(job);
+        await awaitPaidAnalysis(api, job.job_id, paymentResult.paymentIntent.id);
       } else {
         // If no address or onPerplexityResult, just proceed with normal flow
         onSelect(selectedPackage);
@@ -143,6 +181,24 @@ const PackageSelection = ({ onSelect, onPerplexityResult, onBack, address }) =>
       onSelect(selectedPackage);
     } finally {
       setIsProcessing(false);
+      setQueueStatus(null);
+    }
+  };
+
+  const handleCheckAgain = async () => {
+    const { jobId, paymentIntentId } = pendingJob;
+    setPendingJob(null);
+    setIsProcessing(true);
+
+    try {
+      const { api } = await import('../utils/api');
+      await awaitPaidAnalysis(api, jobId, paymentIntentId);
+    } catch (error) {
+      console.error('Error waiting for analysis:', error);
+      onSelect(selectedPackage);
+    } finally {
+      setIsProcessing(false);
+      setQueueStatus(null);
     }
   };
 
@@ -172,6 +228,25 @@ const PackageSelection = ({ onSelect, onPerplexityResult, onBack, address }) =>
     );
   }
 
+  // The analysis is taking longer than checkout waits for
+  if (pendingJob) {
+    return (
+      <div className="min-h-screen theme-bg-primary flex items-center justify-center">
+        <div className="card text-center max-w-lg mx-4">
+          <Clock className="w-16 h-16 text-blue-400 mx-auto mb-6" />
+          <h2 className="text-2xl font-bold theme-text-primary mb-4">Still Processing</h2>
+          <p className="theme-text-secondary mb-6">
+            Your payment is confirmed and your analysis for {address} is still being generated.
+            It is saved to your account as soon as it is ready and will appear in your recent analyses.
+          </p>
+          <button onClick={handleCheckAgain} className="btn-primary">
+            Check again
+          </button>
+        </div>
+      </div>
+    );
+  }
+
   // Show processing state
   if (isProcessing) {
     return (
@@ -193,6 +268,13 @@ const PackageSelection = ({ onSelect, onPerplexityResult, onBack, address }) =>
               <span>Generating AI content...</span>
             </div>
           </div>
+          {queueStatus?.status === 'queued' && queueStatus.queue_position && (
+            <p className="theme-text-secondary text-sm mt-6">
+              Position {queueStatus.queue_position} in the queue
+              {queueStatus.estimated_wait_seconds != null &&
+                ` · about ${Math.max(1, Math.round(queueStatus.estimated_wait_seconds / 60))} min`}
+            </p>
+          )}
         </div>
       </div>
     );
@@ -501,334 +501,10 @@ class API {
     }
   }
 
-  async perplexityAnalyze(address) {
-    // First, generate the agent description
-    let agentDescription = '';
-    try {
-      agentDescription = await this.generateAgentDescription();
-    } catch (error) {
-      console.warn('Failed to generate agent description, proceeding without it:', error);
-    }
-
-    const prompt = ` Create a comprehensive, data-driven real estate listing presentation for the property at ${address}.
-    Use real-time web search to gather current, accurate market information.
-    IMPORTANT: Format your response as clean HTML with the following structure. Do NOT use any markdown formatting, stars (*), hashes (#), or special characters. Use only clean text and the HTML structure provided:
-    <div class="property-analysis">
-      ${agentDescription ? `
-      <section class="analysis-section" data-section="1">
-        <div class="section-header">
-          <h2>👋 Welcome</h2>
-        </div>
-        <div class="section-content">
-          ${agentDescription}
-        </div>
-      </section>
-      ` : ''}
-      <section class="analysis-section" data-section="${agentDescription ? '2' : '1'}">
-        <div class="section-header">
-          <h2>What Buyers Love About ${address}</h2>
-        </div>
-        <div class="section-content">
-          <p>Brief introduction paragraph about the area's appeal and key selling points.</p>
-          <ul>
-            <li>Specific neighborhood feature or amenity</li>
-            <li>Local lifestyle benefits and community features</li>
-            <li>Transportation and accessibility advantages</li>
-            <li>Safety ratings and community atmosphere</li>
-            <li>Recent developments or improvements</li>
-            <li>Balance of urban convenience with suburban comfort</li>
-          </ul>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '3' : '2'}">
-        <div class="section-header">
-          <h2>Neighborhood & Proximity Highlights</h2>
-        </div>
-        <div class="section-content">
-          <p>Here's what stands out about [specific street/area] and the surrounding area:</p>
-          <ul>
-            <li><strong>Lifestyle:</strong> Description of living environment and privacy</li>
-            <li><strong>Local Amenities:</strong>
-              <ul>
-                <li>Specific nearby recreational facilities</li>
-                <li>Parks, wineries, or entertainment venues</li>
-              </ul>
-            </li>
-            <li><strong>Schools:</strong> Highly rated public schools including <strong>School Name</strong>, <strong>School Name</strong>, and <strong>School Name</strong></li>
-            <li><strong>Shopping & Dining:</strong>
-              <ul>
-                <li>Specific shopping centers and grocery stores</li>
-                <li>Popular restaurants and dining areas</li>
-              </ul>
-            </li>
-            <li><strong>Commute Access:</strong> Transportation options and commute times to major areas</li>
-          </ul>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '4' : '3'}">
-        <div class="section-header">
-          <h2>Ideal Buyer Persona</h2>
-        </div>
-        <div class="section-content">
-          <div class="subsection">
-            <h3>Demographic Profile</h3>
-            <ul>
-              <li><strong>Age:</strong> Specific age range</li>
-              <li><strong>Income:</strong> Household income range</li>
-              <li><strong>Occupation:</strong> Common professional backgrounds</li>
-              <li><strong>Family Status:</strong> Family composition and lifestyle stage</li>
-            </ul>
-          </div>
-          <div class="subsection">
-            <h3>Psychographic Profile</h3>
-            <ul>
-              <li><strong>Values:</strong> What buyers prioritize in this area</li>
-              <li><strong>Lifestyle:</strong> Preferred activities and living style</li>
-              <li><strong>Interests:</strong> Common hobbies and interests</li>
-              <li><strong>Pain Points:</strong>
-                <ul>
-                  <li>Common concerns or deal-breakers</li>
-                  <li>Market challenges they face</li>
-                </ul>
-              </li>
-              <li><strong>Motivations:</strong>
-                <ul>
-                  <li>Primary reasons for moving to this area</li>
-                  <li>Investment or lifestyle goals</li>
-                </ul>
-              </li>
-          </ul>
-          </div>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '5' : '4'}">
-        <div class="section-header">
-          <h2>Market Snapshot</h2>
-        </div>
-        <div class="section-content">
-          <div class="subsection">
-            <h3>Active Listings Within 1-3 Mile Radius</h3>
-            <table class="listings-table">
-              <thead>
-                <tr>
-                  <th>Address</th>
-                  <th>Beds</th>
-                  <th>Baths</th>
-                  <th>Sqft</th>
-                  <th>Price</th>
-                </tr>
-              </thead>
-              <tbody>
-                <tr>
-                  <td>123 Example Street</td>
-                  <td>3</td>
-                  <td>2</td>
-                  <td>1,850</td>
-                  <td>$750,000</td>
-                </tr>
-                <tr>
-                  <td>456 Sample Avenue</td>
-                  <td>4</td>
-                  <td>3</td>
-                  <td>2,200</td>
-                  <td>$895,000</td>
-                </tr>
-                <tr>
-                  <td>789 Demo Lane</td>
-                  <td>2</td>
-                  <td>2</td>
-                  <td>1,400</td>
-                  <td>$625,000</td>
-                </tr>
-              </tbody>
-            </table>
-            <p class="no-listings" style="display: none;">No active listings found within 1-3 mile radius.</p>
-          </div>
-          <div class="subsection">
-            <h3>Pending Sales Within 1-3 Mile Radius</h3>
-            <table class="listings-table">
-              <thead>
-                <tr>
-                  <th>Address</th>
-                  <th>Beds</th>
-                  <th>Baths</th>
-                  <th>Sqft</th>
-                  <th>Price</th>
-                </tr>
-              </thead>
-              <tbody>
-                <tr>
-                  <td>321 Pending Street</td>
-                  <td>3</td>
-                  <td>2.5</td>
-                  <td>1,950</td>
-                  <td>$780,000</td>
-                </tr>
-                <tr>
-                  <td>654 Contract Avenue</td>
-                  <td>4</td>
-                  <td>3</td>
-                  <td>2,100</td>
-                  <td>$850,000</td>
-                </tr>
-                <tr>
-                  <td>987 Escrow Lane</td>
-                  <td>2</td>
-                  <td>1.5</td>
-                  <td>1,300</td>
-                  <td>$595,000</td>
-                </tr>
-              </tbody>
-            </table>
-            <p class="no-listings" style="display: none;">No pending listings found within 1-3 mile radius.</p>
-          </div>
-          <div class="subsection">
-            <h3>Recently Sold Within 1-3 Mile Radius</h3>
-            <table class="listings-table">
-              <thead>
-                <tr>
-                  <th>Address</th>
-                  <th>Beds</th>
-                  <th>Baths</th>
-                  <th>Sqft</th>
-                  <th>Price</th>
-                </tr>
-              </thead>
-              <tbody>
-                <tr>
-                  <td>111 Sold Street</td>
-                  <td>3</td>
-                  <td>2</td>
-                  <td>1,800</td>
-                  <td>$725,000</td>
-                </tr>
-                <tr>
-                  <td>222 Closed Avenue</td>
-                  <td>4</td>
-                  <td>2.5</td>
-                  <td>2,000</td>
-                  <td>$815,000</td>
-                </tr>
-                <tr>
-                  <td>333 Final Lane</td>
-                  <td>2</td>
-                  <td>2</td>
-                  <td>1,500</td>
-                  <td>$650,000</td>
-                </tr>
-              </tbody>
-            </table>
-            <p class="no-listings" style="display: none;">No sold listings found within 1-3 mile radius.</p>
-          </div>
-          <p><strong>Average Days on Market:</strong> specific number</p>
-          <p><strong>Buyer Activity:</strong> Description of market temperature and buyer behavior</p>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '6' : '5'}">
-        <div class="section-header">
-          <h2>Suggested Pricing Strategy</h2>
-        </div>
-        <div class="section-content">
-          <p><strong>Recommended List Price Range:</strong> $X,XXX,XXX - $X,XXX,XXX</p>
-          <p>This price reflects:</p>
-          <ul>
-            <li>Active and pending competition analysis</li>
-            <li>Recent sales performance in the area</li>
-            <li>Strategic positioning considerations</li>
-          </ul>
-          <p>Additional pricing considerations and market timing advice.</p>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '7' : '6'}">
-        <div class="section-header">
-          <h2>3-Week Marketing Plan</h2>
-        </div>
-        <div class="section-content">
-          <div class="marketing-timeline">
-            <div class="week">
-              <h4>Week 1 - Go-To-Market Foundation</h4>
-              <ul>
-                <li>Professional photography and staging</li>
-                <li>Digital listing preparation</li>
-                <li>MLS and portal listing launch</li>
-                <li>Agent outreach and pre-marketing</li>
-              </ul>
-            </div>
-            <div class="week">
-              <h4>Week 2 - Exposure & Engagement</h4>
-              <ul>
-                <li>Social media campaign launch</li>
-                <li>Video marketing and virtual tours</li>
-                <li>Email marketing to buyer database</li>
-                <li>Partner agent collaboration</li>
-              </ul>
-            </div>
-            <div class="week">
-              <h4>Week 3 - Conversion & Follow-Up</h4>
-              <ul>
-                <li>Open houses and private showings</li>
-                <li>Retargeting campaigns</li>
-                <li>Feedback analysis and strategy adjustment</li>
-                <li>Offer management and negotiation</li>
-              </ul>
-            </div>
-          </div>
-          <p><em>Disclaimer: Market activity and timing may vary. All campaigns are adjusted based on feedback, showings, and buyer behavior.</em></p>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '8' : '7'}">
-        <div class="section-header">
-          <h2>Local Market Report</h2>
-        </div>
-        <div class="section-content">
-          <ul>
-            <li><strong>Inventory Level:</strong> X.X months (Market condition description)</li>
-            <li><strong>Buyer Pool:</strong> Description of buyer activity and motivations</li>
-            <li><strong>List-to-Sale Ratio:</strong> Percentage and market implications</li>
-            <li><strong>Demand:</strong> Current demand patterns and buyer preferences</li>
-          </ul>
-          <p>Market summary and outlook for the area.</p>
-        </div>
-      </section>
-      <section class="analysis-section" data-section="${agentDescription ? '9' : '8'}">
-        <div class="section-header">
-          <h2>Selling Timeline Overview</h2>
-        </div>
-        <div class="section-content">
-          <p>From preparation to closing:</p>
-          <ol>
-            <li><strong>Pre-Market Setup:</strong> Photography, staging recommendations, property prep</li>
-            <li><strong>Live on Market:</strong> Syndication + agent promotion</li>
-            <li><strong>Showings:</strong> Weekend and weekday showings with feedback</li>
-            <li><strong>Offers:</strong> Reviewed and negotiated</li>
-            <li><strong>Under Contract:</strong> Inspections, appraisal, and title</li>
-            <li><strong>Closing:</strong> Final walkthrough and celebration</li>
-          </ol>
-          <p>You'll receive clear expectations, weekly progress updates, and full transparency every step of the way.</p>
-        </div>
-      </section>
-    </div>
-    CRITICAL INSTRUCTIONS:
-    1. Replace ALL template content with REAL, CURRENT data about ${address}
-    2. Search the web for current, real-time information about this specific address and surrounding area
-    3. Include specific data points, recent sales figures, current listings, and up-to-date market conditions
-    4. Use the exact HTML structure provided above
-    5. Fill each section with actual researched data, not generic advice
-    6. Keep all HTML tags exactly as shown
-    7. Focus on actionable, location-specific information that reflects today's market reality
-    8. Do NOT use any markdown formatting, stars (*), hashes (#), or special characters
-    9. Use only clean text, HTML tags, and <strong> tags for emphasis
-    10. Ensure all data is current and location-specific
-    11. Include real addresses, school names, and specific local amenities
-    12. Provide actual price ranges and market data
-    13. CRITICAL: For Market Snapshot sections (Active Listings, Pending Sales, Recently Sold), ONLY include actual properties found within 1-3 mile radius. If no properties are found for any section, hide the table and show the "No listings found" message by changing the table style to "display: none;" and the .no-listings paragraph style to "display: block;"
-    14. Use the exact table structure provided with Address|Beds|Baths|Sqft|Price columns
-    15. Fill tables with real property data when available, ensuring all data is current and location-specific
-    16. ONLY show positive, factual information that was actually discovered through research
-    `;
-
-    // Use the API base URL configuration
-    const response = await fetch(`${API_BASE_URL}/auth/perplexity/`, {
+  async perplexityAnalyze(address, packageName = 'Professional', options = {}) {
+    // The prompt is rendered server-side from the address; the backend also
+    // adds the agent welcome section and returns it as agent_description
+    const response = await fetch(`${API_BASE_URL}/auth/analyses/generate/`, {
       method: 'POST',
       headers: { 
         'Content-Type': 'application/json',
@@ -838,13 +514,9 @@ class API {
         })
       },
       body: JSON.stringify({
-        model: 'sonar',
-        messages: [
-          {
-            role: 'user',
-            content: prompt
-          }
-        ]
+        address,
+        package_name: packageName,
+        options
       }),
     });
     
@@ -856,6 +528,91 @@ class API {
     return response.json();
   }
 
+  // Stream a Perplexity completion as server-sent events.
+  // onDelta receives each text chunk; resolves with the assembled completion,
+  // whose result_token (signed-in users) saves it with saveGeneratedAnalysis.
+  // The server keeps generating if the connection drops, so the stream is
+  // resumed from the last received offset instead of starting over.
+  async perplexityStream(body, onDelta, maxResumes = 3) {
+    const authHeaders = {
+      ...(localStorage.getItem('token') && {
+        'Authorization': `Bearer ${localStorage.getItem('token')}`
+      })
+    };
+    const state = { generationId: null, offset: 0, completion: null };
+
+    let response = await fetch(`${API_BASE_URL}/auth/perplexity/`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', ...authHeaders },
+      body: JSON.stringify({ ...body, stream: true }),
+    });
+
+    for (let resumes = 0; ; resumes++) {
+      if (!response.ok || !response.body) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.error || `Perplexity API error: ${response.status}`);
+      }
+
+      try {
+        await this.readGenerationEvents(response, state, onDelta);
+      } catch (error) {
+        // Server-reported errors are final; dropped connections are resumed
+        if (error.serverError || !state.generationId || resumes >= maxResumes) throw error;
+      }
+      if (state.completion) return state.completion;
+      if (!state.generationId || resumes >= maxResumes) break;
+
+      response = await fetch(
+        `${API_BASE_URL}/auth/perplexity/generations/${state.generationId}/?offset=${state.offset}`,
+        { headers: authHeaders },
+      );
+    }
+
+    throw new Error('Perplexity stream ended before completion');
+  }
+
+  async readGenerationEvents(response, state, onDelta) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      // Events are separated by a blank line
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let eventType = 'message';
+        let data = '';
+        for (const line of rawEvent.split('\n')) {
+          if (line.startsWith('event:')) eventType = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
+        }
+        if (!data) continue;
+
+        const payload = JSON.parse(data);
+        if (eventType === 'generation') {
+          state.generationId = payload.generation_id;
+          state.offset = payload.offset;
+        } else if (eventType === 'delta') {
+          if (payload.offset !== undefined) state.offset = payload.offset;
+          if (onDelta) onDelta(payload.content);
+        } else if (eventType === 'done') {
+          state.completion = payload;
+        } else if (eventType === 'error') {
+          const error = new Error(payload.error || 'Perplexity streaming error');
+          error.serverError = true;
+          throw error;
+        }
+      }
+    }
+  }
+
   // Property Analysis methods
   async savePropertyAnalysis(analysisData) {
     const response = await fetch(`${API_BASE_URL}/auth/analyses/save/`, {
@@ -877,6 +634,147 @@ class API {
     return response.json();
   }
 
+  // Save a result the server kept from perplexityAnalyze or perplexityStream
+  // (result_token) or the proxy (X-Result-Token header) without uploading it
+  // again; edits may carry address, package_name, analysis_content,
+  // agent_description, payment_intent_id
+  async saveGeneratedAnalysis(resultToken, edits = {}) {
+    return this.savePropertyAnalysis({ ...edits, result_token: resultToken });
+  }
+
+  // Background analysis jobs
+  async submitAnalysisJob(jobData) {
+    const response = await fetch(`${API_BASE_URL}/auth/jobs/`, {
+      method: 'POST',
+      headers: { 
+        'Content-Type': 'application/json',
+        ...(localStorage.getItem('token') && {
+          'Authorization': `Bearer ${localStorage.getItem('token')}`
+        })
+      },
+      body: JSON.stringify(jobData),
+    });
+    
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `Error queuing analysis: ${response.status}`);
+    }
+    
+    return response.json();
+  }
+
+  // Claim a still-queued job to generate it inline; resolves with
+  // { taken, job }, and taken is false when a worker got to it first
+  async takeOverAnalysisJob(jobId) {
+    const response = await fetch(`${API_BASE_URL}/auth/jobs/${jobId}/take-over/`, {
+      method: 'POST',
+      headers: { 
+        'Content-Type': 'application/json',
+        ...(localStorage.getItem('token') && {
+          'Authorization': `Bearer ${localStorage.getItem('token')}`
+        })
+      },
+    });
+    
+    if (!response.ok && response.status !== 409) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `Error taking over analysis job: ${response.status}`);
+    }
+    
+    return { taken: response.ok, job: await response.json() };
+  }
+
+  async waitForAnalysisJob(jobId, timeout = 25, onUpdate = null, maxWait = 180) {
+    // Long-poll until the worker finishes the job or maxWait seconds pass, then
+    // resolve with the job in its latest state (check job.status); onUpdate
+    // receives the job (with queue_position / estimated_wait_seconds while
+    // queued) after each poll. Servers that cannot hold the request open
+    // answer at once with Retry-After, and the next poll waits that long
+    const deadline = Date.now() + maxWait * 1000;
+    for (;;) {
+      const pollTimeout = Math.max(1, Math.min(timeout, Math.ceil((deadline - Date.now()) / 1000)));
+      const response = await fetch(`${API_BASE_URL}/auth/jobs/${jobId}/wait/?timeout=${pollTimeout}`, {
+        method: 'GET',
+        headers: { 
+          'Content-Type': 'application/json',
+          ...(localStorage.getItem('token') && {
+            'Authorization': `Bearer ${localStorage.getItem('token')}`
+          })
+        },
+      });
+      
+      if (!response.ok) {
+        const errorData = await response.json().catch(() => ({}));
+        throw new Error(errorData.error || `Error fetching analysis job: ${response.status}`);
+      }
+      
+      const job = await response.json();
+      if (job.status === 'succeeded' || job.status === 'failed' || Date.now() >= deadline) {
+        return job;
+      }
+      if (onUpdate) {
+        onUpdate(job);
+      }
+      const retryAfter = Number(response.headers.get('Retry-After'));
+      if (retryAfter > 0) {
+        const delay = Math.min(retryAfter * 1000, Math.max(0, deadline - Date.now()));
+        await new Promise((resolve) => setTimeout(resolve, delay));
+      }
+    }
+  }
+
+  // Queue analyses for many addresses: pass { addresses: [...] } or a CSV File
+  async submitAnalysisBatch({ addresses, file, ...batchOptions }) {
+    let body;
+    const headers = {
+      ...(localStorage.getItem('token') && {
+        'Authorization': `Bearer ${localStorage.getItem('token')}`
+      })
+    };
+    if (file) {
+      body = new FormData();
+      body.append('file', file);
+      for (const [key, value] of Object.entries(batchOptions)) {
+        body.append(key, typeof value === 'object' ? JSON.stringify(value) : value);
+      }
+    } else {
+      headers['Content-Type'] = 'application/json';
+      body = JSON.stringify({ addresses, ...batchOptions });
+    }
+
+    const response = await fetch(`${API_BASE_URL}/auth/batches/`, {
+      method: 'POST',
+      headers,
+      body,
+    });
+    
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `Error queuing batch: ${response.status}`);
+    }
+    
+    return response.json();
+  }
+
+  async getAnalysisBatch(batchId, includeJobs = true) {
+    const response = await fetch(`${API_BASE_URL}/auth/batches/${batchId}/?jobs=${includeJobs}`, {
+      method: 'GET',
+      headers: { 
+        'Content-Type': 'application/json',
+        ...(localStorage.getItem('token') && {
+          'Authorization': `Bearer ${localStorage.getItem('token')}`
+        })
+      },
+    });
+    
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `Error fetching batch: ${response.status}`);
+    }
+    
+    return response.json();
+  }
+
   async getRecentAnalyses() {
     const response = await fetch(`${API_BASE_URL}/auth/analyses/recent/`, {
       method: 'GET',
@@ -915,6 +813,27 @@ class API {
     return response.json();
   }
 
+  // Regenerate the time-sensitive sections (listings, pricing, market report)
+  async refreshPropertyAnalysis(analysisId, sections = null) {
+    const response = await fetch(`${API_BASE_URL}/auth/analyses/${analysisId}/refresh/`, {
+      method: 'POST',
+      headers: { 
+        'Content-Type': 'application/json',
+        ...(localStorage.getItem('token') && {
+          'Authorization': `Bearer ${localStorage.getItem('token')}`
+        })
+      },
+      body: JSON.stringify(sections ? { sections } : {}),
+    });
+    
+    if (!response.ok) {
+      const errorData = await response.json().catch(() => ({}));
+      throw new Error(errorData.error || `Error refreshing analysis: ${response.status}`);
+    }
+    
+    return response.json();
+  }
+
   async deletePropertyAnalysis(analysisId) {
     const response = await fetch(`${API_BASE_URL}/auth/analyses/${analysisId}/delete/`, {
       method: 'DELETE',